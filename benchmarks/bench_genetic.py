@@ -0,0 +1,47 @@
+"""
+Benchmarks for genetic programming.
+"""
+
+import crianza
+import crianza.genetic as gp
+import random
+
+MACHINES = 200
+
+
+class Square(gp.GeneticMachine):
+    """Evolves programs that square their input, as in
+    examples/genetic/square-number.py."""
+
+    def __init__(self, code=None):
+        super(Square, self).__init__(code if code is not None else [])
+        self._input = 0
+
+    def new(self, *args, **kw):
+        return Square(*args, **kw)
+
+    def setUp(self):
+        self._orig = self.code
+        self._input = random.randint(0, 100)
+        self.code = [crianza.compiler.make_embedded_push(self._input)] + self.code
+        return self.reset()
+
+    def tearDown(self):
+        self.code = self._orig
+
+    def score(self):
+        wanted = (self._input**2, 0, 1, 0)
+        weights = (0.10, 0.80, 0.05, 0.05)
+        actual = (self.top if crianza.isnumber(self.top) else 9999.9,
+                  1000 if self._error else 0,
+                  len(self.stack),
+                  len(self.return_stack))
+        return 1.0 - gp.weighted_tanimoto(actual, wanted, weights)
+
+def generation():
+    random.seed(0)
+    gp.iterate(Square, stop_function=lambda iterations, _: iterations >= 1,
+            machines=MACHINES, silent=True)
+
+def benchmarks():
+    return [("genetic.iterate", generation, MACHINES)]
@@ -0,0 +1,37 @@
+"""
+Benchmarks for running code on the virtual machine.
+
+Each kernel is an endless loop, run for a fixed number of instructions.
+"""
+
+import crianza
+import crianza.jit
+
+STEPS = 100000
+
+kernels = {
+    # Fibonacci numbers modulo a prime
+    "fib": "0 1 @ swap over + 1000003 % return",
+
+    # Linear congruential generator with some stack shuffling
+    "arithmetic": "1 @ 75 * 74 + 65537 % dup 2 / drop return",
+
+    # Subroutine calls
+    "calls": ": sq dup * 65521 % ; 2 @ sq 1 + return",
+}
+
+def run(machine_class, code):
+    def function():
+        machine_class(code, output=None).run(STEPS)
+    return function
+
+def benchmarks():
+    out = []
+    for name in sorted(kernels):
+        source = crianza.parse(kernels[name])
+        code = crianza.compile(source)
+        out += [
+            ("machine.run.%s" % name, run(crianza.Machine, code), STEPS),
+            ("jit.run.%s" % name, run(crianza.jit.JitMachine, code), STEPS),
+        ]
+    return out
@@ -0,0 +1,37 @@
+"""
+Benchmarks for the optimizer and compiler.
+"""
+
+from crianza import optimizer
+import crianza
+
+def chain(length):
+    """Returns code adding up a long chain of constants, 1 1 + 1 + ..."""
+    return [1] + [1, "+"]*length
+
+def mixed(length):
+    """Returns code with a mix of foldable sequences and output."""
+    block = [2, 3, "swap", "drop", 4, "dup", "*", "+", 5, "str", "cast_int",
+             "."]
+    return block*length
+
+def program(subroutines):
+    """Returns source code with a number of small subroutines."""
+    lines = [": sub%d dup %d + swap 2 3 * drop ;" % (n, n)
+             for n in range(subroutines)]
+    lines.append(" ".join("1 sub%d" % n for n in range(subroutines)))
+    return "\n".join(lines)
+
+def benchmarks():
+    fold = chain(200)
+    rewrites = mixed(10)
+    source = crianza.parse(program(100))
+
+    return [
+        ("optimizer.constant_fold.chain", lambda:
+            optimizer.constant_fold(list(fold)), len(fold)),
+        ("optimizer.constant_fold.mixed", lambda:
+            optimizer.constant_fold(list(rewrites)), len(rewrites)),
+        ("compiler.compile", lambda: crianza.compile(list(source)),
+            len(source)),
+    ]
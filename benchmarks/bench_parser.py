@@ -0,0 +1,44 @@
+"""
+Benchmarks for the tokenizer and parser.
+"""
+
+from crianza.tokenizer import Tokenizer
+import crianza
+import random
+import six
+
+def source(lines=2000, seed=0):
+    """Generates source code with numbers, strings, words and comments."""
+    rng = random.Random(seed)
+    words = ["dup", "drop", "swap", "over", "rot", "+", "-", "*", "square"]
+    out = [": square dup * ;"]
+    for n in range(lines):
+        parts = []
+        for _ in range(10):
+            r = rng.random()
+            if r < 0.4:
+                parts.append(str(rng.randint(0, 99999)))
+            elif r < 0.5:
+                parts.append("%d.%d" % (rng.randint(0, 999), rng.randint(0, 99)))
+            elif r < 0.6:
+                parts.append('"line %d"' % n)
+            else:
+                parts.append(rng.choice(words))
+        out.append(" ".join(parts) + "  # comment")
+    return "\n".join(out) + "\n"
+
+def benchmarks():
+    text = source()
+    tokens = len(crianza.parse(text))
+
+    def tokenize():
+        for _ in Tokenizer(six.StringIO(text)).tokenize():
+            pass
+
+    def parse():
+        crianza.parse(text)
+
+    return [
+        ("tokenizer.tokenize", tokenize, tokens),
+        ("parser.parse", parse, tokens),
+    ]
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+"""
+Runs the crianza benchmarks and writes the results as JSON.
+
+Each bench_*.py module in this directory has a benchmarks() function
+returning a list of (name, function, operations) tuples, where function runs
+one iteration and operations is the number of units of work it does (tokens,
+instructions, machines), used to report throughput.
+
+Usage:
+    PYTHONPATH=. python benchmarks/run.py --output results.json
+    PYTHONPATH=. python benchmarks/run.py --compare results.json
+"""
+
+import crianza
+import datetime
+import glob
+import json
+import optparse
+import os
+import platform
+import subprocess
+import sys
+import timeit
+
+def options():
+    opt = optparse.OptionParser("Usage: %prog [option(s)]")
+
+    opt.add_option("-o", "--output", dest="output", metavar="FILE",
+        help="Write results as JSON to FILE.",
+        default=None)
+
+    opt.add_option("-c", "--compare", dest="compare", metavar="FILE",
+        help="Compare results with an earlier JSON file.",
+        default=None)
+
+    opt.add_option("-r", "--repeat", dest="repeat", type="int",
+        help="Number of timing runs per benchmark (default: %default).",
+        default=5)
+
+    opt.add_option("-k", dest="filter", metavar="TEXT",
+        help="Only run benchmarks whose name contains TEXT.",
+        default=None)
+
+    return opt
+
+def modules():
+    """Imports and returns all benchmark modules."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, directory)
+    names = sorted(os.path.basename(p)[:-3] for p in
+                   glob.glob(os.path.join(directory, "bench_*.py")))
+    return [__import__(name) for name in names]
+
+def commit():
+    """Returns the current git commit, if any."""
+    try:
+        with open(os.devnull, "w") as null:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                    stderr=null).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def measure(function, repeat):
+    """Returns the best and mean time of a number of calls."""
+    function() # Warm up caches
+    times = timeit.repeat(function, number=1, repeat=repeat)
+    return min(times), sum(times) / len(times)
+
+def run(opts):
+    results = {}
+    for module in modules():
+        for name, function, operations in module.benchmarks():
+            if opts.filter is not None and opts.filter not in name:
+                continue
+            best, mean = measure(function, opts.repeat)
+            results[name] = {
+                "seconds": best,
+                "mean_seconds": mean,
+                "repeat": opts.repeat,
+                "operations": operations,
+                "operations_per_second": operations / best if best > 0 else None,
+            }
+            sys.stderr.write("%-36s %12.6f s %14.0f ops/s\n" % (name, best,
+                operations / best if best > 0 else 0))
+
+    return {
+        "crianza": crianza.__version__,
+        "python": "%s %s" % (platform.python_implementation(),
+                             platform.python_version()),
+        "platform": platform.platform(),
+        "commit": commit(),
+        "date": datetime.datetime.utcnow().isoformat() + "Z",
+        "results": results,
+    }
+
+def compare(old, new, out=sys.stdout):
+    """Prints the speedup of each benchmark from old to new results."""
+    out.write("%-36s %12s %12s %8s\n" % ("Benchmark", "Before", "After",
+        "Speedup"))
+    for name in sorted(new["results"]):
+        after = new["results"][name]["seconds"]
+        if name not in old["results"]:
+            out.write("%-36s %12s %12.6f %8s\n" % (name, "-", after, "-"))
+            continue
+        before = old["results"][name]["seconds"]
+        out.write("%-36s %12.6f %12.6f %7.2fx\n" % (name, before, after,
+            before / after if after > 0 else float("inf")))
+
+def main():
+    opt = options()
+    (opts, args) = opt.parse_args()
+
+    results = run(opts)
+
+    if opts.output is not None:
+        with open(opts.output, "wt") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+            file.write("\n")
+
+    if opts.compare is not None:
+        with open(opts.compare, "rt") as file:
+            compare(json.load(file), results)
+
+    if opts.output is None and opts.compare is None:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
 from crianza.compiler import (check, compile)
+from crianza.debug import DebugInfo
 from crianza.errors import CompileError, MachineError, ParseError
-from crianza.instructions import lookup
-from crianza.optimizer import constant_fold, optimized
+from crianza.instructions import Instruction, lookup
+from crianza.optimizer import constant_fold, native_fold, optimized
 from crianza.parser import (parse, parse_stream)
+from crianza.passes import PassManager
+from crianza.program import Program, assemble
 from crianza.repl import repl, print_code
 from crianza.stack import Stack
 from crianza.interpreter import (
@@ -25,11 +28,15 @@ __version__ = "0.1.9"
 
 __all__ = [
     "CompileError",
+    "DebugInfo",
     "Instruction",
     "Machine",
     "MachineError",
     "ParseError",
+    "PassManager",
+    "Program",
     "Stack",
+    "assemble",
     "check",
     "code_to_string",
     "compile",
@@ -42,6 +49,7 @@ __all__ = [
     "isnumber",
     "isstring",
     "lookup",
+    "native_fold",
     "optimized",
     "parse",
     "parse_stream",
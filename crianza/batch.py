@@ -0,0 +1,600 @@
+"""
+Contains a batch interpreter, which runs one program on many inputs at once.
+
+Each data and return stack cell holds a NumPy array with one value for each
+input, or lane, so an instruction runs once for the whole batch instead of once
+per input:
+
+    from crianza import batch
+    code = crianza.compile(crianza.parse("dup * 1 +"))
+    result = batch.run(code, [numpy.arange(1000)])
+    result.top # array([1.0, 2.0, 5.0, ...])
+
+Lanes run in lockstep. When they take different branches, or if chooses
+values of different types, the batch is split into groups that go on
+separately. A lane that raises an error stops there with its error flag set,
+like in GeneticMachine.run().
+
+Values must be booleans, integers or floats. Lanes whose values cannot be held
+in the arrays, like integers that overflow 64 bits or strings, go on in a
+Machine each from where they are, so the results are the same as those of the
+virtual machine, except that integers and floats are compared and divided as
+floats. The same happens for instructions that are not supported here, like
+input and output.
+
+Requires NumPy.
+"""
+
+from crianza import compiler as cc
+from crianza import instructions as cr
+from crianza import interpreter
+from crianza import program
+from crianza import stack as st
+from crianza import superinstructions
+import numpy
+import six
+import sys
+
+_MIN = numpy.iinfo(numpy.int64).min
+_MAX = numpy.iinfo(numpy.int64).max
+
+
+def _array(values, size):
+    """Returns values as a boolean, 64-bit integer or float array."""
+    a = numpy.asarray(values)
+    if a.ndim == 0:
+        a = numpy.repeat(a, size)
+    if a.dtype.kind == "b":
+        return a.astype(bool)
+    if a.dtype.kind in "iu" and (a.size == 0 or (a.min() >= _MIN and
+            a.max() <= _MAX)):
+        return a.astype(numpy.int64)
+    if a.dtype.kind == "f":
+        return a.astype(numpy.float64)
+    raise ValueError("Batch values must be booleans, integers or floats: %r" %
+            (values,))
+
+def _number(a):
+    """Returns booleans as integers, since Python treats them as numbers."""
+    return a.astype(numpy.int64) if a.dtype.kind == "b" else a
+
+def _isfloat(*args):
+    return any(a.dtype.kind == "f" for a in args)
+
+
+class _Group(object):
+    """Lanes that run in lockstep, at the same address and with stacks of the
+    same size and types."""
+
+    def __init__(self, lanes, ip, stack, rstack, steps):
+        self.lanes = lanes
+        self.ip = ip
+        self.stack = stack
+        self.rstack = rstack
+        self.steps = steps
+
+    def __len__(self):
+        return len(self.lanes)
+
+    def take(self, mask):
+        """Returns a new group of the lanes in mask, and keeps the rest."""
+        group = _Group(self.lanes[mask], self.ip,
+                [a[mask] for a in self.stack], [a[mask] for a in self.rstack],
+                self.steps)
+        keep = ~mask
+        self.lanes = self.lanes[keep]
+        self.stack = [a[keep] for a in self.stack]
+        self.rstack = [a[keep] for a in self.rstack]
+        return group
+
+    def pop(self):
+        return self.stack.pop()
+
+    def push(self, value):
+        self.stack.append(value)
+
+    def goto(self, ip):
+        """Continues at ip, counting the current instruction as a step."""
+        self.ip = ip
+        self.steps += 1
+        return self
+
+
+class BatchResult(object):
+    """The state of each lane after a batch run.
+
+    Attributes:
+        errors: Whether each lane stopped with an error.
+        depth: The number of values on the data stack of each lane.
+        return_depth: The number of values on the return stack of each lane.
+        top: The top of the data stack of each lane as a float, or NaN if it
+            is empty or not a number.
+    """
+
+    def __init__(self, size, groups, machines):
+        self.errors = numpy.zeros(size, dtype=bool)
+        self.depth = numpy.zeros(size, dtype=numpy.int64)
+        self.return_depth = numpy.zeros(size, dtype=numpy.int64)
+        self.top = numpy.full(size, numpy.nan)
+        self._groups = groups
+        self._machines = machines
+        self._group = numpy.full(size, -1, dtype=numpy.int64)
+        self._position = numpy.zeros(size, dtype=numpy.int64)
+
+        for n, (group, error) in enumerate(groups):
+            lanes = group.lanes
+            self.errors[lanes] = error
+            self.depth[lanes] = len(group.stack)
+            self.return_depth[lanes] = len(group.rstack)
+            if len(group.stack) > 0:
+                self.top[lanes] = group.stack[-1]
+            self._group[lanes] = n
+            self._position[lanes] = numpy.arange(len(lanes))
+
+        for lane, (values, rdepth, error) in machines.items():
+            self.errors[lane] = error
+            self.depth[lane] = len(values)
+            self.return_depth[lane] = rdepth
+            if len(values) > 0 and interpreter.isnumber(values[-1]):
+                try:
+                    self.top[lane] = float(values[-1])
+                except OverflowError:
+                    self.top[lane] = numpy.inf if values[-1] > 0 else -numpy.inf
+
+    def __len__(self):
+        return len(self.errors)
+
+    def stack(self, lane):
+        """Returns the data stack of a lane as a list of Python values."""
+        if lane in self._machines:
+            return list(self._machines[lane][0])
+        group, _ = self._groups[self._group[lane]]
+        position = self._position[lane]
+        return [a[position].item() for a in group.stack]
+
+    def __repr__(self):
+        return "<BatchResult: lanes=%d errors=%d>" % (len(self),
+                numpy.count_nonzero(self.errors))
+
+
+class _Batch(object):
+    """Runs code on groups of lanes."""
+
+    def __init__(self, code, steps, output, input):
+        self.code = code
+        self.steps = steps
+        self.output = output
+        self.input = input
+        self.groups = [] # Finished groups and whether they failed
+        self.machines = {} # Lanes that finished in a Machine
+
+    def finish(self, g, error=False):
+        if len(g) > 0:
+            self.groups.append((g, error))
+
+    def fail(self, g, mask=None, stack=None):
+        """Stops the lanes in mask with an error, with the given data stack,
+        or the current one. Returns whether any lanes are left."""
+        if mask is None:
+            mask = numpy.ones(len(g), dtype=bool)
+        if stack is not None:
+            g.stack = stack
+        if mask.any():
+            self.finish(g.take(mask), error=True)
+        return len(g) > 0
+
+    def underflow(self, g, count):
+        """Stops all lanes if the stack has fewer than count values, which
+        the instructions pop until the stack is empty."""
+        if len(g.stack) < count:
+            return not self.fail(g, stack=[])
+        return False
+
+    def fallback(self, g, mask=None):
+        """Runs the lanes in mask on a Machine each, from the current
+        instruction."""
+        if mask is None:
+            mask = numpy.ones(len(g), dtype=bool)
+        if not mask.any():
+            return
+        g = g.take(mask)
+        steps = None if self.steps is None else self.steps - g.steps
+
+        for n, lane in enumerate(g.lanes):
+            m = interpreter.Machine(self.code, output=self.output,
+                    input=self.input)
+            m.data_stack = st.Stack([a[n].item() for a in g.stack])
+            m.return_stack = st.Stack([a[n].item() for a in g.rstack])
+            m.instruction_pointer = g.ip
+            error = False
+            if steps is None or steps > 0:
+                try:
+                    m.run(steps)
+                except Exception:
+                    error = True
+            self.machines[int(lane)] = (m.stack, len(m.return_stack), error)
+
+    def jump(self, g):
+        """Jumps each lane to its address on top of the stack, splitting the
+        group if they differ. Returns the groups to go on with."""
+        if len(g.stack) == 0:
+            self.fail(g)
+            return []
+        if g.stack[-1].dtype.kind == "f":
+            self.fail(g)
+            return []
+        address = _number(g.pop())
+        self.fail(g, (address < 0) | (address >= len(self.code)))
+        address = address[(address >= 0) & (address < len(self.code))]
+        return self.split(g, address)
+
+    def split(self, g, address):
+        """Splits the group by address, and continues each part there."""
+        groups = []
+        for ip in numpy.unique(address):
+            mask = address == ip
+            if mask.all():
+                groups.append(g.goto(int(ip)))
+            else:
+                groups.append(g.take(mask).goto(int(ip)))
+                address = address[~mask]
+        return groups
+
+    def run(self, g):
+        pending = [g]
+        while pending:
+            g = pending.pop()
+            while len(g) > 0:
+                if g.ip >= len(self.code) or (self.steps is not None and
+                        g.steps >= self.steps):
+                    self.finish(g)
+                    break
+
+                op = self.code[g.ip]
+                if cc.is_embedded_push(op):
+                    handler = _push
+                else:
+                    handler = _handlers.get(op)
+                if handler is None:
+                    self.fallback(g)
+                    break
+
+                groups = handler(self, g, op)
+                if groups is not None:
+                    pending.extend(part for part in groups if len(part) > 0)
+                    break
+                g.goto(g.ip + 1)
+
+
+def run(code, stack=(), steps=None, size=None, output=sys.stdout,
+        input=sys.stdin):
+    """Runs code once for each lane of a batch.
+
+    Args:
+        code: Native code, or a Program.
+        stack: The initial data stack, from bottom to top, where each value
+            is a sequence with one value for each lane, or a single value for
+            all of them.
+        steps: If specified, the number of instructions each lane may
+            execute.
+        size: The number of lanes, if not given by the stack values.
+        output: Output stream for lanes that run on a Machine.
+        input: Input stream for lanes that run on a Machine.
+
+    Returns:
+        A BatchResult.
+    """
+    if isinstance(code, program.Program):
+        code = code.threaded
+    code = superinstructions.unfused(code)
+
+    if size is None:
+        lengths = [len(values) for values in stack if numpy.ndim(values) > 0]
+        size = lengths[0] if lengths else 1
+    stack = [_array(values, size) for values in stack]
+    if any(len(a) != size for a in stack):
+        raise ValueError("Batch stack values must have %d lanes" % size)
+
+    batch = _Batch(code, steps, output, input)
+    with numpy.errstate(all="ignore"):
+        batch.run(_Group(numpy.arange(size), 0, stack, [], 0))
+    return BatchResult(size, batch.groups, batch.machines)
+
+
+def _push(batch, g, op):
+    value = cc.get_embedded_push_value(op)
+    if isinstance(value, bool) or (isinstance(value, six.integer_types) and
+            _MIN <= value <= _MAX) or isinstance(value, float):
+        g.push(_array(value, len(g)))
+    else:
+        batch.fallback(g)
+        return []
+
+def _nop(batch, g, op):
+    pass
+
+def _exit(batch, g, op):
+    batch.finish(g.goto(g.ip + 1))
+    return []
+
+def _dup(batch, g, op):
+    if len(g.stack) == 0:
+        # The virtual machine pushes None
+        batch.fallback(g)
+        return []
+    g.push(g.stack[-1])
+
+def _drop(batch, g, op):
+    if not batch.underflow(g, 1):
+        g.pop()
+
+def _swap(batch, g, op):
+    if not batch.underflow(g, 2):
+        g.stack[-2:] = g.stack[-1], g.stack[-2]
+
+def _over(batch, g, op):
+    if not batch.underflow(g, 2):
+        g.push(g.stack[-2])
+
+def _rot(batch, g, op):
+    if not batch.underflow(g, 3):
+        g.stack[-3:] = g.stack[-2], g.stack[-1], g.stack[-3]
+
+def _arithmetic(batch, g, op):
+    if batch.underflow(g, 2):
+        return []
+    a, b = _number(g.stack[-1]), _number(g.stack[-2])
+
+    if op is cr.add:
+        r = b + a
+        overflow = ((a ^ r) & (b ^ r)) < 0 if not _isfloat(a, b) else None
+    elif op is cr.sub:
+        r = b - a
+        overflow = ((b ^ a) & (b ^ r)) < 0 if not _isfloat(a, b) else None
+    else:
+        r = b * a
+        overflow = None
+        if not _isfloat(a, b):
+            overflow = (a != 0) & ((r // numpy.where(a == 0, 1, a) != b) |
+                    ((a == -1) & (b == _MIN)))
+
+    if overflow is not None and overflow.any():
+        batch.fallback(g, overflow)
+        r = r[~overflow]
+    del g.stack[-2:]
+    g.push(r)
+
+def _div(batch, g, op):
+    if batch.underflow(g, 2):
+        return []
+    a, b = _number(g.stack[-1]), _number(g.stack[-2])
+    if six.PY2 and op is cr.div and not _isfloat(a, b):
+        overflow = (a == -1) & (b == _MIN)
+        if overflow.any():
+            batch.fallback(g, overflow)
+    a, b = _number(g.pop()), _number(g.pop())
+    zero = a == 0
+    batch.fail(g, zero)
+    a, b = a[~zero], b[~zero]
+
+    if op is cr.mod:
+        g.push(numpy.remainder(b, a))
+    elif six.PY2 and not _isfloat(a, b):
+        g.push(numpy.floor_divide(b, a))
+    else:
+        g.push(numpy.true_divide(b, a))
+
+_comparisons = {
+    cr.equal: numpy.equal,
+    cr.not_equal: numpy.not_equal,
+    cr.less: numpy.less,
+    cr.less_equal: numpy.less_equal,
+    cr.greater: numpy.greater,
+    cr.greater_equal: numpy.greater_equal,
+}
+
+def _compare(batch, g, op):
+    if batch.underflow(g, 2):
+        return []
+    a = g.pop()
+    g.push(_comparisons[op](a, g.pop()))
+
+_bitwise = {
+    cr.bitwise_and: numpy.bitwise_and,
+    cr.bitwise_or: numpy.bitwise_or,
+    cr.bitwise_xor: numpy.bitwise_xor,
+}
+
+def _bitwise_binary(batch, g, op):
+    if batch.underflow(g, 2):
+        return []
+    a, b = g.pop(), g.pop()
+    if _isfloat(a, b):
+        batch.fail(g)
+        return []
+    if a.dtype != b.dtype:
+        a, b = _number(a), _number(b)
+    g.push(_bitwise[op](b, a))
+
+def _complement(batch, g, op):
+    if batch.underflow(g, 1):
+        return []
+    a = g.pop()
+    if _isfloat(a):
+        batch.fail(g)
+        return []
+    g.push(~_number(a))
+
+def _unary(batch, g, op):
+    """abs and negate, which check the value before popping it."""
+    if batch.underflow(g, 1):
+        return []
+    a = _number(g.stack[-1])
+    overflow = a == _MIN if not _isfloat(a) else None
+    if overflow is not None and overflow.any():
+        batch.fallback(g, overflow)
+        a = a[~overflow]
+    g.stack[-1] = numpy.abs(a) if op is cr.abs_ else -a
+
+def _boolean(batch, g, op):
+    count = 1 if op is cr.boolean_not else 2
+    if batch.underflow(g, count):
+        return []
+    values = g.stack[-count:]
+    del g.stack[-count:]
+    if any(a.dtype.kind != "b" for a in values):
+        batch.fail(g)
+        return []
+    if op is cr.boolean_not:
+        g.push(~values[0])
+    elif op is cr.boolean_and:
+        g.push(values[0] & values[1])
+    else:
+        g.push(values[0] | values[1])
+
+def _cast_int(batch, g, op):
+    if batch.underflow(g, 1):
+        return []
+    a = g.stack[-1]
+    if not _isfloat(a):
+        g.stack[-1] = _number(a)
+        return
+    batch.fail(g, ~numpy.isfinite(a))
+    a = g.stack[-1]
+    large = numpy.abs(a) >= 2.0**63
+    if large.any():
+        batch.fallback(g, large)
+        a = a[~large]
+    g.stack[-1] = numpy.trunc(a).astype(numpy.int64)
+
+def _cast_bool(batch, g, op):
+    if batch.underflow(g, 1):
+        return []
+    g.stack[-1] = g.stack[-1] != 0
+
+def _cast_float(batch, g, op):
+    # Only checks that the value can be cast
+    if batch.underflow(g, 1):
+        return []
+
+def _if(batch, g, op):
+    if batch.underflow(g, 3):
+        return []
+    false_clause, true_clause, test = g.pop(), g.pop(), g.pop()
+    if true_clause.dtype == false_clause.dtype:
+        g.push(numpy.where(test != 0, true_clause, false_clause))
+        return
+
+    # Keep the types of the values by splitting the group
+    mask = test != 0
+    g.push(false_clause)
+    true_group = g.take(mask)
+    true_group.stack[-1] = true_clause[mask]
+    return [true_group.goto(g.ip + 1), g.goto(g.ip + 1)]
+
+def _at(batch, g, op):
+    g.rstack.append(numpy.full(len(g), g.ip, dtype=numpy.int64))
+
+def _jmp(batch, g, op):
+    return batch.jump(g)
+
+def _call(batch, g, op):
+    g.rstack.append(numpy.full(len(g), g.ip + 1, dtype=numpy.int64))
+    return batch.jump(g)
+
+def _return(batch, g, op):
+    if len(g.rstack) == 0:
+        batch.fail(g)
+        return []
+    address = g.rstack[-1]
+    if address.dtype.kind == "f":
+        batch.fallback(g)
+        return []
+    address = _number(address)
+    batch.fallback(g, address < 0) # Python indexes from the end
+    address = g.rstack.pop()
+    return batch.split(g, _number(address))
+
+def _jz(batch, g, op):
+    if batch.underflow(g, 2):
+        return []
+    address, test = g.pop(), g.pop()
+    jump = test == 0
+    if not jump.any():
+        return
+    g.push(address)
+    groups = batch.jump(g.take(jump))
+    g.pop()
+    return groups + [g.goto(g.ip + 1)]
+
+def _do(batch, g, op):
+    if batch.underflow(g, 2):
+        return []
+    start, limit = g.pop(), g.pop()
+    g.rstack.extend([limit, start])
+
+def _loop(batch, g, op):
+    if batch.underflow(g, 1):
+        return []
+    if len(g.rstack) < 2:
+        # Popping the index, or comparing it to None, fails
+        batch.fallback(g)
+        return []
+    index = _number(g.rstack[-1])
+    overflow = index == _MAX if not _isfloat(index) else None
+    if overflow is not None and overflow.any():
+        batch.fallback(g, overflow)
+
+    address = g.pop()
+    index = _number(g.rstack.pop()) + 1
+    again = index < g.rstack[-1]
+    g.rstack.append(index)
+    g.push(address)
+    groups = batch.jump(g.take(again)) if again.any() else []
+    g.pop()
+    del g.rstack[-2:]
+    return groups + [g.goto(g.ip + 1)]
+
+def _index(batch, g, op):
+    if len(g.rstack) == 0:
+        # The virtual machine pushes None
+        batch.fallback(g)
+        return []
+    g.push(g.rstack[-1])
+
+_handlers = {
+    cr.nop: _nop,
+    cr.exit: _exit,
+    cr.dup: _dup,
+    cr.drop: _drop,
+    cr.swap: _swap,
+    cr.over: _over,
+    cr.rot: _rot,
+    cr.add: _arithmetic,
+    cr.sub: _arithmetic,
+    cr.mul: _arithmetic,
+    cr.div: _div,
+    cr.mod: _div,
+    cr.bitwise_and: _bitwise_binary,
+    cr.bitwise_or: _bitwise_binary,
+    cr.bitwise_xor: _bitwise_binary,
+    cr.bitwise_complement: _complement,
+    cr.abs_: _unary,
+    cr.negate: _unary,
+    cr.boolean_not: _boolean,
+    cr.boolean_and: _boolean,
+    cr.boolean_or: _boolean,
+    cr.cast_int: _cast_int,
+    cr.cast_bool: _cast_bool,
+    cr.cast_float: _cast_float,
+    cr.if_stmt: _if,
+    cr.at: _at,
+    cr.jmp: _jmp,
+    cr.call: _call,
+    cr.return_: _return,
+    cr.jz: _jz,
+    cr.do: _do,
+    cr.loop: _loop,
+    cr.index: _index,
+}
+_handlers.update((function, _compare) for function in _comparisons)
@@ -0,0 +1,144 @@
+"""
+Contains direct branches, jumps and calls to addresses known at compile time.
+
+The compiler emits jumps and calls as a push of the address followed by jmp or
+call, which type- and range-checks the address every time it runs. A direct
+branch replaces the push, and goes straight to an address that was checked once
+when the branch was made. Conditional jumps of the form "<a> <b> if jmp" become
+a single branch that pops the test and goes to a or b, and "<a> jz" and
+"<a> loop", which structured control flow compiles to, go to a or past the jz
+or loop.
+
+Like superinstructions, a direct branch only replaces the first instruction of
+the sequence and leaves the others in place, so that jumps into the middle of
+it still work and superinstructions.unfused() gives back the original code.
+A direct branch also counts as one step for each instruction it replaced.
+"""
+
+from crianza import instructions
+from crianza import superinstructions
+import collections
+
+# How many times each kind of branch has been made by direct()
+statistics = collections.Counter()
+
+
+def _tag(branch, name, ops):
+    """Tags a branch function as a superinstruction replacing ops."""
+    branch.tag = superinstructions.SUPERINSTRUCTION_TAG
+    branch.name = name
+    branch.original = ops[0]
+    branch.ops = tuple(ops)
+    return branch
+
+def jump(address, ops):
+    """Returns a direct branch for "<address> jmp"."""
+    def direct_jump(vm):
+        vm.instruction_pointer = address
+    return _tag(direct_jump, "<address> jmp", ops)
+
+def call(address, ops):
+    """Returns a direct branch for "<address> call"."""
+    def direct_call(vm):
+        # Return to the instruction after the call
+        vm.return_stack.push(vm.instruction_pointer + 1)
+        vm.instruction_pointer = address
+    return _tag(direct_call, "<address> call", ops)
+
+def jump_if_zero(address, ops):
+    """Returns a direct branch for "<address> jz"."""
+    truth = instructions.truth
+    def direct_jump_if_zero(vm):
+        if truth(vm.pop()):
+            vm.instruction_pointer += 1
+        else:
+            vm.instruction_pointer = address
+    return _tag(direct_jump_if_zero, "<address> jz", ops)
+
+def loop(address, ops):
+    """Returns a direct branch for "<address> loop"."""
+    def direct_loop(vm):
+        index = vm.return_stack.pop() + 1
+        if index < vm.return_stack.top:
+            vm.return_stack.push(index)
+            vm.instruction_pointer = address
+        else:
+            vm.return_stack.pop()
+            vm.instruction_pointer += 1
+    return _tag(direct_loop, "<address> loop", ops)
+
+def branch(true_address, false_address, ops):
+    """Returns a direct branch for "<true address> <false address> if jmp"."""
+    truth = instructions.truth
+    def direct_branch(vm):
+        if truth(vm.pop()):
+            vm.instruction_pointer = true_address
+        else:
+            vm.instruction_pointer = false_address
+    return _tag(direct_branch, "<address> <address> if jmp", ops)
+
+# Patterns are matched in order, so longer ones should come first. None marks
+# a push of a valid address.
+patterns = [
+    ((None, None, instructions.if_stmt, instructions.jmp), branch),
+    ((None, instructions.jmp), jump),
+    ((None, instructions.call), call),
+    ((None, instructions.jz), jump_if_zero),
+    ((None, instructions.loop), loop),
+]
+
+def match(code, index, pattern):
+    """Returns the addresses if the pattern matches unfused code at the given
+    index, otherwise None."""
+    from crianza import compiler
+
+    if index + len(pattern) > len(code):
+        return None
+
+    addresses = []
+    for op, want in zip(code[index:], pattern):
+        if want is None:
+            if not compiler.is_embedded_push(op):
+                return None
+            value = compiler.get_embedded_push_value(op)
+            if type(value) is not int or not 0 <= value < len(code):
+                return None
+            addresses.append(value)
+        elif op is not want:
+            return None
+    return addresses
+
+def direct(code, silent=True):
+    """Replaces jumps and calls to constant addresses in native code with
+    direct branches.
+
+    Addresses outside of the code are left for jmp to report at run time.
+
+    Args:
+        code: Native code, as returned by compiler.native_types(). It may
+            contain superinstructions.
+        silent: If False, print each branch made.
+
+    Returns:
+        A new list of the same length as the input.
+    """
+    ops = superinstructions.unfused(code)
+    out = list(code)
+    i = 0
+    while i < len(out):
+        if not superinstructions.is_superinstruction(out[i]):
+            for pattern, factory in patterns:
+                addresses = match(ops, i, pattern)
+                if addresses is not None:
+                    out[i] = factory(*(addresses + [ops[i:i+len(pattern)]]))
+                    statistics[out[i].name] += 1
+                    if not silent:
+                        print("Branches: Made direct %s at index %d" %
+                                (out[i].name, i))
+                    i += len(pattern)
+                    break
+            else:
+                i += 1
+        else:
+            i += 1
+    return out
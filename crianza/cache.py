@@ -0,0 +1,363 @@
+"""
+Contains caches of compiled programs.
+
+CompileCache is a bounded in-process cache of compiled code, used by execute()
+and eval(). DiskCache is a persistent cache of Programs.
+
+Programs in a DiskCache are stored in a versioned binary format, one file per program, named
+after a hash of the source code, the compiler flags, the crianza version and
+the instruction set. On a hit, the file is read through a memory map instead of
+parsing, optimizing and checking the source again.
+
+Example:
+
+    cache = crianza.cache.DiskCache()
+    program = cache.compile("2 3 + .")
+    crianza.Machine(program).run()
+"""
+
+from crianza import debug
+from crianza import errors
+from crianza import program
+import array
+import collections
+import hashlib
+import mmap
+import os
+import six
+import struct
+import sys
+import tempfile
+import threading
+
+MAGIC = b"CRZP"
+FORMAT_VERSION = 1
+
+# Magic, format version, word typecode, word size, number of words, constants
+# and symbols
+_header = struct.Struct("<4sHcBIII")
+_length = struct.Struct("<I")
+_float = struct.Struct("<d")
+
+
+def default_directory():
+    """Returns the default cache directory, $XDG_CACHE_HOME/crianza or
+    ~/.cache/crianza."""
+    base = os.environ.get("XDG_CACHE_HOME") or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "crianza")
+
+def _text(data):
+    return data.decode("utf-8") if six.PY3 else data
+
+def _binary(text):
+    return text.encode("utf-8") if isinstance(text, six.text_type) else text
+
+def _pack_bytes(data):
+    return _length.pack(len(data)) + data
+
+def dumps(prog):
+    """Serializes a Program to bytes.
+
+    Raises:
+        CompileError: If the program holds constants other than booleans,
+            numbers and strings.
+    """
+    words = array.array(prog.words.typecode, prog.words)
+    if sys.byteorder != "little":
+        words.byteswap()
+
+    out = [_header.pack(MAGIC, FORMAT_VERSION,
+                        _binary(words.typecode), words.itemsize,
+                        len(words), len(prog.constants), len(prog.symbols)),
+           words.tobytes() if hasattr(words, "tobytes") else words.tostring()]
+
+    for value in prog.constants:
+        if isinstance(value, bool):
+            out.append(b"b" + (b"\x01" if value else b"\x00"))
+        elif isinstance(value, six.integer_types):
+            out.append(b"i" + _pack_bytes(_binary(str(value))))
+        elif isinstance(value, float):
+            out.append(b"f" + _float.pack(value))
+        elif isinstance(value, six.string_types):
+            out.append(b"s" + _pack_bytes(_binary(value)))
+        else:
+            raise errors.CompileError("Cannot serialize constant: %r" % value)
+
+    for name, address in sorted(prog.symbols.items()):
+        out.append(_pack_bytes(_binary(name)) + _length.pack(address))
+
+    return b"".join(out)
+
+def loads(data):
+    """Deserializes a Program from bytes, or any object supporting the buffer
+    protocol (such as a memory map).
+
+    Raises:
+        ValueError: If the data is not a valid program for this version.
+    """
+    try:
+        (magic, version, typecode, itemsize, nwords, nconstants,
+                nsymbols) = _header.unpack_from(data, 0)
+        typecode = _text(typecode)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("Unknown program format")
+        if typecode not in "BHL" or \
+                array.array(typecode).itemsize != itemsize:
+            raise ValueError("Unsupported word size")
+
+        offset = _header.size
+        end = offset + nwords*itemsize
+        words = array.array(typecode)
+        chunk = data[offset:end]
+        if len(chunk) != end - offset:
+            raise ValueError("Truncated program")
+        if hasattr(words, "frombytes"):
+            words.frombytes(chunk)
+        else:
+            words.fromstring(chunk)
+        if sys.byteorder != "little":
+            words.byteswap()
+        offset = end
+
+        def read_bytes(offset):
+            length = _length.unpack_from(data, offset)[0]
+            start = offset + _length.size
+            if start + length > len(data):
+                raise ValueError("Truncated program")
+            return data[start:start+length], start + length
+
+        constants = []
+        for _ in six.moves.range(nconstants):
+            tag = data[offset:offset+1]
+            offset += 1
+            if tag == b"b":
+                constants.append(data[offset:offset+1] == b"\x01")
+                offset += 1
+            elif tag == b"i":
+                value, offset = read_bytes(offset)
+                constants.append(int(value))
+            elif tag == b"f":
+                constants.append(_float.unpack_from(data, offset)[0])
+                offset += _float.size
+            elif tag == b"s":
+                value, offset = read_bytes(offset)
+                constants.append(_text(value))
+            else:
+                raise ValueError("Unknown constant type")
+
+        symbols = {}
+        for _ in six.moves.range(nsymbols):
+            name, offset = read_bytes(offset)
+            symbols[_text(name)] = _length.unpack_from(data, offset)[0]
+            offset += _length.size
+    except struct.error as e:
+        raise ValueError("Truncated program: %s" % e)
+
+    if len(words) > 0 and max(words) >= len(program.OPCODES) + len(constants):
+        raise ValueError("Invalid word in program")
+
+    # Source positions are not stored, but the symbols give word names
+    return program.Program(words, constants, symbols,
+            debug.DebugInfo(symbols=symbols))
+
+
+class DiskCache(object):
+    """Stores compiled programs in a directory, keyed by source hash."""
+
+    def __init__(self, directory=None):
+        """
+        Args:
+            directory: Where to store programs. Defaults to
+                default_directory(). Created when needed.
+        """
+        self.directory = directory if directory is not None else \
+            default_directory()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, source, **flags):
+        """Returns the cache key for source code and compiler flags.
+
+        The optimize flag is keyed by its level, so that True and 1 give the
+        same key.
+        """
+        import crianza
+        if "optimize" in flags:
+            flags["optimize"] = int(flags["optimize"])
+        h = hashlib.sha256()
+        for part in [crianza.__version__, str(FORMAT_VERSION),
+                     " ".join(program.OPCODES),
+                     repr(sorted(flags.items())), source]:
+            h.update(_binary(part))
+            h.update(b"\x00")
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".crz")
+
+    def load(self, key):
+        """Returns the cached Program for a key, or None if there is no valid
+        entry."""
+        try:
+            with open(self.path(key), "rb") as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    return loads(data)
+                finally:
+                    data.close()
+        except (IOError, OSError, ValueError):
+            # Missing, empty or invalid files are all misses
+            return None
+
+    def store(self, key, prog):
+        """Writes a Program to the cache.
+
+        The file is written under a temporary name and renamed into place, so
+        that concurrent readers never see a partial file.
+        """
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+
+        data = dumps(prog)
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(data)
+            os.rename(temp, self.path(key))
+        except (IOError, OSError):
+            os.remove(temp)
+            if not os.path.exists(self.path(key)):
+                raise
+
+    def compile(self, source, optimize=True, silent=True, passes=None):
+        """Returns the compiled Program for the source, compiling and storing
+        it on a miss.
+
+        Args:
+            source: A string or stream containing source code.
+            optimize: Whether to optimize the code, or the optimization
+                level (see compiler.compile).
+            silent: If False, print optimization messages on a miss.
+            passes: An optional passes.PassManager to compile with, instead
+                of optimize. It only records statistics on a miss.
+        """
+        from crianza import compiler
+        from crianza import parser
+
+        if not isinstance(source, six.string_types):
+            source = source.read()
+
+        if passes is None:
+            key = self.key(source, optimize=optimize)
+        else:
+            key = self.key(source, passes=passes.passes)
+        prog = self.load(key)
+        if prog is not None:
+            self.hits += 1
+            return prog
+
+        self.misses += 1
+        prog = compiler.compile(parser.parse(source), silent=silent,
+                optimize=optimize, assemble=True, passes=passes,
+                debug=debug.DebugInfo())
+        try:
+            self.store(key, prog)
+        except (IOError, OSError, errors.CompileError):
+            # Not being able to cache a program is not an error
+            pass
+        return prog
+
+
+class CompileCache(object):
+    """A thread-safe LRU cache of compiled code, keyed by source code and
+    compiler flags."""
+
+    def __init__(self, maxsize=256):
+        """
+        Args:
+            maxsize: The maximum number of entries. Set to 0 to disable the
+                cache.
+        """
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, value):
+        """Sets the maximum number of entries, evicting the least recently
+        used ones if needed."""
+        with self._lock:
+            self._maxsize = value
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > max(0, self._maxsize):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        """Removes all entries and resets the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def compile(self, source, optimize=True, silent=True):
+        """Returns compiled code for the source, compiling it on a miss.
+
+        Each call returns a new list, so callers may change the code they get
+        without affecting the cache. Streams are compiled without caching.
+
+        Args:
+            source: A string or stream containing source code.
+            optimize: Whether to optimize the code, or the optimization
+                level (see compiler.compile).
+            silent: If False, print optimization messages on a miss.
+        """
+        from crianza import compiler
+        from crianza import parser
+
+        if not isinstance(source, six.string_types) or self._maxsize <= 0:
+            return compiler.compile(parser.parse(source), silent=silent,
+                    optimize=optimize)
+
+        key = (source, int(optimize))
+        with self._lock:
+            code = self._entries.get(key)
+            if code is not None:
+                # Mark entry as most recently used
+                del self._entries[key]
+                self._entries[key] = code
+                self.hits += 1
+                return list(code)
+            self.misses += 1
+
+        # Compile outside of the lock, so that a slow compilation does not
+        # block other threads. Two threads may then compile the same source,
+        # but they will get the same result.
+        code = compiler.compile(parser.parse(source), silent=silent,
+                optimize=optimize)
+
+        with self._lock:
+            self._entries[key] = code
+            self._evict()
+        return list(code)
+
+# The cache used by execute() and eval()
+compile_cache = CompileCache()
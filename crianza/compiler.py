@@ -1,7 +1,11 @@
 from crianza.errors import CompileError
 from crianza.interpreter import Machine, isconstant, isstring, isbool, isnumber
+from crianza.passes import PassManager
+from crianza import branches
 from crianza import instructions
 from crianza import optimizer
+from crianza import program
+from crianza import superinstructions
 
 EMBEDDED_PUSH_TAG = "embedded_push"
 
@@ -35,8 +39,10 @@ def check(code):
         except Exception:
             return op
 
-    for i, a in enumerate(code):
-        b = code[i+1] if i+1 < len(code) else None
+    ops = superinstructions.unfused(code)
+
+    for i, a in enumerate(ops):
+        b = ops[i+1] if i+1 < len(ops) else None
 
         # Does instruction exist?
         if not isconstant(a):
@@ -65,7 +71,163 @@ def check(code):
                     (i, a, b))
     return code
 
-def compile(code, silent=True, ignore_errors=False, optimize=True):
+# Words that make up structured control flow
+CONTROL_WORDS = ("begin", "do", "else", "if", "loop", "repeat", "then",
+                 "until", "while")
+
+# Instructions that came after programs were free to define words with their
+# names, so words may shadow them
+SHADOWABLE = ("do", "i", "jz", "loop")
+
+def structured_ifs(code, words=()):
+    """Returns the indices of the if words in code that have a matching then,
+    and are therefore structured ifs rather than if instructions."""
+    ifs = []
+    structured = set()
+    for index, op in enumerate(code):
+        if op in words or not isinstance(op, str):
+            continue
+        if op == "if":
+            ifs.append(index)
+        elif op == "then" and len(ifs) > 0:
+            structured.add(ifs.pop())
+    return structured
+
+def control_flow(code, positions, words=(), optimize=None):
+    """Compiles structured control flow words to conditional and direct jumps.
+
+    The words are:
+
+        <test> if <code> [else <code>] then
+        begin <code> <test> until
+        begin <code> <test> while <code> repeat
+        <limit> <start> do <code> loop
+
+    A test is false if it is false, 0 or "", like for the if instruction. An
+    if without a matching then is the if instruction. do ... loop runs the
+    code at least once, for each index from start up to limit, which i
+    pushes. Words in words are subroutine calls, even if they have the same
+    name as a control flow word.
+
+    Args:
+        code: Code in non-native types, with subroutine calls expanded.
+        positions: A list of source positions for each instruction.
+        words: Names of subroutines.
+        optimize: An optional function that optimizes a list of code in
+            place, given a list of source positions. It is called for the
+            code between jumps and jump targets.
+
+    Returns:
+        A tuple of the new code, its positions and the indices of the jump
+        addresses in it, which are relative to the start of the code.
+
+    Raises:
+        CompileError: If control flow words do not match up.
+    """
+    ifs = structured_ifs(code, words)
+
+    out = []
+    out_positions = []
+    segment = []
+    segment_positions = []
+    labels = []
+    patches = []
+    frames = []
+
+    def flush():
+        if optimize is not None:
+            optimize(segment, segment_positions)
+        out.extend(segment)
+        out_positions.extend(segment_positions)
+        del segment[:]
+        del segment_positions[:]
+
+    def label():
+        labels.append(None)
+        return len(labels) - 1
+
+    def define(label):
+        flush()
+        labels[label] = len(out)
+
+    def jump(label, op, position):
+        flush()
+        patches.append((len(out), label))
+        out.extend([label, instructions.lookup(op)])
+        out_positions.extend([position, position])
+
+    def frame(word, position, *kinds):
+        if len(frames) == 0 or frames[-1][0] not in kinds:
+            raise CompileError("%s%s without %s" % (where(position), word,
+                " or ".join(kinds)))
+        return frames.pop()
+
+    for index, (op, position) in enumerate(zip(code, positions)):
+        if (op in words or not isinstance(op, str) or
+                op not in CONTROL_WORDS or (op == "if" and index not in ifs)):
+            segment.append(op)
+            segment_positions.append(position)
+        elif op == "if":
+            otherwise = label()
+            jump(otherwise, instructions.jz, position)
+            frames.append(("if", position, otherwise))
+        elif op == "else":
+            _, start, otherwise = frame(op, position, "if")
+            end = label()
+            jump(end, instructions.jmp, position)
+            define(otherwise)
+            frames.append(("else", start, end))
+        elif op == "then":
+            _, _, end = frame(op, position, "if", "else")
+            define(end)
+        elif op == "begin":
+            start = label()
+            define(start)
+            frames.append(("begin", position, start))
+        elif op == "until":
+            _, _, start = frame(op, position, "begin")
+            jump(start, instructions.jz, position)
+        elif op == "while":
+            _, first, start = frame(op, position, "begin")
+            end = label()
+            jump(end, instructions.jz, position)
+            frames.append(("while", first, (start, end)))
+        elif op == "repeat":
+            _, _, (start, end) = frame(op, position, "while")
+            jump(start, instructions.jmp, position)
+            define(end)
+        elif op == "do":
+            segment.append(op)
+            segment_positions.append(position)
+            start = label()
+            define(start)
+            frames.append(("do", position, start))
+        elif op == "loop":
+            _, _, start = frame(op, position, "do")
+            jump(start, instructions.loop, position)
+
+    if len(frames) > 0:
+        kind, position, _ = frames[-1]
+        raise CompileError("%sUnterminated %s" % (where(position), kind))
+
+    flush()
+
+    # Jumps cannot go past the end of the code
+    if len(out) in labels:
+        out.append(instructions.lookup(instructions.nop))
+        out_positions.append(None)
+
+    for address, label in patches:
+        out[address] = labels[label]
+    return out, out_positions, [address for address, _ in patches]
+
+def where(position):
+    """Returns a source position as a prefix for error messages."""
+    return "%d:%d: " % position if position is not None else ""
+
+def compile(code, silent=True, ignore_errors=False, optimize=True,
+        fuse=False, assemble=False, positions=None, debug=None,
+        inline_size=optimizer.INLINE_SIZE, passes=None):
     """Compiles subroutine-forms into a complete working code.
 
     A program such as:
@@ -94,7 +256,38 @@ def compile(code, silent=True, ignore_errors=False, optimize=True):
             it will not raise any exceptions. The actual compilatio will still
             raise errors.
 
-        optimize: Flag to control whether to optimize code.
+        optimize: Flag to control whether to optimize code, or an
+            optimization level. Level 0 (or False) does no optimizations,
+            level 1 (or True) constant-folds the code and level 2 also
+            inlines small words first, so that folding can cross word
+            boundaries, and turns tail calls and @ loops into jumps. Code
+            that uses jmp or call itself is not inlined and its loops are
+            left alone, since it may depend on where instructions end up. Level
+            3 also fuses superinstructions (see fuse) and replaces jumps and
+            calls to constant addresses with direct branches.
+
+        fuse: If True, fuse common instruction sequences into
+            superinstructions after compilation. This leaves the code length,
+            addresses and the number of steps it runs for unchanged.
+
+        assemble: If True, return a Program instead of a list of native code.
+            Programs hold their instructions in an opcode array with a
+            constant pool and a table of subroutine addresses. They cannot
+            store superinstructions, so fuse has no effect.
+
+        positions: An optional list with the source (line, column) of each
+            instruction in code, as returned by parse(source, positions=True).
+
+        debug: An optional, empty DebugInfo to fill in with the word, source
+            line and column of each address in the compiled code. Programs
+            keep it in their debug attribute.
+
+        inline_size: The maximum number of instructions in words that are
+            inlined at optimization level 2.
+
+        passes: An optional passes.PassManager that chooses the optimization
+            passes to run instead of optimize, and records statistics for
+            each of them.
 
     Raises:
         CompilationError - Raised if invalid code is detected.
@@ -111,78 +304,136 @@ def compile(code, silent=True, ignore_errors=False, optimize=True):
     """
     assert(isinstance(code, list))
 
+    if passes is None:
+        passes = PassManager(level=int(optimize))
+
+    if positions is None:
+        positions = [None]*len(code)
+    assert(len(positions) == len(code))
+
     output = []
+    output_positions = []
     subroutine = {}
+    subroutine_positions = {}
     builtins = Machine([]).instructions
 
     # Gather up subroutines
     try:
-        it = code.__iter__()
+        it = zip(code, positions).__iter__()
         while True:
-            word = next(it)
+            word, position = next(it)
             if word == ":":
-                name = next(it)
-                if name in builtins:
-                    raise CompileError("Cannot shadow internal word definition '%s'." % name)
+                name, position = next(it)
+                if name in builtins and name not in SHADOWABLE:
+                    raise CompileError("%sCannot shadow internal word definition '%s'." %
+                            (where(position), name))
                 if name in [":", ";"]:
-                    raise CompileError("Invalid word name '%s'." % name)
+                    raise CompileError("%sInvalid word name '%s'." %
+                            (where(position), name))
                 subroutine[name] = []
+                subroutine_positions[name] = []
                 while True:
-                    op = next(it)
+                    op, position = next(it)
                     if op == ";":
                         subroutine[name].append(instructions.lookup(instructions.return_))
+                        subroutine_positions[name].append(position)
                         break
                     else:
                         subroutine[name].append(op)
+                        subroutine_positions[name].append(position)
             else:
                 output.append(word)
+                output_positions.append(position)
     except StopIteration:
         pass
 
-    # Expand all subroutine words to ["<name>", "call"]
-    for name, code in subroutine.items():
-        # For subroutines
+    # Code that jumps or calls by itself may depend on the exact layout of the
+    # compiled code, so don't move instructions around in it
+    jumps = [instructions.lookup(instructions.call),
+             instructions.lookup(instructions.jmp),
+             instructions.lookup(instructions.jz),
+             instructions.lookup(instructions.loop)]
+    fixed = any(op in jumps and op not in subroutine for op in code
+                if isinstance(op, str))
+
+    if passes.enabled("inline") and not fixed:
+        passes.run("inline", optimizer.inline, output, subroutine,
+                size=inline_size, positions=output_positions,
+                word_positions=subroutine_positions, silent=silent)
+
+    def expand(code, positions):
+        """Expands subroutine words to ["<name>", "call"]."""
         xcode = []
-        for op in code:
+        xpositions = []
+        for op, position in zip(code, positions):
             xcode.append(op)
+            xpositions.append(position)
             if op in subroutine:
                 xcode.append(instructions.lookup(instructions.call))
-        subroutine[name] = xcode
+                xpositions.append(position)
+        return xcode, xpositions
+
+    for name in subroutine:
+        subroutine[name], subroutine_positions[name] = expand(subroutine[name],
+                subroutine_positions[name])
 
     # Compile main code (code outside of subroutines)
-    xcode = []
-    for op in output:
-        xcode.append(op)
-        if op in subroutine:
-            xcode.append(instructions.lookup(instructions.call))
+    output, positions = expand(output, output_positions)
 
     # Because main code comes before subroutines, we need to explicitly add an
     # exit instruction
-    output = xcode
     if len(subroutine) > 0:
         output += [instructions.lookup(instructions.exit)]
+        positions += [None]
+
+    def _optimize(code, positions):
+        code[:] = optimizer.optimized(code, silent=silent,
+                ignore_errors=False, positions=positions, passes=passes)
+
+    optimize_code = _optimize if any(passes.enabled(name) for name in
+            ["constant_fold", "simplify", "shuffle"]) else None
 
-    # Optimize main code
-    if optimize:
-        output = optimizer.optimized(output, silent=silent, ignore_errors=False)
+    # Compile control flow and optimize main code
+    output, positions, _ = control_flow(output, positions,
+            words=subroutine, optimize=optimize_code)
 
     # Add subroutines to output, track their locations
     location = {}
     for name, code in subroutine.items():
         location[name] = len(output)
-        if optimize:
-            output += optimizer.optimized(code, silent=silent, ignore_errors=False)
-        else:
-            output += code
+        code, code_positions, code_addresses = control_flow(code,
+                subroutine_positions[name], words=subroutine,
+                optimize=optimize_code)
+        for a in code_addresses:
+            code[a] += location[name]
+        output += code
+        positions += code_positions
 
     # Resolve all subroutine references
     for i, op in enumerate(output):
         if op in location:
             output[i] = location[op]
 
+    if passes.enabled("tail_calls"):
+        passes.run("tail_calls", optimizer.eliminate_tail_calls, output,
+                positions=positions, silent=silent, loops=not fixed)
+
     output = native_types(output)
     if not ignore_errors:
         check(output)
+
+    if debug is not None:
+        debug.add_symbols(location)
+        debug.extend(positions)
+
+    if assemble:
+        return program.assemble(output, symbols=location, debug=debug)
+    if fuse or passes.enabled("superinstructions"):
+        output = passes.run("superinstructions", superinstructions.fuse,
+                output, silent=silent)
+    if passes.enabled("branches"):
+        output = passes.run("branches", branches.direct, output,
+                silent=silent)
     return output
 
 def to_bool(instr):
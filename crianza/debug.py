@@ -0,0 +1,87 @@
+"""
+Contains debug information for compiled code.
+
+A DebugInfo maps code addresses to the source line and column each instruction
+came from, and to the word (subroutine) containing it. It is filled in by
+crianza.compile() and kept up to date through optimizer rewrites:
+
+    code, positions = crianza.parse(source, positions=True)
+    debug = crianza.DebugInfo()
+    code = crianza.compile(code, positions=positions, debug=debug)
+    machine = crianza.Machine(code, debug=debug)
+"""
+
+import array
+import bisect
+
+
+class DebugInfo(object):
+    """A side table mapping code addresses to (word, line, column).
+
+    Lines and columns are stored in arrays, with zero meaning unknown (e.g.,
+    for instructions added by the compiler). Word names are found by looking
+    up the address in the symbol table.
+    """
+
+    def __init__(self, positions=(), symbols=None):
+        """
+        Args:
+            positions: A (line, column) tuple or None for each address.
+            symbols: A dict mapping subroutine names to addresses. Use
+                add_symbols() to add more later.
+        """
+        self.lines = array.array("L")
+        self.columns = array.array("L")
+        self.symbols = {}
+        self.add_symbols(symbols or {})
+        self.extend(positions)
+
+    def add_symbols(self, symbols):
+        """Adds subroutine names and addresses to the symbol table, which is
+        kept sorted by address for word()."""
+        self.symbols.update(symbols)
+        table = sorted((a, n) for n, a in self.symbols.items())
+        self._addresses = [a for a, _ in table]
+        self._names = [n for _, n in table]
+
+    def extend(self, positions):
+        """Appends a (line, column) tuple or None for each address."""
+        for position in positions:
+            line, column = position if position is not None else (0, 0)
+            self.lines.append(line)
+            self.columns.append(column)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, address):
+        """Returns (word, line, column) for an address. The word is None for
+        the main code, and line and column are None if unknown."""
+        return (self.word(address),) + (self.position(address) or (None, None))
+
+    def position(self, address):
+        """Returns the (line, column) of an address, or None if unknown."""
+        if 0 <= address < len(self.lines) and self.lines[address] > 0:
+            return (self.lines[address], self.columns[address])
+        return None
+
+    def word(self, address):
+        """Returns the name of the word containing the address, or None if the
+        address is in the main code."""
+        index = bisect.bisect_right(self._addresses, address) - 1
+        return self._names[index] if index >= 0 else None
+
+    def describe(self, address):
+        """Returns a readable description of an address, such as "line 3,
+        column 5 in square"."""
+        word, line, column = self[address]
+        parts = []
+        if line is not None:
+            parts.append("line %d, column %d" % (line, column))
+        if word is not None:
+            parts.append("in %s" % word)
+        return " ".join(parts)
+
+    def __repr__(self):
+        return "<DebugInfo: %d addresses %d symbols>" % (len(self),
+                len(self.symbols))
@@ -6,8 +6,13 @@ TIP: Run with pypy for speed.
 See examples in examples-genetic/
 """
 
+import array
+import bisect
+import collections
 import crianza
+import multiprocessing
 import random
+import six
 import sys
 
 def _log(s, stream=sys.stdout):
@@ -21,14 +26,15 @@ def tanimoto_coefficient(a, b):
         1.0 if the two points completely overlap,
         0.0 if the two points are infinitely far apart.
     """
-    return sum(map(lambda (x,y): float(x)*float(y), zip(a,b))) / sum([
-          -sum(map(lambda (x,y): float(x)*float(y), zip(a,b))),
+    return sum(map(lambda xy: float(xy[0])*float(xy[1]), zip(a,b))) / sum([
+          -sum(map(lambda xy: float(xy[0])*float(xy[1]), zip(a,b))),
            sum(map(lambda x: float(x)**2, a)),
            sum(map(lambda x: float(x)**2, b))])
 
 def weighted_tanimoto(a, b, weights):
     """Same as the Tanimoto coefficient, but wit weights for each dimension."""
-    weighted = lambda s: map(lambda (x,y): float(x)*float(y), zip(s, weights))
+    weighted = lambda s: list(map(lambda xy: float(xy[0])*float(xy[1]),
+        zip(s, weights)))
     return tanimoto_coefficient(weighted(a), weighted(b))
 
 def average(sequence, key):
@@ -52,17 +58,65 @@ def stochastic_choice(machines):
     if len(machines) < 4:
         return random.choice(machines)
 
+    # Pick indices instead of slicing, which would copy the list
     r = random.random()
     if r < 0.5:
-        return random.choice(machines[:len(machines)/4])
+        return machines[random.randrange(len(machines)//4)]
     elif r < 0.75:
-        return random.choice(machines[:len(machines)/2])
+        return machines[random.randrange(len(machines)//2)]
     else:
         return random.choice(machines)
 
-    #This is better, but waaaay too slow:
-    # w = [(1.0 - m.score()) for m in machines]
-    # return weighted_choice(zip(machines, w))
+def _cumulative_choice(machines, weights):
+    """Returns a function that picks a machine with a probability
+    proportional to its weight, by bisecting the cumulative weights."""
+    cumulative = []
+    total = 0.0
+    last = 0
+    for index, weight in enumerate(weights):
+        total += weight
+        cumulative.append(total)
+        if weight > 0:
+            last = index
+
+    if total <= 0:
+        return lambda: random.choice(machines)
+
+    def choose():
+        # The product can round up to total, past the last cumulative weight
+        index = bisect.bisect_right(cumulative, random.random() * total)
+        return machines[min(index, last)]
+    return choose
+
+def stochastic_selection(machines):
+    """Selects with stochastic_choice()."""
+    return lambda: stochastic_choice(machines)
+
+def tournament_selection(machines, size=2):
+    """Selects the best of size machines picked at random."""
+    n = len(machines)
+    others = six.moves.range(size - 1)
+
+    def choose():
+        # The machines are sorted, so the best has the lowest index
+        best = random.randrange(n)
+        for _ in others:
+            best = min(best, random.randrange(n))
+        return machines[best]
+    return choose
+
+def rank_selection(machines):
+    """Selects machines with a probability proportional to their rank, so
+    that the best of n machines is picked n times as often as the worst."""
+    n = len(machines)
+    return _cumulative_choice(machines, six.moves.range(n, 0, -1))
+
+def proportional_selection(machines):
+    """Selects machines with a probability proportional to 1.0 - fitness,
+    for scores from 0.0 (best) to 1.0 (worst). The machines are picked
+    uniformly if none of them score better than 1.0."""
+    return _cumulative_choice(machines,
+            [max(0.0, 1.0 - m.fitness) for m in machines])
 
 def randomize(vm,
         length=(10,10),
@@ -71,7 +125,7 @@ def randomize(vm,
         chars=(32,126),
         instruction_ratio=0.5,
         number_string_ratio=0.8,
-        exclude=map(crianza.instructions.lookup, [".", "exit", "read", "write", "str"]),
+        exclude=list(map(crianza.instructions.lookup, [".", "exit", "read", "write", "str"])),
         restrict_to=None):
 
     """Replaces existing code with completely random instructions. Does not
@@ -101,43 +155,363 @@ def randomize(vm,
         restrict_to: Limit instructions to the given list.
 
     Returns:
-        The VM.
+        The VM. A GeneticMachine gets a Genome in its constant pool, and other
+        machines get native code.
     """
-    vm.code = []
     instructions = set(vm.instructions.values()) - set(exclude)
 
     if restrict_to is not None:
         instructions = instructions.intersection(set(restrict_to))
 
-    instructions = list(instructions)
+    # Sort by name, since the order of a set changes between runs
+    instructions = sorted(instructions, key=vm.lookup)
+
+    settings = {
+        "opcodes": [crianza.instructions.instruction(vm.lookup(op)).opcode
+                    for op in instructions],
+        "ints": ints,
+        "strs": strs,
+        "chars": chars,
+        "instruction_ratio": instruction_ratio,
+        "number_string_ratio": number_string_ratio,
+    }
+
+    pool = getattr(vm, "pool", None)
+    if pool is None:
+        pool = ConstantPool()
+    genome = Genome(random_words(random.randint(*length), pool, **settings),
+            pool)
+
+    if isinstance(vm, GeneticMachine):
+        vm.code = genome
+        vm._settings = settings
+    else:
+        vm.code = genome.to_code()
+    return vm
 
-    for _ in xrange(random.randint(*length)):
+def random_words(count, pool, opcodes, ints, strs, chars, instruction_ratio,
+        number_string_ratio):
+    """Returns an array of count random words for a Genome, as described in
+    randomize(). New constants are added to the pool."""
+    words = []
+    for _ in six.moves.range(count):
         r = random.random()
         if r <= instruction_ratio:
             # Generate a random instruction
-            vm.code.append(random.choice(instructions))
+            words.append(random.choice(opcodes))
         elif r <= number_string_ratio:
             # Generate a random number
-            vm.code.append(crianza.compiler.make_embedded_push(random.randint(*ints)))
+            words.append(pool.add(random.randint(*ints)))
         else:
             # Generate a random string
-            vm.code.append(crianza.compiler.make_embedded_push('%s' %
-                "".join(chr(random.randint(*chars)) for n in xrange(0,
+            words.append(pool.add('%s' %
+                "".join(chr(random.randint(*chars)) for n in six.moves.range(0,
                     random.randint(*strs)))))
-    return vm
+    return array.array(pool.typecode, words)
 
 def crossover(m, f):
     """Produces an offspring from two Machines, whose code is a
-    combination of the two."""
-    i = random.randint(0, len(m.code))
-    j = random.randint(0, len(f.code))
-    return m.code[:i] + f.code[j:]
+    combination of the two, as a Genome."""
+    i = random.randint(0, len(m.genome))
+    j = random.randint(0, len(f.genome))
+    return m.genome[:i] + f.genome[j:]
+
+
+class ConstantPool(object):
+    """The constants of a population's genomes. Each constant is stored once,
+    with one embedded push that all the code built from the genomes uses.
+
+    Words below len(program.OPCODES) are instructions, and the rest push
+    constants from the pool, like in a Program.
+    """
+
+    def __init__(self, constants=()):
+        self.constants = []
+        self.table = [entry.function for entry in crianza.instructions.registry]
+        self._index = {}
+        for value in constants:
+            self.add(value)
+
+    def add(self, value):
+        """Returns the word that pushes value, adding it to the pool if it is
+        new."""
+        # Tell apart constants that compare equal, like 1, 1.0 and true
+        key = (type(value), repr(value))
+        word = self._index.get(key)
+        if word is None:
+            word = self._index[key] = len(self.table)
+            self.constants.append(value)
+            self.table.append(crianza.compiler.make_embedded_push(value))
+        return word
+
+    @property
+    def typecode(self):
+        """The array typecode that can hold every word of the pool. It only
+        grows as constants are added."""
+        return crianza.program.typecode(len(self.table))
+
+    def __len__(self):
+        return len(self.constants)
+
+    def __getstate__(self):
+        return {"constants": self.constants}
+
+    def __setstate__(self, state):
+        self.__init__(state["constants"])
+
+    def __repr__(self):
+        return "<ConstantPool: %d constants>" % len(self.constants)
+
+
+# The pool of machines that are not given one
+_pool = ConstantPool()
+
+
+class Genome(object):
+    """Code stored as an array of words that refer to instructions and the
+    constants in a ConstantPool. Slicing and adding genomes copies the
+    arrays, and to_code() builds the native code."""
+
+    __slots__ = ("words", "pool")
+
+    def __init__(self, words, pool):
+        self.words = words
+        self.pool = pool
+
+    @classmethod
+    def from_code(cls, code, pool):
+        """Returns a genome for native code, adding its constants to pool.
+
+        Raises:
+            CompileError: If the code contains unknown instructions.
+        """
+        words = []
+        for op in crianza.superinstructions.unfused(code):
+            if crianza.compiler.is_embedded_push(op):
+                words.append(pool.add(
+                    crianza.compiler.get_embedded_push_value(op)))
+            else:
+                try:
+                    words.append(crianza.instructions.instruction(
+                        crianza.instructions.lookup(op)).opcode)
+                except KeyError:
+                    raise crianza.CompileError(
+                            "Cannot make a genome of instruction: %s" % op)
+        return cls(array.array(pool.typecode, words), pool)
+
+    def to_code(self):
+        """Returns the genome as a new list of native code."""
+        table = self.pool.table
+        return [table[word] for word in self.words]
+
+    def key(self):
+        """Returns a hashable key that is equal for genomes with the same
+        code, whatever their typecode and pool. Constants are keyed by their
+        type and repr, like in ConstantPool.add()."""
+        constants = self.pool.constants
+        base = len(self.pool.table) - len(constants)
+        return tuple(word if word < base else
+                     (type(constants[word - base]),
+                      repr(constants[word - base]))
+                     for word in self.words)
+
+    def _fit(self):
+        """Widens the array if the pool has outgrown its typecode."""
+        if self.words.typecode != self.pool.typecode:
+            self.words = array.array(self.pool.typecode, self.words)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return Genome(self.words[index], self.pool)
+        return self.words[index]
+
+    def __setitem__(self, index, word):
+        self._fit()
+        self.words[index] = word
+
+    def __delitem__(self, index):
+        del self.words[index]
+
+    def insert(self, index, word):
+        self._fit()
+        self.words.insert(index, word)
+
+    def __add__(self, other):
+        if other.pool is not self.pool:
+            other = Genome.from_code(other.to_code(), self.pool)
+        a, b = self.words, other.words
+        if a.typecode != b.typecode:
+            a = array.array(self.pool.typecode, a)
+            b = array.array(self.pool.typecode, b)
+        return Genome(a + b, self.pool)
+
+    def __eq__(self, other):
+        if not isinstance(other, Genome):
+            return NotImplemented
+        return self.key() == other.key()
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return "<Genome: %d words (%s)>" % (len(self.words),
+                self.words.typecode)
+
+
+def encode(code):
+    """Returns native code as a genome that can be pickled and sent to another
+    process, with instructions as their names and constants as one-element
+    tuples."""
+    genome = []
+    for op in code:
+        if crianza.compiler.is_embedded_push(op):
+            genome.append((crianza.compiler.get_embedded_push_value(op),))
+        else:
+            genome.append(crianza.instructions.lookup(op))
+    return genome
+
+def decode(genome):
+    """Returns native code for a genome made by encode()."""
+    code = []
+    for gene in genome:
+        if isinstance(gene, tuple):
+            code.append(crianza.compiler.make_embedded_push(gene[0]))
+        else:
+            code.append(crianza.instructions.lookup(gene))
+    return code
+
+def run_once(m, seed, optimize=False):
+    """Runs a machine once with the random generator seeded by seed, so that
+    it gets the same inputs in any process, and returns it."""
+    random.seed(seed)
+    if optimize:
+        m.code = crianza.optimizer.optimized(m.code)
+    m.setUp()
+    m.run()
+    m.tearDown()
+    return m
+
+def evaluate(task):
+    """Runs and scores a machine, usually in a worker process.
+
+    Args:
+        task: A tuple of the machine class, its genome as returned by
+        encode(), a random seed and whether to optimize the code first.
+
+    Returns:
+        A tuple of the score, the number of values left on the data and
+        return stacks, and the genome of the optimized code, or None if the
+        code was not optimized.
+    """
+    MachineClass, genome, seed, optimize = task
+    m = run_once(MachineClass(decode(genome)), seed, optimize)
+    return _result(m, optimize)
+
+def _result(m, optimize):
+    return (m.score(), len(m.stack) + len(m.return_stack),
+            encode(m.code) if optimize else None)
+
+def _apply(m, result):
+    m.fitness, m._depth, genome = result
+    if genome is not None:
+        m.code = decode(genome)
+
+
+class FitnessCache(object):
+    """Remembers the results of machines in iterate(), keyed by their code, so
+    that known programs are not run again. Only use it if a program always
+    gets the same score, i.e. if setUp() does not pick random inputs.
+
+    The least recently used results are evicted when there are more than
+    size of them.
+    """
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._results = collections.OrderedDict()
+
+    def get(self, key):
+        """Returns the result for key, or None."""
+        result = self._results.pop(key, None)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._results[key] = result
+        return result
+
+    def put(self, key, result):
+        self._results.pop(key, None)
+        self._results[key] = result
+        while len(self._results) > self.size:
+            self._results.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        """Returns the ratio of lookups that were hits."""
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups > 0 else 0.0
+
+    def __len__(self):
+        return len(self._results)
+
+    def __repr__(self):
+        return "<FitnessCache: size=%d hits=%d misses=%d hit_rate=%.2f>" % (
+                len(self), self.hits, self.misses, self.hit_rate)
 
 
 class GeneticMachine(crianza.Machine):
+    """A machine whose code is stored as a Genome, shared with the rest of its
+    population through a ConstantPool. The code is built when it is first
+    used.
+
+    Assigning native code to code, like setUp() and tearDown() may do, leaves
+    the genome alone until it is asked for. Change code by assigning it, not
+    in place.
+    """
+
     def __init__(self, code):
+        self.pool = _pool
+        self._genome = None
+        self._code = None
+        self._genome_code = None # The code that was built from the genome
+        self._settings = None # The randomize() settings, for mutations
         super(GeneticMachine, self).__init__(code)
         self._error = False
+        self.fitness = None # The score from the last run in iterate()
+        self._depth = 0 # Values left on the stacks after that run
+
+    @property
+    def code(self):
+        if self._code is None:
+            self._code = self._genome_code = self._genome.to_code()
+        return self._code
+
+    @code.setter
+    def code(self, code):
+        if isinstance(code, Genome):
+            self.pool = code.pool
+            self._genome = code
+            self._code = self._genome_code = None
+        else:
+            self._code = code
+
+    @property
+    def genome(self):
+        """The code as a Genome."""
+        if self._code is not None and self._code is not self._genome_code:
+            self._genome = Genome.from_code(self._code, self.pool)
+            self._genome_code = self._code
+        return self._genome
 
     def setUp(self):
         """Called before each invocation of run()."""
@@ -159,28 +533,51 @@ class GeneticMachine(crianza.Machine):
         """Creates a new random code."""
         return randomize(self, **kw)
 
+    def key(self):
+        """Returns a hashable key that is equal for machines with the same
+        code, used by FitnessCache. Constants include their type, so that 1,
+        1.0 and true differ."""
+        return self.genome.key()
+
     def crossover(self, other):
         """Produce offspring from this and another instance."""
-        return self.new(crossover(self, other))
+        child = self.new(crossover(self, other))
+        child._settings = self._settings
+        return child
+
+    def random_words(self, count):
+        """Returns random words for mutations, made with the settings of
+        randomize()."""
+        if self._settings is None:
+            # Learn the settings that the subclass passes to randomize()
+            m = self.new([])
+            m.pool = self.pool
+            m.randomize()
+            if m._settings is None:
+                return m.genome.words[:count]
+            self._settings = m._settings
+        return random_words(count, self.pool, **self._settings)
 
     def mutate(self):
         """Mutates code."""
         # Choose a random position
-        if len(self.code) == 0:
+        genome = self.genome
+        if len(genome) == 0:
             return
 
-        index = random.randint(0, len(self.code)-1)
+        index = random.randint(0, len(genome)-1)
         mutation_type = random.random()
 
         if mutation_type < 0.5:
             # Change
-            self.code[index] = self.new().randomize().code[0]
+            genome[index] = self.random_words(1)[0]
         elif mutation_type < 0.75:
             # Deletion
-            del self.code[index]
+            del genome[index]
         else:
             # Insertion
-            self.code.insert(index, self.new().randomize().code[0])
+            genome.insert(index, self.random_words(1)[0])
+        self._code = self._genome_code = None
 
     def run(self, steps=10):
         """Executes up to `steps` instructions."""
@@ -206,8 +603,11 @@ class GeneticMachine(crianza.Machine):
         return iterations >= 10000
 
 
-def iterate(MachineClass, stop_function=lambda iterations: iterations < 10000,
-        machines=1000, survival_rate=0.05, mutation_rate=0.075, silent=False):
+def iterate(MachineClass,
+        stop_function=lambda iterations, generation: iterations >= 10000,
+        machines=1000, survival_rate=0.05, mutation_rate=0.075, silent=False,
+        optimize=False, workers=None, executor=None, cache=None,
+        selection=stochastic_selection):
     """Creates a bunch of machines, runs them for a number of steps and then
     gives them a fitness score.  The best produce offspring that are passed on
     to the next generation.
@@ -229,7 +629,8 @@ def iterate(MachineClass, stop_function=lambda iterations: iterations < 10000,
             fitness.
 
         stop_function: An optional function that takes the current generation
-        number and returns True if the processing should stop.
+        number and the surviving machines, and returns True if the processing
+        should stop.
 
         machines: The number of machines to create for each generation.
 
@@ -243,22 +644,82 @@ def iterate(MachineClass, stop_function=lambda iterations: iterations < 10000,
         offspring for the next generation.
 
         mutation_rate: Rate for each machine's chance of being mutated.
-    """
-    def make_random(n):
-        return MachineClass().randomize()
 
-    def run_once(m):
-        m.setUp()
-        m.run()
-        m.tearDown()
-        return m
+        optimize: Whether to constant-fold each machine's code before running
+        it, so that it costs fewer instructions. The folded code replaces the
+        original.
+
+        workers: The number of processes to run and score the machines in.
+        The machine class must then be picklable, i.e. defined at the top
+        level of a module.
+
+        executor: Instead of workers, an object with a map(function,
+        iterable) method that runs the machines, like a multiprocessing.Pool
+        or a concurrent.futures.ProcessPoolExecutor.
+
+        cache: A FitnessCache with the results of programs that have already
+        been run, for problems where a program always gets the same score.
+        Machines with the same code in a generation are always run only once
+        if it is given.
+
+        selection: A function that takes the survivors, sorted from best to
+        worst, and returns a function that picks a parent among them. See
+        stochastic_selection(), tournament_selection(), rank_selection() and
+        proportional_selection().
 
-    def make_offspring(survivors):
-        a = stochastic_choice(survivors)
-        b = stochastic_choice(survivors)
+    Each machine is run with the random generator seeded from the one of the
+    calling process, so a seed gives the same results for any number of
+    workers. A machine's score is stored in its fitness attribute.
+    """
+    pool = ConstantPool()
+
+    def make_random(n):
+        m = MachineClass()
+        m.pool = pool
+        return m.randomize()
+
+    def run_all(generation):
+        seeds = [random.getrandbits(32) for _ in generation]
+
+        # Group machines with the same code, unless they are known
+        groups = collections.OrderedDict()
+        for n, (m, seed) in enumerate(zip(generation, seeds)):
+            if cache is None:
+                groups[n] = [m], seed
+                continue
+            key = m.key()
+            if key in groups:
+                cache.hits += 1
+                groups[key][0].append(m)
+                continue
+            result = cache.get(key)
+            if result is None:
+                groups[key] = [m], seed
+            else:
+                _apply(m, result)
+
+        if executor is None:
+            state = random.getstate()
+            results = [_result(run_once(ms[0], seed, optimize), optimize)
+                       for ms, seed in groups.values()]
+            random.setstate(state)
+        else:
+            tasks = [(ms[0].__class__, encode(ms[0].code), seed, optimize)
+                     for ms, seed in groups.values()]
+            results = executor.map(evaluate, tasks)
+
+        for (key, (ms, _)), result in zip(groups.items(), results):
+            for m in ms:
+                _apply(m, result)
+            if cache is not None:
+                cache.put(key, result)
+
+    def make_offspring(choose):
+        a = choose()
+        b = choose()
         return a.crossover(b)
 
-    generation = map(make_random, xrange(machines))
+    generation = list(map(make_random, six.moves.range(machines)))
     survivors = generation
 
     if silent:
@@ -266,6 +727,10 @@ def iterate(MachineClass, stop_function=lambda iterations: iterations < 10000,
     else:
         log = _log
 
+    process_pool = None
+    if executor is None and workers is not None:
+        executor = process_pool = multiprocessing.Pool(workers)
+
     try:
         iterations = 0
         while not stop_function(iterations, survivors):
@@ -273,34 +738,35 @@ def iterate(MachineClass, stop_function=lambda iterations: iterations < 10000,
             log("running ... ")
 
             # Run all machines in this generation
-            generation = map(run_once, generation)
+            run_all(generation)
 
             # Sort machines from best to worst
-            generation = sorted(generation, key=lambda m: m.score())
+            generation = sorted(generation, key=lambda m: m.fitness)
 
             # Select the best
             survivors = generation[:int(survival_rate * len(generation))]
 
             # Remove code larger than 50
             for s in survivors:
-                if len(s.code) >= 50:
-                    s.code = s.code[:50]
+                if len(s.genome) >= 50:
+                    s.code = s.genome[:50]
 
             # Remove dead ones
-            survivors = [s for s in survivors if len(s.code)>0]
+            survivors = [s for s in survivors if len(s.genome)>0]
 
-            #survivors = [s for s in survivors if len(s.code)<=50]
+            #survivors = [s for s in survivors if len(s.genome)<=50]
             # All dead? start with a new set
             if len(survivors) == 0:
                 log("\nNo survivors, restarting")
-                survivors = map(make_random, xrange(machines))
+                survivors = list(map(make_random, six.moves.range(machines)))
                 generation = survivors
                 continue
 
             # Create a new generation based on the survivors.
             log("crossover ... ")
-            cross = lambda _: make_offspring(survivors)
-            generation = map(cross, xrange(machines))
+            choose = selection(survivors)
+            cross = lambda _: make_offspring(choose)
+            generation = list(map(cross, six.moves.range(machines)))
 
             # Add mutations from time to time
             for m in generation:
@@ -309,10 +775,14 @@ def iterate(MachineClass, stop_function=lambda iterations: iterations < 10000,
 
             log("\rgen %d 1-fitness %.12f avg code len %.2f avg stack len %.2f\n" %
                 (iterations,
-                 average(survivors, lambda m: m.score()),
-                 average(survivors, lambda m: len(m.code)),
-                 average(survivors, lambda m: len(m.stack) + len(m.return_stack))))
+                 average(survivors, lambda m: m.fitness),
+                 average(survivors, lambda m: len(m.genome)),
+                 average(survivors, lambda m: m._depth)))
     except KeyboardInterrupt:
         pass
+    finally:
+        if process_pool is not None:
+            process_pool.terminate()
+            process_pool.join()
 
     return survivors
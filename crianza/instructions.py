@@ -3,6 +3,7 @@ Contains a collection of useful instructions, or machine primivites.
 """
 
 from crianza import errors
+import six
 
 def _assert_number(*args):
     from crianza import interpreter
@@ -205,29 +206,32 @@ def true_(vm):
 def false_(vm):
     vm.push(False)
 
-def if_stmt(vm):
+def truth(test):
+    """Returns whether a value counts as true for if."""
     from crianza import interpreter
-    false_clause = vm.pop()
-    true_clause = vm.pop()
-    test = vm.pop()
 
     # False values: False, 0, "", everyting else is true
     if interpreter.isbool(test) and test == False:
-        result = False
+        return False
     elif interpreter.isstring(test) and len(test) == 0:
-        result = False
+        return False
     elif interpreter.isnumber(test) and test == 0:
-        result = False
+        return False
     else:
-        result = True
+        return True
+
+def if_stmt(vm):
+    false_clause = vm.pop()
+    true_clause = vm.pop()
+    test = vm.pop()
 
-    if result == True:
+    if truth(test):
         vm.push(true_clause)
     else:
         vm.push(false_clause)
 
 def jmp(vm):
-    if not (isinstance(vm.top, int) or isinstance(vm.top, long)):
+    if not isinstance(vm.top, six.integer_types):
         raise errors.MachineError("Jump address must be an integer: %s" %
                 str(vm.top))
     addr = vm.pop()
@@ -236,6 +240,39 @@ def jmp(vm):
     else:
         raise errors.MachineError("Jump address out of range: %s" % str(addr))
 
+def jz(vm):
+    """Jumps to the address on top of the stack if the value below it is
+    false, 0 or "" (see if)."""
+    addr = vm.pop()
+    if not truth(vm.pop()):
+        vm.push(addr)
+        jmp(vm)
+
+def do(vm):
+    """Starts a counted loop, moving the limit and start index to the return
+    stack."""
+    start = vm.pop()
+    limit = vm.pop()
+    _assert_number(limit, start)
+    vm.return_stack.push(limit)
+    vm.return_stack.push(start)
+
+def loop(vm):
+    """Increments the index of a counted loop and jumps to the address on top
+    of the stack, until the index reaches the limit."""
+    addr = vm.pop()
+    index = vm.return_stack.pop() + 1
+    if index < vm.return_stack.top:
+        vm.return_stack.push(index)
+        vm.push(addr)
+        jmp(vm)
+    else:
+        vm.return_stack.pop()
+
+def index(vm):
+    """Pushes the index of the innermost counted loop."""
+    vm.push(vm.return_stack.top)
+
 def dump_stack(vm):
     vm.output.write("Data stack:\n")
     for v in reversed(vm.data_stack._values):
@@ -295,6 +332,9 @@ def lookup(instruction, instructions = None):
     """Looks up instruction, which can either be a function or a string.
     If it's a string, returns the corresponding method.
     If it's a function, returns the corresponding name.
+
+    Lookups in the default instructions take constant time, through the
+    registry. Functions added to them later are searched for.
     """
     if instructions is None:
         instructions = default_instructions
@@ -302,6 +342,14 @@ def lookup(instruction, instructions = None):
     if isinstance(instruction, str):
         return instructions[instruction]
     elif hasattr(instruction, "__call__"):
+        if instructions is default_instructions:
+            entry = _by_function.get(instruction)
+            if entry is not None:
+                return entry.name
+            if hasattr(instruction, "tag"):
+                # An embedded push or superinstruction, which the compiler
+                # looks up often
+                raise KeyError(instruction)
         rev = dict(((v,k) for (k,v) in instructions.items()))
         return rev[instruction]
     else:
@@ -328,14 +376,18 @@ default_instructions = {
     "and":    boolean_and,
     "bool":   cast_bool,
     "call":   call,
+    "do":     do,
     "drop":   drop,
     "dup":    dup,
     "exit":   exit,
     "false":  false_,
     "float":  cast_float,
+    "i":      index,
     "if":     if_stmt,
     "int":    cast_int,
     "jmp":    jmp,
+    "jz":     jz,
+    "loop":   loop,
     "negate": negate,
     "nop":    nop,
     "not":    boolean_not,
@@ -354,3 +406,132 @@ default_instructions = {
     #"r>":     r_gt, # Parser doesn't like this
     #"r@":     r_at, # Parser doesn't like this
 }
+
+
+class Instruction(object):
+    """Static information about an instruction.
+
+    Attributes:
+        name: The name used in source code.
+        function: The function implementing it.
+        opcode: Its number in Program words.
+        pops: How many values it pops off the data stack.
+        pushes: How many values it pushes on the data stack.
+        pure: True if it only works on the data stack, so that it can be
+            evaluated at compile time on constant operands (it may still
+            raise an error).
+        branches: True if it can change the instruction pointer.
+        control: True if it reads or changes the instruction pointer or
+            return stack.
+        io: True if it reads input or writes output.
+    """
+
+    def __init__(self, name, function, opcode, pops, pushes, pure=False,
+            branches=False, control=False, io=False):
+        self.name = name
+        self.function = function
+        self.opcode = opcode
+        self.pops = pops
+        self.pushes = pushes
+        self.pure = pure
+        self.branches = branches
+        self.control = control
+        self.io = io
+
+    @property
+    def arity(self):
+        """The number of operands."""
+        return self.pops
+
+    @property
+    def effect(self):
+        """The change in data stack depth."""
+        return self.pushes - self.pops
+
+    def __repr__(self):
+        flags = [flag for flag in ["pure", "branches", "control", "io"]
+                 if getattr(self, flag)]
+        return "<Instruction %d %s ( %d -- %d )%s>" % (self.opcode, self.name,
+                self.pops, self.pushes, "".join(" " + f for f in flags))
+
+
+# Stack effects and properties of the default instructions
+_properties = {
+    "%":      (2, 1, "pure"),
+    "&":      (2, 1, "pure"),
+    "*":      (2, 1, "pure"),
+    "+":      (2, 1, "pure"),
+    "-":      (2, 1, "pure"),
+    ".":      (1, 0, "io"),
+    "/":      (2, 1, "pure"),
+    "<":      (2, 1, "pure"),
+    "<=":     (2, 1, "pure"),
+    "<>":     (2, 1, "pure"),
+    "=":      (2, 1, "pure"),
+    ">":      (2, 1, "pure"),
+    ">=":     (2, 1, "pure"),
+    "@":      (0, 0, "control"),
+    "^":      (2, 1, "pure"),
+    "abs":    (1, 1, "pure"),
+    "and":    (2, 1, "pure"),
+    "bool":   (1, 1, "pure"),
+    "call":   (1, 0, "branches control"),
+    "do":     (2, 0, "control"),
+    "drop":   (1, 0, "pure"),
+    "dup":    (1, 2, "pure"),
+    "exit":   (0, 0, "branches control"),
+    "false":  (0, 1, "pure"),
+    "float":  (1, 1, "pure"),
+    "i":      (0, 1, "control"),
+    "if":     (3, 1, "pure"),
+    "int":    (1, 1, "pure"),
+    "jmp":    (1, 0, "branches control"),
+    "jz":     (2, 0, "branches control"),
+    "loop":   (1, 0, "branches control"),
+    "negate": (1, 1, "pure"),
+    "nop":    (0, 0, "pure"),
+    "not":    (1, 1, "pure"),
+    "or":     (2, 1, "pure"),
+    "over":   (2, 3, "pure"),
+    "read":   (0, 1, "io"),
+    "return": (0, 0, "branches control"),
+    "rot":    (3, 3, "pure"),
+    "str":    (1, 1, "pure"),
+    "swap":   (2, 2, "pure"),
+    "true":   (0, 1, "pure"),
+    "write":  (1, 0, "io"),
+    "|":      (2, 1, "pure"),
+    "~":      (1, 1, "pure"),
+}
+
+def _make_registry():
+    registry = []
+    for opcode, name in enumerate(sorted(default_instructions)):
+        pops, pushes, flags = _properties[name]
+        flags = flags.split()
+        registry.append(Instruction(name, default_instructions[name], opcode,
+            pops, pushes, pure="pure" in flags, branches="branches" in flags,
+            control="control" in flags, io="io" in flags))
+    return registry
+
+# The default instructions, in opcode order
+registry = _make_registry()
+
+_by_name = dict((entry.name, entry) for entry in registry)
+_by_function = dict((entry.function, entry) for entry in registry)
+
+def instruction(key):
+    """Returns the registry entry for a default instruction, given its name,
+    function or opcode.
+
+    Raises:
+        KeyError: If there is no such instruction.
+    """
+    if isinstance(key, str):
+        return _by_name[key]
+    elif isinstance(key, int):
+        if 0 <= key < len(registry):
+            return registry[key]
+        raise KeyError(key)
+    else:
+        return _by_function[key]
@@ -1,13 +1,15 @@
 from crianza import errors
 from crianza import instructions
-from crianza import parser
+from crianza import program
 from crianza import stack
+from crianza import superinstructions
+import six
 import sys
 
 def code_to_string(code):
     from crianza import compiler
     s = []
-    for op in code:
+    for op in superinstructions.unfused(code):
         if isconstant(op):
             if isstring(op):
                 s.append(repr(op))
@@ -41,11 +43,12 @@ def isnumber(*args):
     """
     return all(map(lambda c: isinstance(c, int) or isinstance(c, float), args))
 
+_true_or_false = (instructions.lookup(instructions.true_),
+                  instructions.lookup(instructions.false_))
+
 def isbool(*args):
     """Checks if value is boolean."""
-    true_or_false = [instructions.lookup(instructions.true_),
-                     instructions.lookup(instructions.false_)]
-    return all(map(lambda c: isinstance(c, bool) or c in true_or_false, args))
+    return all(map(lambda c: isinstance(c, bool) or c in _true_or_false, args))
 
 def isbinary(*args):
     """Checks if value can be part of binary/bitwise operations."""
@@ -59,36 +62,47 @@ def isconstant(args, quoted=False):
     else:
         return check(args)
 
-def execute(source, optimize=True, output=sys.stdout, input=sys.stdin, steps=-1):
+def execute(source, optimize=True, output=sys.stdout, input=sys.stdin, steps=-1,
+        cache=None):
     """Compiles and runs program, returning the machine used to execute the
     code.
 
     Args:
-        optimize: Whether to optimize the code after parsing it.
+        optimize: Whether to optimize the code after parsing it, or the
+            optimization level (see compile).
         output: Stream which program can write output to.
         input: Stream which program can read input from.
         steps: An optional maximum number of instructions to execute on the
             virtual machine.  Set to -1 for no limit.
+        cache: Where to look up the compiled code, such as a
+            cache.DiskCache. Defaults to cache.compile_cache, an in-process
+            LRU cache.
 
     Returns:
         A Machine instance.
     """
-    from crianza import compiler
-    code = compiler.compile(parser.parse(source), optimize=optimize)
+    from crianza.cache import compile_cache
+    if cache is None:
+        cache = compile_cache
+    code = cache.compile(source, optimize=optimize)
     machine = Machine(code, output=output, input=input)
     return machine.run(steps)
 
-def eval(source, optimize=True, output=sys.stdout, input=sys.stdin, steps=-1):
+def eval(source, optimize=True, output=sys.stdout, input=sys.stdin, steps=-1,
+        cache=None):
     """Compiles and runs program, returning the values on the stack.
 
     To return the machine instead, see execute().
 
     Args:
-        optimize: Whether to optimize the code after parsing it.
+        optimize: Whether to optimize the code after parsing it, or the
+            optimization level (see compile).
         output: Stream which program can write output to.
         input: Stream which program can read input from.
         steps: An optional maximum number of instructions to execute on the
             virtual machine.  Set to -1 for no limit.
+        cache: Where to look up the compiled code. Defaults to
+            cache.compile_cache, an in-process LRU cache.
 
     Returns:
         None: If the stack is empty
@@ -96,7 +110,7 @@ def eval(source, optimize=True, output=sys.stdout, input=sys.stdin, steps=-1):
         [obj, obj, ...]: If the stack contains many values
     """
     machine = execute(source, optimize=optimize, output=output, input=input,
-            steps=steps)
+            steps=steps, cache=cache)
     ds = machine.stack
 
     if len(ds) == 0:
@@ -110,19 +124,23 @@ def eval(source, optimize=True, output=sys.stdout, input=sys.stdin, steps=-1):
 class Machine(object):
     """A virtual machine with code, a data stack and an instruction stack."""
 
-    def __init__(self, code, output=sys.stdout, input=sys.stdin):
+    def __init__(self, code, output=sys.stdout, input=sys.stdin, debug=None):
         """
         Args:
-            code: The code to run.
+            code: The code to run, either as native code or a Program.
             output: Output stream that the machine's code can write to.
             input: Input stream that the machine's code can read from.
-            optimize: If True, optimize the given code.
+            debug: An optional debug.DebugInfo for the code, used in error
+                messages. Defaults to the one of a Program, if any.
         """
         self.reset()
         self.code = code
         self.output = output
         self.input = input
         self.instructions = instructions.default_instructions
+        if debug is None and isinstance(code, program.Program):
+            debug = code.debug
+        self.debug = debug
 
     def lookup(self, instruction):
         """Looks up name-to-function or function-to-name."""
@@ -157,8 +175,18 @@ class Machine(object):
         try:
             return self.data_stack.pop()
         except errors.MachineError as e:
-            raise errors.MachineError("%s: At index %d in code: %s" %
-                    (e, self.instruction_pointer, self.code_string))
+            raise errors.MachineError("%s: At index %d%s in code: %s" %
+                    (e, self.instruction_pointer, self.source_location(),
+                        self.code_string))
+
+    def source_location(self):
+        """Returns a description of where in the source code the current
+        instruction came from, such as " (line 3, column 5 in square)", or an
+        empty string if unknown."""
+        if self.debug is None:
+            return ""
+        where = self.debug.describe(self.instruction_pointer - 1)
+        return " (%s)" % where if where else ""
 
     def push(self, value):
         """Pushes a value on the data stack."""
@@ -169,29 +197,86 @@ class Machine(object):
         """Returns the top of the data stack."""
         return self.data_stack.top
 
+    def _threaded_code(self):
+        """Returns the code as a list of instruction functions."""
+        if isinstance(self.code, program.Program):
+            return self.code.threaded
+        return self.code
+
     def step(self):
         """Executes one instruction and stops."""
         op = self.code[self.instruction_pointer]
         self.instruction_pointer += 1
         op(self)
 
-    def run(self, steps=None):
+    def run(self, steps=None, profiler=None):
         """Run threaded code in machine.
 
         Args:
             steps: If specified, run that many number of instructions before
             stopping.
+
+            profiler: An optional profiler.Profiler to collect instruction
+            counts and times with. It uses a separate, slower run loop.
         """
+        if profiler is not None:
+            return profiler.run(self, steps)
         try:
-            while self.instruction_pointer < len(self.code):
-                self.step()
-
-                if steps is not None:
-                    steps -= 1
-                    if steps == 0:
-                        break
+            if steps is None or steps <= 0:
+                self._run_unbounded()
+            else:
+                self._run_bounded(steps)
         except StopIteration:
             pass
         except EOFError:
             pass
         return self
+
+    def _run_unbounded(self):
+        """Runs until the instruction pointer falls off the end of the code.
+
+        This is the same as calling step() in a loop, but with the code and
+        instruction pointer kept in local variables. Instructions may read and
+        change the instruction pointer (call, return, jmp, @, error messages),
+        so it is written through before and read back after each instruction.
+        """
+        code = self._threaded_code()
+        length = len(code)
+        ip = self.instruction_pointer
+        while ip < length:
+            self.instruction_pointer = ip + 1
+            code[ip](self)
+            ip = self.instruction_pointer
+
+    def _run_bounded(self, steps):
+        """Like _run_unbounded, but stops after the given number of steps.
+
+        The step budget is consumed by iterating over a range instead of
+        decrementing a counter for each instruction. Superinstructions count
+        as one step for each instruction they replaced, so they need a slower
+        loop. If fewer steps are left than that, only the first instruction
+        is run, like in unfused code.
+        """
+        code = self._threaded_code()
+        length = len(code)
+        ip = self.instruction_pointer
+        if not any(superinstructions.is_superinstruction(op) for op in code):
+            for _ in six.moves.range(steps):
+                if ip >= length:
+                    break
+                self.instruction_pointer = ip + 1
+                code[ip](self)
+                ip = self.instruction_pointer
+            return
+
+        size = superinstructions.size
+        while steps > 0 and ip < length:
+            op = code[ip]
+            n = size(op)
+            if n > steps:
+                op = superinstructions.get_original(op)
+                n = 1
+            steps -= n
+            self.instruction_pointer = ip + 1
+            op(self)
+            ip = self.instruction_pointer
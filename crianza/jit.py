@@ -0,0 +1,420 @@
+"""
+Contains a basic-block compiler that turns threaded code into generated Python
+functions.
+
+The code is split into basic blocks at jump targets and after instructions
+that change the instruction pointer (such as call, return, jmp, jz and @). Each
+block is turned into Python source code, compiled with exec and cached, so that
+a block runs as a single function call instead of one call per instruction.
+
+Inside a block, stack values are kept in local variables. Arithmetic,
+comparisons and stack shuffling on known or guarded types are done inline.
+Everything else is done by calling the ordinary instruction function after
+writing the local values back to the data stack.
+
+If a guard fails (e.g., "+" on a string, or division by zero), the block writes
+its local values back to the data stack and returns control to the interpreter
+at the failing instruction. The interpreter then runs it, so that results,
+errors and machine state are exactly the same as for Machine.run.
+
+Blocks are made from the code with its superinstructions and direct branches
+unfused. Machine.run counts those as one step for each instruction they
+replaced, so a JitMachine given a number of steps stops at the same place.
+
+Example:
+
+    code = crianza.compile(crianza.parse("2 3 + 4 *"), optimize=False)
+    machine = crianza.jit.JitMachine(code).run()
+"""
+
+from crianza import compiler
+from crianza import instructions
+from crianza import interpreter
+from crianza import superinstructions
+import six
+import sys
+
+_number = (int, float)
+_numeric = ("int", "bool", "float", "number")
+
+# Instructions that change or read the instruction pointer end a block
+_control = set(entry.function for entry in instructions.registry
+               if entry.control)
+
+# Instructions that jump to an address popped off the stack
+_jumps = (instructions.call, instructions.jmp, instructions.jz,
+          instructions.loop)
+
+
+def find_leaders(code):
+    """Returns the set of addresses that start a basic block.
+
+    These are address 0, the address after each control instruction, the
+    address of each @ and all constant jump and call targets, including the
+    ones selected by "<addr> <addr> if jmp".
+    """
+    def address(op):
+        if compiler.is_embedded_push(op):
+            value = compiler.get_embedded_push_value(op)
+            if isinstance(value, int) and 0 <= value < len(code):
+                return value
+        return None
+
+    leaders = set([0])
+    for i, op in enumerate(code):
+        if op in _control:
+            leaders.add(i + 1)
+        if op is instructions.at:
+            leaders.add(i)
+        if op in _jumps and i > 0:
+            if code[i-1] is instructions.if_stmt and i > 2:
+                targets = [address(code[i-3]), address(code[i-2])]
+            else:
+                targets = [address(code[i-1])]
+            leaders.update(t for t in targets if t is not None)
+    return leaders
+
+
+class _Block(object):
+    """Generates Python source code for a single basic block."""
+
+    def __init__(self, code, start, leaders):
+        self.code = code
+        self.start = start
+        self.leaders = leaders
+        self.lines = []
+        self.stack = [] # Local stack values as (expression, type)
+        self.namespace = {"_number": _number}
+        self.literals = {} # Integer literal expressions and their values
+        self.temps = 0
+        self.segments = [] # (line index, address, executed, pops)
+        self.executed = 0
+        self.address = start
+        self.begin_segment()
+
+    def emit(self, line, indent=1):
+        self.lines.append("    " * indent + line)
+
+    def temp(self):
+        name = "t%d" % self.temps
+        self.temps += 1
+        return name
+
+    def bind(self, prefix, value):
+        name = "%s%d" % (prefix, len(self.namespace))
+        self.namespace[name] = value
+        return name
+
+    def begin_segment(self):
+        """Starts a new run of inline instructions, with an empty local
+        stack."""
+        self.segments.append([len(self.lines), self.address, self.executed, 0])
+
+    def pop(self):
+        if len(self.stack) > 0:
+            return self.stack.pop()
+        name = self.temp()
+        self.emit("%s = s.pop()" % name)
+        self.segments[-1][3] += 1
+        return (name, None)
+
+    def push(self, expr, type):
+        self.stack.append((expr, type))
+
+    def flush(self, indent=1):
+        """Writes local stack values back to the data stack."""
+        if len(self.stack) == 1:
+            self.emit("s.append(%s)" % self.stack[0][0], indent)
+        elif len(self.stack) > 1:
+            self.emit("s.extend((%s))" % ", ".join(e for e, _ in self.stack),
+                    indent)
+
+    def leave(self, address, executed, indent=1):
+        """Returns control to the dispatcher."""
+        self.emit("vm.instruction_pointer = %d" % address, indent)
+        self.emit("return %d" % executed, indent)
+
+    def guard(self, condition, operands):
+        """Returns control to the interpreter at the current instruction if
+        the condition fails. The operands must already have been popped off
+        the local stack."""
+        if condition is None:
+            return
+        self.emit("if not (%s):" % condition)
+        self.stack.extend(operands)
+        self.flush(indent=2)
+        del self.stack[-len(operands):]
+        self.leave(self.address, self.executed, indent=2)
+
+    def numbers(self, *operands):
+        """Returns a condition checking that operands of unknown type are
+        numbers, or None if their types are known."""
+        checks = ["isinstance(%s, _number)" % e for e, t in operands
+                  if t not in _numeric]
+        return " and ".join(checks) if len(checks) > 0 else None
+
+    def arithmetic_type(self, a, b):
+        if a[1] in ("int", "bool") and b[1] in ("int", "bool"):
+            return "int"
+        elif a[1] == "float" or b[1] == "float":
+            return "float"
+        else:
+            return "number"
+
+    def binary(self, template, type=None, divisor=False, numbers=True):
+        """Emits a binary operation, where a is the top of the stack and b
+        the one below it."""
+        a = self.pop()
+        b = self.pop()
+        conditions = []
+        if numbers and self.numbers(a, b) is not None:
+            conditions.append(self.numbers(a, b))
+        if divisor:
+            conditions.append("%s != 0" % a[0])
+        self.guard(" and ".join(conditions) if conditions else None, [b, a])
+        name = self.temp()
+        self.emit("%s = %s" % (name, template % {"a": a[0], "b": b[0]}))
+        self.push(name, type if type is not None else
+                self.arithmetic_type(a, b))
+
+    def generic(self, op):
+        """Calls the instruction function with the machine in a consistent
+        state."""
+        self.flush()
+        self.stack = []
+        name = self.bind("op", op)
+        self.emit("vm.instruction_pointer = %d" % (self.address + 1))
+        self.emit("%s(vm)" % name)
+
+    def constant(self, value):
+        if isinstance(value, bool):
+            self.push(repr(value), "bool")
+        elif isinstance(value, int):
+            self.literals[repr(value)] = value
+            self.push(repr(value), "int")
+        elif isinstance(value, float):
+            self.push(self.bind("k", value), "float")
+        elif isinstance(value, str):
+            self.push(self.bind("k", value), "str")
+        else:
+            self.push(self.bind("k", value), None)
+
+    def static_target(self):
+        """Returns the jump target on top of the local stack, if it is an
+        integer constant in range."""
+        if len(self.stack) == 0 or self.stack[-1][1] != "int":
+            return None
+        target = self.literals.get(self.stack[-1][0])
+        if target is not None and 0 <= target < len(self.code):
+            return target
+        return None
+
+    def instruction(self, op):
+        """Emits code for one instruction. Returns False if the instruction
+        ends the block."""
+        i = instructions
+
+        if compiler.is_embedded_push(op):
+            self.constant(compiler.get_embedded_push_value(op))
+        elif op is i.dup:
+            a = self.pop()
+            self.push(*a)
+            self.push(*a)
+        elif op is i.drop:
+            self.pop()
+        elif op is i.swap:
+            b = self.pop()
+            a = self.pop()
+            self.push(*b)
+            self.push(*a)
+        elif op is i.over:
+            b = self.pop()
+            a = self.pop()
+            self.push(*a)
+            self.push(*b)
+            self.push(*a)
+        elif op is i.rot:
+            c = self.pop()
+            b = self.pop()
+            a = self.pop()
+            self.push(*b)
+            self.push(*c)
+            self.push(*a)
+        elif op is i.add:
+            self.binary("%(a)s + %(b)s")
+        elif op is i.sub:
+            self.binary("%(b)s - %(a)s")
+        elif op is i.mul:
+            self.binary("%(a)s * %(b)s")
+        elif op is i.div:
+            self.binary("%(b)s / %(a)s", type="number", divisor=True)
+        elif op is i.mod:
+            self.binary("%(b)s %% %(a)s", divisor=True)
+        elif op is i.equal:
+            self.binary("%(a)s == %(b)s", type="bool", numbers=False)
+        elif op is i.not_equal:
+            self.binary("%(a)s != %(b)s", type="bool", numbers=False)
+        elif op is i.less:
+            self.binary("%(a)s < %(b)s", type="bool")
+        elif op is i.less_equal:
+            self.binary("%(a)s <= %(b)s", type="bool")
+        elif op is i.greater:
+            self.binary("%(a)s > %(b)s", type="bool")
+        elif op is i.greater_equal:
+            self.binary("%(a)s >= %(b)s", type="bool")
+        elif op is i.negate:
+            a = self.pop()
+            self.guard(self.numbers(a), [a])
+            name = self.temp()
+            self.emit("%s = -%s" % (name, a[0]))
+            self.push(name, "int" if a[1] in ("int", "bool") else a[1] or
+                    "number")
+        elif op is i.nop:
+            pass
+        elif op is i.true_:
+            self.push("True", "bool")
+        elif op is i.false_:
+            self.push("False", "bool")
+        elif op in (i.jmp, i.call) and self.static_target() is not None:
+            target = self.static_target()
+            self.stack.pop()
+            self.flush()
+            if op is i.call:
+                self.emit("vm.return_stack.push(%d)" % (self.address + 1))
+            self.leave(target, self.executed + 1)
+            return False
+        elif op is i.jz and self.static_target() is not None:
+            target = self.static_target()
+            self.stack.pop()
+            test = self.pop()
+            self.flush()
+            truth = self.bind("truth", i.truth)
+            self.emit("if not %s(%s):" % (truth, test[0]))
+            self.leave(target, self.executed + 1, indent=2)
+            self.leave(self.address + 1, self.executed + 1)
+            return False
+        elif op in _control:
+            self.generic(op)
+            self.emit("return %d" % (self.executed + 1))
+            return False
+        else:
+            self.generic(op)
+            self.address += 1
+            self.executed += 1
+            self.begin_segment()
+            return True
+
+        self.address += 1
+        self.executed += 1
+        return True
+
+    def source(self, name):
+        """Generates the block and returns its source code."""
+        while self.address < len(self.code):
+            if not self.instruction(self.code[self.address]):
+                break
+            if self.address in self.leaders:
+                self.flush()
+                self.leave(self.address, self.executed)
+                break
+        else:
+            self.flush()
+            self.leave(self.address, self.executed)
+
+        # Each segment of inline instructions checks up front that the data
+        # stack holds enough values for it, so that the pops cannot fail.
+        for index, address, executed, pops in reversed(self.segments):
+            if pops > 0:
+                self.lines[index:index] = [
+                    "    if len(s) < %d:" % pops,
+                    "        vm.instruction_pointer = %d" % address,
+                    "        return %d" % executed]
+
+        args = "".join(", %s=%s" % (n, n) for n in sorted(self.namespace))
+        return "\n".join(["def %s(vm%s):" % (name, args),
+                          "    s = vm.data_stack._values"] + self.lines) + "\n"
+
+
+class BlockCompiler(object):
+    """Compiles and runs basic blocks of a given code."""
+
+    def __init__(self, code):
+        self.original = code
+        self.code = superinstructions.unfused(code)
+        self.leaders = find_leaders(self.code)
+        self.blocks = {}
+        self.source = {}
+
+    def compile(self, start):
+        """Returns the compiled block starting at the given address as a
+        function taking a Machine and returning the number of instructions it
+        executed. The function sets the machine's instruction pointer to the
+        next instruction to run."""
+        block = self.blocks.get(start)
+        if block is None:
+            generator = _Block(self.code, start, self.leaders)
+            name = "block_%d" % start
+            source = generator.source(name)
+            namespace = dict(generator.namespace)
+            six.exec_(compile(source, "<crianza block %d>" % start, "exec",
+                dont_inherit=True), namespace)
+            block = namespace[name]
+            block.length = generator.executed + (
+                1 if generator.address < len(self.code) and
+                self.code[generator.address] in _control else 0)
+            self.blocks[start] = block
+            self.source[start] = source
+        return block
+
+    def run(self, machine, steps=None):
+        """Runs code on the machine, like Machine.run."""
+        bounded = steps is not None and steps > 0
+        code = self.code
+        length = len(code)
+        try:
+            while machine.instruction_pointer < length:
+                block = self.compile(machine.instruction_pointer)
+                if bounded and block.length > steps:
+                    machine._run_bounded(steps)
+                    break
+                executed = block(machine)
+                if executed == 0:
+                    # A guard failed on the first instruction
+                    ip = machine.instruction_pointer
+                    machine.instruction_pointer = ip + 1
+                    code[ip](machine)
+                    executed = 1
+                if bounded:
+                    steps -= executed
+                    if steps == 0:
+                        break
+        except StopIteration:
+            pass
+        except EOFError:
+            pass
+        return machine
+
+
+class JitMachine(interpreter.Machine):
+    """A Machine that runs its code through the basic-block compiler."""
+
+    def __init__(self, code, output=sys.stdout, input=sys.stdin):
+        super(JitMachine, self).__init__(code, output=output, input=input)
+        self._compiler = None
+
+    def invalidate(self):
+        """Drops compiled blocks. Call this after changing the code in
+        place."""
+        self._compiler = None
+
+    def run(self, steps=None):
+        """Run code in machine, compiling basic blocks as they are reached.
+
+        Args:
+            steps: If specified, run that many number of instructions before
+            stopping.
+        """
+        if (self._compiler is None or self._compiler.original is not self.code
+                or len(self._compiler.code) != len(self.code)):
+            self._compiler = BlockCompiler(self.code)
+        return self._compiler.run(self, steps)
@@ -1,272 +1,495 @@
 """
-Contains extremely experimental support for compiling to native Python.
+Contains experimental support for compiling to native Python functions.
 
-Beware that actually running your code as native Python bytecode may segfault
-the interpreter!
+Code is lowered to a Python abstract syntax tree and compiled with the built-in
+compile(), so it works on all Python versions. Subroutines (constant call
+targets) become real Python functions, and code with jumps becomes a while loop
+that dispatches on the address of each basic block.
+
+Jump and call targets must be known at compile time. That is the case for
+"<addr> jmp", "<addr> call", "<addr> <addr> if jmp", and for "<addr> jz" and
+"<addr> loop", which structured control flow compiles to. Code with computed
+jumps is not compiled, and the returned function runs it on a Machine instead.
+
+Beware that native code does not do the runtime type checking that the
+instructions of the virtual machine do, so erroneous programs may raise plain
+Python exceptions.
 
 TODO:
-    - Read all jump locations (not entirely possible, actually), convert to
-      bp.Label.
+    - Keep stack values in local variables inside basic blocks, like the
+      crianza.jit block compiler does.
+"""
 
-    - In the entire language, require that jumps are absolute? if-jumps are OK,
-      but they should all be constants (or possible to deduce), so "read int
-      jmp" should not be allowable. Or find another way (use structured
-      programming for loops, pass on subroutines for call/return to the native
-      compiler so it can deduce positions, have compile be able to return these
-      positions).
+from crianza import compiler as cc
+from crianza import errors
+from crianza import instructions as cr
+from crianza import interpreter
+from crianza import superinstructions
+from six.moves import builtins
+import ast
+import copy
+import crianza
+import six
+import sys
 
-      An alternative would be to do
 
-        labels[lineno] = bp.Label()
+class _DynamicCode(Exception):
+    """Raised when code cannot be compiled natively."""
+    pass
 
-      and put a label for each line. That works, but I don't know if the
-      byteplay module will optimize away unused jumps for us? (Probably does)
 
-    - Would it be possible to invoke CPython's optimizer?
-"""
+def _parse(source):
+    """Parses Python source code into a list of statement nodes."""
+    return ast.parse(source).body
 
-import byteplay as bp
-import crianza
-import crianza.compiler as cc
-import crianza.instructions as cr
-import sys
+def _template(source):
+    """Returns a function that returns fresh copies of the statements in the
+    given source code."""
+    nodes = _parse(source)
+    return lambda: copy.deepcopy(nodes)
 
 
 def mod():
-    return [(bp.BINARY_MODULO, None)]
+    return _template("a = s.pop()\ns[-1] = s[-1] % a")
 
 def add():
-    return [(bp.BINARY_ADD, None)]
+    return _template("a = s.pop()\ns[-1] = a + s[-1]")
 
 def bitwise_and():
-    return [(bp.BINARY_AND, None)]
+    return _template("a = s.pop()\ns[-1] = s[-1] & a")
 
 def mul():
-    return [(bp.BINARY_MULTIPLY, None)]
+    return _template("a = s.pop()\ns[-1] = a * s[-1]")
 
 def sub():
-    return [(bp.BINARY_SUBTRACT, None)]
+    return _template("a = s.pop()\ns[-1] = s[-1] - a")
 
 def dot():
-    # TODO: Use current output stream
-    return [
-        (bp.PRINT_ITEM, None),
-        (bp.PRINT_NEWLINE, None),
-    ]
+    return _template("_dot(s.pop())")
 
 def div():
-    return [(bp.BINARY_DIVIDE, None)]
+    return _template("a = s.pop()\ns[-1] = s[-1] / a")
 
 def less():
-    return [(bp.COMPARE_OP, "<")]
+    return _template("a = s.pop()\ns[-1] = a < s[-1]")
 
 def less_equal():
-    return [(bp.COMPARE_OP, "<=")]
+    return _template("a = s.pop()\ns[-1] = a <= s[-1]")
 
 def not_equal():
-    return [(bp.COMPARE_OP, "!=")]
+    return _template("a = s.pop()\ns[-1] = a != s[-1]")
 
 def equal():
-    return [(bp.COMPARE_OP, "==")]
+    return _template("a = s.pop()\ns[-1] = a == s[-1]")
 
 def greater():
-    return [(bp.COMPARE_OP, ">")]
+    return _template("a = s.pop()\ns[-1] = a > s[-1]")
 
 def greater_equal():
-    return [(bp.COMPARE_OP, ">=")]
-
-def at():
-    raise NotImplementedError("@")
+    return _template("a = s.pop()\ns[-1] = a >= s[-1]")
 
 def bitwise_xor():
-    return [(bp.BINARY_XOR, None)]
-
-def __call_function(name, args):
-    # TODO: Stuff like this can probably be optimized if we do a global pass
-    # (so we don't need the ROT_TWO)
-    if args == 0:
-        return [
-            (bp.LOAD_GLOBAL, name),
-            (bp.CALL_FUNCTION, args)
-        ]
-    elif args == 1:
-        return [
-            (bp.LOAD_GLOBAL, name),
-            (bp.ROT_TWO, None),
-            (bp.CALL_FUNCTION, args)
-        ]
-    else:
-        raise NotImplementedError("__call_function with more than 1 args")
+    return _template("a = s.pop()\ns[-1] = s[-1] ^ a")
 
 def abs_():
-    return __call_function("abs", 1)
+    return _template("s[-1] = abs(s[-1])")
 
 def cast_bool():
-    return __call_function("bool", 1)
-
-def call():
-    # TODO: Could use JUMP_ABSOLUTE, but we'd have to calculate some offsets
-    # due to input arguments.
-    raise NotImplementedError("call")
-
-def return_():
-    raise NotImplementedError("return")
+    return _template("s[-1] = bool(s[-1])")
 
 def drop():
-    return [(bp.POP_TOP, None)]
+    return _template("del s[-1]")
 
 def dup():
-    return [(bp.DUP_TOP, None)]
+    # Like the VM instruction, duplicating an empty stack pushes None
+    return _template("s.append(s[-1] if s else None)")
 
 def exit():
-    # Returns None to Python
-    return [
-        (bp.LOAD_CONST, None),
-        (bp.RETURN_VALUE, None),
-    ]
+    return _template("raise _Exit()")
 
 def false_():
-    return [(bp.LOAD_CONST, False)]
+    return _template("s.append(False)")
 
 def cast_float():
-    return __call_function("float", 1)
+    # Like the VM instruction, only checks that the value can be converted
+    return _template("float(s[-1])")
+
+def do():
+    return _template("a = s.pop()\nb = s.pop()\nrs.append(b)\nrs.append(a)")
 
 def if_stmt():
-    # Stack: (p)redicate (c)onsequent (a)lternative
-    # Example: "true  'yes' 'no' if" ==> 'yes'
-    # Example: "false 'yes' 'no' if" ==> 'no'
-    pop = bp.Label()
-    return [
-        (bp.ROT_THREE, None),        # p c a -- a p c
-        (bp.ROT_TWO, None),          # a p c -- a c p
-        (bp.POP_JUMP_IF_FALSE, pop),
-        (bp.ROT_TWO, None),          #  a c  -- c a
-        (pop, None),
-        (bp.POP_TOP, None),
-    ]
+    return _template("a = s.pop()\nb = s.pop()\ns[-1] = b if _istrue(s[-1]) else a")
 
-def cast_int():
-    return __call_function("int", 1)
+def index():
+    return _template("s.append(rs[-1])")
 
-def jmp():
-    # TODO: Make sure that our way of calculating jump locations work
-    return [
-        (bp.LOAD_CONST, 3),
-        (bp.BINARY_FLOOR_DIVIDE, None),
-        (bp.JUMP_ABSOLUTE, None),
-    ]
+def cast_int():
+    return _template("s[-1] = int(s[-1])")
 
 def negate():
-    return [(bp.UNARY_NEGATIVE, None)]
+    return _template("s[-1] = -s[-1]")
 
 def nop():
-    return [(bp.NOP, None)]
+    return _template("")
 
 def boolean_and():
-    # a b -- (b and a)
-    # TODO: Our other lang requires these are booleans
-    # TODO: Use JUMP_IF_FALSE_OR_POP and leave either a or b
-    label_out = bp.Label()
-    return [
-        (bp.POP_JUMP_IF_TRUE, label_out), # a b -- a
-        (bp.POP_TOP, None),
-        (bp.LOAD_CONST, False),
-        (label_out, None),
-    ]
+    return _template("a = s.pop()\ns[-1] = s[-1] and a")
 
 def boolean_not():
-    return [(bp.UNARY_NOT, None)]
+    return _template("s[-1] = not s[-1]")
 
 def boolean_or():
-    # TODO: This is wrong. Implement as shown in boolean_and
-    return [(bp.BINARY_OR, None)]
+    return _template("a = s.pop()\ns[-1] = s[-1] or a")
 
 def over():
-    # a b -- a b a
-    return [
-        (bp.DUP_TOPX, 2),   # a b -- a b a b
-        (bp.POP_TOP, None), # a b a b -- a b a
-    ]
+    return _template("s.append(s[-2])")
 
 def read():
-    # TODO: Use current input stream
-    return [
-        (bp.LOAD_GLOBAL, "sys"),
-        (bp.LOAD_ATTR, "stdin"),
-        (bp.LOAD_ATTR, "readline"),
-        (bp.CALL_FUNCTION, 0),
-        (bp.LOAD_ATTR, "rstrip"),
-        (bp.CALL_FUNCTION, 0),
-    ]
+    return _template("""
+a = _input.readline().rstrip()
+s.append(a)
+if a == "":
+    raise EOFError()
+""")
 
 def rot():
-    # Forth:   a b c -- b c a
-    # CPython: a b c -- c a b
-    return [
-        (bp.ROT_THREE, None), # a b c -- c a b
-        (bp.ROT_THREE, None), # c a b -- b c a
-    ]
+    # a b c -- b c a
+    return _template("s.append(s.pop(-3))")
 
 def cast_str():
-    return __call_function("str", 1)
+    return _template("s[-1] = str(s[-1])")
 
 def swap():
-    return [(bp.ROT_TWO, None)]
+    return _template("s[-2], s[-1] = s[-1], s[-2]")
 
 def true_():
-    return [(bp.LOAD_CONST, True)]
+    return _template("s.append(True)")
 
 def write():
-    # TODO: Use current output stream
-    return [
-        (bp.PRINT_ITEM, None),
-    ]
+    return _template("_write(s.pop())")
 
 def bitwise_or():
-    return [(bp.BINARY_OR, None)]
+    return _template("a = s.pop()\ns[-1] = s[-1] | a")
 
 def bitwise_complement():
-    return [(bp.UNARY_INVERT, None)]
-
-def push(constant):
-    return [(bp.LOAD_CONST, constant)]
+    return _template("s[-1] = ~s[-1]")
 
-def to_code(bytecode):
-    code = []
 
-    for op in bytecode:
-        if cc.is_embedded_push(op):
-            code += push(cc.get_embedded_push_value(op))
+def _istrue(value):
+    """Returns the truth value of a value, as used by the if instruction."""
+    if isinstance(value, bool):
+        return value
+    elif isinstance(value, str):
+        return len(value) > 0
+    elif interpreter.isnumber(value):
+        return value != 0
+    else:
+        return True
+
+
+class _Lowering(object):
+    """Lowers native code to a Python module AST."""
+
+    def __init__(self, code):
+        self.code = code
+        self.constants = {}
+        self.targets = {}
+        self.find_targets()
+        self.find_leaders()
+
+    def constant(self, value):
+        """Returns an expression node for the given constant."""
+        if isinstance(value, (bool, int, float, str)):
+            try:
+                if ast.literal_eval(repr(value)) == value:
+                    return _parse(repr(value))[0].value
+            except (ValueError, SyntaxError):
+                pass
+        name = "_k%d" % len(self.constants)
+        self.constants[name] = value
+        return _parse(name)[0].value
+
+    def address(self, index):
+        """Returns the constant integer pushed at the given index, or None."""
+        if 0 <= index < len(self.code) and cc.is_embedded_push(self.code[index]):
+            value = cc.get_embedded_push_value(self.code[index])
+            if isinstance(value, int) and not isinstance(value, bool):
+                return value
+        return None
+
+    def find_targets(self):
+        """Finds the possible targets of each jmp, call, jz and loop.
+
+        Maps the address of each of them to a tuple of (targets, the first
+        address of the instructions that produce the target).
+
+        Raises:
+            _DynamicCode: If a target cannot be determined.
+        """
+        for i, op in enumerate(self.code):
+            if op not in (cr.jmp, cr.call, cr.jz, cr.loop):
+                continue
+            if self.address(i-1) is not None:
+                self.targets[i] = ([self.address(i-1)], i-1)
+            elif (i > 2 and op in (cr.jmp, cr.call) and
+                    self.code[i-1] is cr.if_stmt and
+                    self.address(i-2) is not None and
+                    self.address(i-3) is not None):
+                self.targets[i] = ([self.address(i-3), self.address(i-2)], i-3)
+            else:
+                raise _DynamicCode("Computed target at index %d" % i)
+
+    def find_leaders(self):
+        """Finds the addresses that start a basic block."""
+        code = self.code
+        self.leaders = set([0])
+        for i, (targets, first) in self.targets.items():
+            self.leaders.update(t for t in targets if 0 <= t < len(code))
+        for i, op in enumerate(code):
+            if op is cr.at:
+                self.leaders.add(i)
+            if op in (cr.jmp, cr.jz, cr.loop, cr.return_, cr.exit):
+                self.leaders.add(i + 1)
+
+        # The instructions that produce a target must run together with the
+        # jump itself
+        for i, (targets, first) in self.targets.items():
+            if any(j in self.leaders for j in range(first + 1, i + 1)):
+                raise _DynamicCode("Jump into target computation at index %d"
+                        % i)
+
+        self.entries = set([0])
+        for i, (targets, first) in self.targets.items():
+            if code[i] is cr.call:
+                self.entries.update(t for t in targets if 0 <= t < len(code))
+
+    def transfer(self, targets, call):
+        """Returns statements that jump to or call one of the targets on top
+        of the stack."""
+        for target in targets:
+            if not (0 <= target < len(self.code)):
+                return _parse("raise _MachineError('Jump address out of "
+                              "range: %d')" % target)
+        if len(targets) == 1:
+            if call:
+                return _parse("_f%d(s)" % targets[0])
+            return _parse("pc = %d" % targets[0])
+
+        source = "a = s.pop()\nif a == %d:\n    %s\nelse:\n    %s"
+        if call:
+            return _parse(source % (targets[0], "_f%d(s)" % targets[0],
+                "_f%d(s)" % targets[1]))
+        return _parse(source % (targets[0], "pc = %d" % targets[0],
+            "pc = %d" % targets[1]))
+
+    def conditional(self, op, target, address):
+        """Returns statements for "<target> jz" or "<target> loop" at the
+        given address, which go to the target or the next address."""
+        if op is cr.jz:
+            nodes = _parse("if _istrue(s.pop()):\n"
+                           "    pc = %d\n"
+                           "else:\n"
+                           "    pass" % (address + 1))
+            nodes[0].orelse = self.transfer([target], False)
         else:
-            code += opmap[op]()
-
-    return code
-
-def compile(code, args=0, arglist=(), freevars=[], varargs=False,
-        varkwargs=False, newlocals=True, name="", filename="", firstlineno=1,
-        docstring=""):
-
-    code = to_code(code)
-    code.append((bp.RETURN_VALUE, None))
-
-    if args > 0:
-        for n in xrange(args):
-            argname = "arg%d" % n
-            arglist = arglist + (argname,)
-            code = [(bp.LOAD_FAST, argname)] + code
+            nodes = _parse("a = rs.pop() + 1\n"
+                           "if a < rs[-1]:\n"
+                           "    rs.append(a)\n"
+                           "else:\n"
+                           "    rs.pop()\n"
+                           "    pc = %d" % (address + 1))
+            nodes[1].body += self.transfer([target], False)
+        return nodes
+
+    def block(self, start, main):
+        """Lowers a basic block.
+
+        Returns:
+            A tuple of (statements, successor addresses, whether the block
+            assigns pc).
+        """
+        body = []
+        successors = []
+        jumps = False
+        i = start
+
+        while True:
+            if i >= len(self.code):
+                body += _parse("return" if main else "raise _Exit()")
+                break
+
+            if i != start and i in self.leaders:
+                body += _parse("pc = %d" % i)
+                successors.append(i)
+                jumps = True
+                break
+
+            op = self.code[i]
+
+            if i in self.targets:
+                targets, first = self.targets[i]
+                call = op is cr.call
+                if op in (cr.jz, cr.loop):
+                    body += self.conditional(op, targets[0], i)
+                    successors += [t for t in targets + [i + 1]
+                                   if 0 <= t <= len(self.code)]
+                    jumps = True
+                    break
+                body += self.transfer(targets, call)
+                if not call:
+                    successors += [t for t in targets
+                                   if 0 <= t < len(self.code)]
+                    jumps = True
+                    break
+            elif cc.is_embedded_push(op):
+                if not (i+1 in self.targets and self.targets[i+1][1] == i):
+                    call = _parse("s.append(_)")[0]
+                    call.value.args = [
+                        self.constant(cc.get_embedded_push_value(op))]
+                    body.append(call)
+            elif op is cr.at:
+                body += _parse("rs.append(%d)" % i)
+            elif op is cr.return_:
+                if main:
+                    body += _parse("if not rs:\n"
+                                   "    raise _MachineError('Stack underflow')")
+                else:
+                    body += _parse("if not rs:\n    return")
+                body += _parse("pc = rs.pop()")
+                jumps = True
+                break
+            elif op is cr.exit:
+                body += opmap[op]()
+                break
+            elif op in opmap:
+                body += opmap[op]()
+            else:
+                raise _DynamicCode("Unsupported instruction at index %d" % i)
+            i += 1
+
+        return body, successors, jumps
+
+    def function(self, entry):
+        """Lowers the code reachable from an entry point to a function."""
+        main = entry == 0
+        blocks = []
+        seen = set()
+        work = [entry]
+        jumps = False
+
+        while len(work) > 0:
+            start = work.pop(0)
+            if start in seen:
+                continue
+            seen.add(start)
+            body, successors, assigns = self.block(start, main)
+            blocks.append((start, body))
+            work += successors
+            jumps = jumps or assigns
+
+        func = _parse("def _f%d(s):\n    rs = []" % entry)[0]
+        if not jumps:
+            func.body = blocks[0][1] or _parse("pass")
+            return func
+
+        loop = _parse("pc = %d\nwhile True:\n    pass" % entry)
+        chain = None
+        for start, body in reversed(blocks):
+            test = _parse("if pc == %d:\n    pass" % start)[0]
+            test.body = body or _parse("pass")
+            test.orelse = [chain] if chain is not None else []
+            chain = test
+        loop[1].body = [chain]
+        func.body += loop
+        return func
+
+    def module(self, name, args):
+        """Returns a module AST that defines the given function name."""
+        arglist = ", ".join("arg%d" % n for n in range(args))
+        module = ast.parse("""
+def %(name)s(%(args)s):
+    s = [%(args)s]
+    try:
+        _f0(s)
+    except (_Exit, EOFError):
+        pass
+    return s[-1] if len(s) > 0 else None
+""" % {"name": name, "args": arglist})
+        module.body = [self.function(e) for e in sorted(self.entries)] + \
+                module.body
+        return ast.fix_missing_locations(module)
+
+
+def interpreted(code, args=0, output=sys.stdout, input=sys.stdin):
+    """Returns a function that runs code on a Machine, with the same calling
+    convention as natively compiled functions."""
+    def run(*argv):
+        if len(argv) != args:
+            raise TypeError("Expected %d arguments, got %d" % (args,
+                len(argv)))
+        machine = interpreter.Machine(code, output=output, input=input)
+        for arg in argv:
+            machine.push(arg)
+        machine.run()
+        return machine.top
+    return run
+
+def compile(code, args=0, name="", filename="", docstring="",
+        output=sys.stdout, input=sys.stdin):
+    """Compiles native code to a Python function.
+
+    Arguments are pushed onto the data stack in order, so that the last one
+    ends up on top, and the function returns the value on top of the stack, or
+    None if it is empty.
 
-    # First of all, push a None value in case we run code like "'hey' .", so
-    # that we always have a value to return.
-    code = [(bp.LOAD_CONST, None)] + code
-
-    codeobj = bp.Code(code, freevars=freevars, args=arglist, varargs=varargs,
-            varkwargs=varkwargs, newlocals=newlocals, name=name,
-            filename=filename, firstlineno=firstlineno, docstring=docstring)
+    Args:
+        code: Native code, as returned by crianza.compile().
+        args: The resulting function's number of input parameters.
+        name: The function's name.
+        filename: The file name used in tracebacks.
+        docstring: The function's docstring.
+        output: Stream that the code writes to.
+        input: Stream that the code reads from.
 
-    func = lambda: None
-    func.func_code = bp.Code.to_code(codeobj)
-    func.__doc__ = docstring # TODO: I thought bp.Code was supposed to do this?
-    func.__name__ = name # TODO: Ditto
+    Returns:
+        A callable Python function. If the code contains computed jumps, the
+        function runs the code on a Machine instead, and its "interpreted"
+        attribute is True.
+    """
+    code = superinstructions.unfused(code)
+
+    try:
+        lowering = _Lowering(code)
+        module = lowering.module("native", args)
+    except _DynamicCode:
+        func = interpreted(code, args=args, output=output, input=input)
+        func.interpreted = True
+    else:
+        def write(value, flush=True):
+            output.write(str(value))
+            if flush:
+                output.flush()
+
+        def dot(value):
+            write(value, flush=False)
+            write("\n")
+
+        namespace = {
+            "_Exit": errors.ExitProgram,
+            "_MachineError": errors.MachineError,
+            "_dot": dot,
+            "_input": input,
+            "_istrue": _istrue,
+            "_write": write,
+        }
+        namespace.update(lowering.constants)
+        six.exec_(builtins.compile(module, filename or "<crianza>", "exec",
+            dont_inherit=True), namespace)
+        func = namespace["native"]
+        func.interpreted = False
+
+    func.__doc__ = docstring
+    func.__name__ = name if name else "native"
     return func
 
 def xcompile(source_code, args=0, optimize=True):
@@ -282,60 +505,57 @@ def xcompile(source_code, args=0, optimize=True):
     return crianza.native.compile(code, args=args)
 
 def xeval(source, optimize=True):
-    """Compiles to native Python bytecode and runs program, returning the
-    topmost value on the stack.
+    """Compiles to native Python and runs program, returning the topmost value
+    on the stack.
 
     Args:
         optimize: Whether to optimize the code after parsing it.
 
     Returns:
         None: If the stack is empty
-        obj: If the stack contains a single value
-        [obj, obj, ...]: If the stack contains many values
+        obj: The topmost value on the stack, otherwise
     """
     native = xcompile(source, optimize=optimize)
     return native()
 
 opmap = {
-    cr.lookup("%"):      mod,
-    cr.lookup("&"):      bitwise_and,
-    cr.lookup("*"):      mul,
-    cr.lookup("+"):      add,
-    cr.lookup("-"):      sub,
-    cr.lookup("."):      dot,
-    cr.lookup("/"):      div,
-    cr.lookup("<"):      less,
-    cr.lookup("<="):     greater_equal,
-    cr.lookup("<>"):     not_equal,
-    cr.lookup("="):      equal,
-    cr.lookup(">"):      greater,
-    cr.lookup(">="):     greater_equal,
-    cr.lookup("@"):      at,
-    cr.lookup("^"):      bitwise_xor,
-    cr.lookup("abs"):    abs_,
-    cr.lookup("and"):    boolean_and,
-    cr.lookup("bool"):   cast_bool,
-    cr.lookup("call"):   call,
-    cr.lookup("drop"):   drop,
-    cr.lookup("dup"):    dup,
-    cr.lookup("exit"):   exit,
-    cr.lookup("false"):  false_,
-    cr.lookup("float"):  cast_float,
-    cr.lookup("if"):     if_stmt,
-    cr.lookup("int"):    cast_int,
-    cr.lookup("jmp"):    jmp,
-    cr.lookup("negate"): negate,
-    cr.lookup("nop"):    nop,
-    cr.lookup("not"):    boolean_not,
-    cr.lookup("or"):     boolean_or,
-    cr.lookup("over"):   over,
-    cr.lookup("read"):   read,
-    cr.lookup("return"): return_,
-    cr.lookup("rot"):    rot,
-    cr.lookup("str"):    cast_str,
-    cr.lookup("swap"):   swap,
-    cr.lookup("true"):   true_,
-    cr.lookup("write"):  write,
-    cr.lookup("|"):      bitwise_or,
-    cr.lookup("~"):      bitwise_complement,
+    cr.lookup("%"):      mod(),
+    cr.lookup("&"):      bitwise_and(),
+    cr.lookup("*"):      mul(),
+    cr.lookup("+"):      add(),
+    cr.lookup("-"):      sub(),
+    cr.lookup("."):      dot(),
+    cr.lookup("/"):      div(),
+    cr.lookup("<"):      less(),
+    cr.lookup("<="):     less_equal(),
+    cr.lookup("<>"):     not_equal(),
+    cr.lookup("="):      equal(),
+    cr.lookup(">"):      greater(),
+    cr.lookup(">="):     greater_equal(),
+    cr.lookup("^"):      bitwise_xor(),
+    cr.lookup("abs"):    abs_(),
+    cr.lookup("and"):    boolean_and(),
+    cr.lookup("bool"):   cast_bool(),
+    cr.lookup("do"):     do(),
+    cr.lookup("drop"):   drop(),
+    cr.lookup("dup"):    dup(),
+    cr.lookup("exit"):   exit(),
+    cr.lookup("false"):  false_(),
+    cr.lookup("float"):  cast_float(),
+    cr.lookup("i"):      index(),
+    cr.lookup("if"):     if_stmt(),
+    cr.lookup("int"):    cast_int(),
+    cr.lookup("negate"): negate(),
+    cr.lookup("nop"):    nop(),
+    cr.lookup("not"):    boolean_not(),
+    cr.lookup("or"):     boolean_or(),
+    cr.lookup("over"):   over(),
+    cr.lookup("read"):   read(),
+    cr.lookup("rot"):    rot(),
+    cr.lookup("str"):    cast_str(),
+    cr.lookup("swap"):   swap(),
+    cr.lookup("true"):   true_(),
+    cr.lookup("write"):  write(),
+    cr.lookup("|"):      bitwise_or(),
+    cr.lookup("~"):      bitwise_complement(),
 }
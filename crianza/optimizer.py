@@ -1,25 +1,328 @@
 from crianza import errors
 from crianza import instructions
 from crianza import interpreter
+from crianza import program
+from crianza import stack
+from crianza import superinstructions
+from crianza.passes import PassManager
+import bisect
+import collections
+import six
 
+# How many rewrites each pass has made (see passes.PassManager)
+statistics = collections.Counter()
 
-def optimized(code, silent=True, ignore_errors=True):
-    """Performs optimizations on already parsed code."""
-    return constant_fold(code, silent=silent, ignore_errors=ignore_errors)
+# Instructions that can be run at compile time when their operands are known
+_pure = dict((entry.function, entry) for entry in instructions.registry
+             if entry.pure)
 
-def constant_fold(code, silent=True, ignore_errors=True):
+# Instructions that take an address from the top of the stack
+_jumps = (instructions.call, instructions.jmp, instructions.jz,
+          instructions.loop)
+
+# Stack shuffling instructions, with the values each one pushes given as
+# indices into the values it pops, the deepest one first
+_shuffles = {
+    "dup":  (0, 0),
+    "drop": (),
+    "nop":  (),
+    "over": (0, 1, 0),
+    "rot":  (1, 2, 0),
+    "swap": (1, 0),
+}
+
+# The longest stack shuffle sequences that shuffle() looks for
+SHUFFLE_SIZE = 5
+
+# Algebraic identities, as (window, replacement, types). The window is a
+# sequence of instruction names and constants, and the replacement the names of
+# the instructions to put in its place. If types is not None, a rule only
+# applies if the value below the window is known to have one of the types.
+_identities = [
+    ((0, "+"),              (), ("int",)),
+    ((0, "-"),              (), ("int", "float")),
+    ((1, "*"),              (), ("int", "float")),
+    ((1, "/"),              (), ("float",)),
+    ((0, "|"),              (), ("int",)),
+    ((0, "^"),              (), ("int",)),
+    ((-1, "&"),             (), ("int",)),
+    ((True, "and"),         (), ("bool",)),
+    (("true", "and"),       (), ("bool",)),
+    ((False, "or"),         (), ("bool",)),
+    (("false", "or"),       (), ("bool",)),
+    (("negate", "negate"),  (), ("int", "float")),
+    (("not", "not"),        (), ("bool",)),
+    (("~", "~"),            (), ("int",)),
+    (("int",),              (), ("int",)),
+    (("float",),            (), ("int", "float")),
+    (("str",),              (), ("str",)),
+    (("bool",),             (), ("bool",)),
+    (("abs", "abs"),        ("abs",), None),
+    (("bool", "bool"),      ("bool",), None),
+    (("float", "float"),    ("float",), None),
+    (("int", "int"),        ("int",), None),
+    (("str", "str"),        ("str",), None),
+    (("swap", "+"),         ("+",), None),
+    (("swap", "*"),         ("*",), None),
+    (("swap", "="),         ("=",), None),
+    (("swap", "<>"),        ("<>",), None),
+    (("swap", "and"),       ("and",), None),
+    (("swap", "or"),        ("or",), None),
+    (("swap", "&"),         ("&",), None),
+    (("swap", "|"),         ("|",), None),
+    (("swap", "^"),         ("^",), None),
+    (("swap", "<"),         (">",), None),
+    (("swap", ">"),         ("<",), None),
+    (("swap", "<="),        (">=",), None),
+    (("swap", ">="),        ("<=",), None),
+]
+
+# The types of the values pushed by instructions that always push the same
+# type (see _result_type)
+_result_types = {
+    "<":    "bool",
+    "<=":   "bool",
+    "<>":   "bool",
+    "=":    "bool",
+    ">":    "bool",
+    ">=":   "bool",
+    "and":  "bool",
+    "bool": "bool",
+    "false": "bool",
+    "int":  "int",
+    "not":  "bool",
+    "or":   "bool",
+    "read": "str",
+    "str":  "str",
+    "true": "bool",
+}
+
+# Instructions whose result is an int for int and bool operands
+_integral = set(["%", "&", "*", "+", "-", "^", "abs", "negate", "|", "~"])
+
+# Instructions whose result is a float for numbers where one is a float
+_floating = set(["%", "*", "+", "-", "abs", "negate"])
+
+# Instructions that words must not contain to be inlined
+_control = set(entry.name for entry in instructions.registry if entry.control)
+
+# The default maximum size of words to inline
+INLINE_SIZE = 8
+
+
+def optimized(code, silent=True, ignore_errors=True, positions=None,
+        passes=None):
+    """Performs optimizations on already parsed code.
+
+    The code can also be native code, as returned by crianza.compile() or
+    genetic.randomize(), or a Program. These are optimized with native_fold()
+    and returned in the same form.
+
+    Args:
+        passes: A passes.PassManager that chooses the constant_fold, simplify
+            and shuffle passes to run and records their statistics. Defaults
+            to all of them.
+    """
+    if passes is None:
+        passes = PassManager()
+    if isinstance(code, program.Program):
+        return optimize_program(code, silent=silent,
+                ignore_errors=ignore_errors, passes=passes)
+    if any(callable(op) for op in code):
+        return native_fold(code, silent=silent, ignore_errors=ignore_errors,
+                positions=positions, passes=passes)
+
+    # Each pass may make more work for the others, as removing "over drop" in
+    # "2 over drop 3 +" does, so run them until the code stops shrinking
+    pipeline = [
+        ("constant_fold", constant_fold, {"ignore_errors": ignore_errors}),
+        ("simplify", simplify, {}),
+        ("shuffle", shuffle, {}),
+    ]
+    length = None
+    while len(code) != length:
+        length = len(code)
+        for name, function, kwargs in pipeline:
+            if passes.enabled(name):
+                passes.run(name, function, code, silent=silent,
+                        positions=positions, **kwargs)
+    return code
+
+def inline(code, words, size=INLINE_SIZE, positions=None,
+        word_positions=None, silent=True):
+    """Replaces uses of small words with their bodies.
+
+    A word is inlined if it is not recursive, contains no control
+    instructions such as @, jmp, call and return (except the final one), and
+    its body is at most size instructions after inlining the words it uses.
+    Words are inlined into the main code and into each other, and inlined
+    words are removed, since nothing refers to them anymore.
+
+    Args:
+        code: Main code in non-native types. It is rewritten in place.
+        words: A dict mapping word names to their bodies, each ending with a
+            return. It is updated in place.
+        size: The maximum size of words to inline.
+        positions: An optional list of source positions for each instruction
+            in the code, which is kept in step with it.
+        word_positions: Like positions, but a dict with a list for each word.
+        silent: Flag that controls whether to print optimizations made.
+    """
+    if positions is None:
+        positions = [None]*len(code)
+    if word_positions is None:
+        word_positions = dict((name, [None]*len(body))
+                              for name, body in words.items())
+
+    def uses(name):
+        return set(op for op in words[name] if op in words)
+
+    def recursive(name):
+        seen = set()
+        pending = list(uses(name))
+        while pending:
+            other = pending.pop()
+            if other == name:
+                return True
+            if other not in seen:
+                seen.add(other)
+                pending.extend(uses(other))
+        return False
+
+    expanded = {}
+
+    def expand(name):
+        """Returns the inlined body and positions of a word, or None if it
+        cannot be inlined."""
+        if name not in expanded:
+            body = words[name][:-1]
+            result = None
+            if not (recursive(name) or _control.intersection(op for op in body
+                    if isinstance(op, str))):
+                result = substitute(body, word_positions[name][:-1])
+                if len(result[0]) > size:
+                    result = None
+            expanded[name] = result
+        return expanded[name]
+
+    def substitute(body, body_positions):
+        ops = []
+        ops_positions = []
+        for op, position in zip(body, body_positions):
+            inlined = expand(op) if op in words else None
+            if inlined is None:
+                ops.append(op)
+                ops_positions.append(position)
+            else:
+                ops.extend(inlined[0])
+                ops_positions.extend(inlined[1])
+        return ops, ops_positions
+
+    for name in list(words):
+        if expand(name) is not None:
+            statistics["inline"] += 1
+            if not silent:
+                print("Optimizer: Inlining word %s" % name)
+
+    for name in list(words):
+        if expanded[name] is None:
+            words[name][:-1], word_positions[name][:-1] = substitute(
+                    words[name][:-1], word_positions[name][:-1])
+    code[:], positions[:] = substitute(code, positions)
+
+    for name in list(words):
+        if expanded[name] is not None:
+            del words[name]
+            del word_positions[name]
+    return code
+
+def eliminate_tail_calls(code, positions=None, silent=True, loops=True):
+    """Turns tail calls and @ ... return loops into jumps.
+
+    A loop "@ <body> return" becomes "<body> <address> jmp", jumping back to
+    the start of the body, if the body has no @, exit, return, jumps or jump
+    targets, so that it never spans the end of the main code or of a word.
+    Calls in the body must return normally. After that, each
+    "call return" becomes "jmp return", so that the called word returns
+    straight to the caller. The return is then never run.
+
+    Neither rewrite changes the length of the code, or any address outside of
+    the loops, so it can be done after addresses have been resolved.
+
+    Args:
+        code: Code in non-native types, with resolved addresses. It is
+            rewritten in place.
+        positions: An optional list of source positions for each instruction,
+            which is kept in step with the code.
+        silent: Flag that controls whether to print optimizations made.
+        loops: Whether to rewrite @ loops. This moves the loop bodies, so it
+            must not be done for code that jumps into them.
+    """
+    at = instructions.lookup(instructions.at)
+    call = instructions.lookup(instructions.call)
+    jmp = instructions.lookup(instructions.jmp)
+    jumps = [jmp, instructions.lookup(instructions.jz),
+             instructions.lookup(instructions.loop)]
+    ret = instructions.lookup(instructions.return_)
+    exit = instructions.lookup(instructions.exit)
+
+    # Constant jump and call targets
+    targets = set(code[address-1] for address, op in enumerate(code)
+                  if address > 0 and op in jumps + [call] and
+                  isinstance(code[address-1], int))
+
+    start = None
+    for address, op in enumerate(code if loops else []):
+        if op == at:
+            start = address
+        elif op in jumps or op == exit or address in targets:
+            start = None
+        elif op == ret and start is not None:
+            code[start:address+1] = code[start+1:address] + [start, jmp]
+            statistics["tail_calls"] += 1
+            if positions is not None:
+                positions[start:address+1] = (positions[start+1:address] +
+                        [positions[address]]*2)
+            if not silent:
+                print("Optimizer: Translated @ loop at %d to %d jmp" %
+                        (start, start))
+            start = None
+
+    for address, op in enumerate(code[:-1]):
+        if op == call and code[address+1] == ret:
+            code[address] = jmp
+            statistics["tail_calls"] += 1
+            if not silent:
+                print("Optimizer: Translated tail call at %d to jmp" % address)
+    return code
+
+def _positions(old, count):
+    """Returns source positions for count instructions that replace
+    instructions with the given old positions.
+
+    The n-th new instruction gets the position of the n-th replaced one, or of
+    the last replaced one if there are more new instructions.
+    """
+    old = old or [None]
+    return [old[min(n, len(old)-1)] for n in range(count)]
+
+def constant_fold(code, silent=True, ignore_errors=True, positions=None):
     """Constant-folds simple expressions like 2 3 + to 5.
 
+    The code is scanned once, from left to right. Each instruction is moved
+    onto an output list, and the rules are tried on the windows that end at
+    it. A rewrite puts its replacement back in front of the remaining input,
+    so that only the neighbourhood of each rewrite is looked at again. E.g.,
+    "2 3 + 5 *" is rewritten to "5 5 *" and then to 25 without starting over.
+
     Args:
-        code: Code in non-native types.
+        code: Code in non-native types. It is rewritten in place.
         silent: Flag that controls whether to print optimizations made.
         ignore_errors: Whether to raise exceptions on found errors.
+        positions: An optional list of source positions for each instruction,
+            which is kept in step with the code.
     """
-    # Loop until we haven't done any optimizations.  E.g., "2 3 + 5 *" will be
-    # optimized to "5 5 *" and in the next iteration to 25.  Yes, this is
-    # extremely slow, big-O wise. We'll fix that some other time. (TODO)
-
-    arithmetic = list(map(instructions.lookup, [
+    arithmetic = set(map(instructions.lookup, [
         instructions.add,
         instructions.bitwise_and,
         instructions.bitwise_or,
@@ -33,10 +336,10 @@ def constant_fold(code, silent=True, ignore_errors=True):
         instructions.sub,
     ]))
 
-    divzero = map(instructions.lookup, [
+    divzero = set(map(instructions.lookup, [
         instructions.div,
         instructions.mod,
-    ])
+    ]))
 
     lookup = instructions.lookup
 
@@ -50,154 +353,638 @@ def constant_fold(code, silent=True, ignore_errors=True):
     def isconstant(op):
         return op is None or interpreter.isconstant(op, quoted=True) or not isfunction(op)
 
-    keep_running = True
-    while keep_running:
-        keep_running = False
-        # Find two consecutive numbes and an arithmetic operator
-        for i, a in enumerate(code):
-            b = code[i+1] if i+1 < len(code) else None
-            c = code[i+2] if i+2 < len(code) else None
-
-            # Constant fold arithmetic operations (TODO: Move to check-func)
-            if interpreter.isnumber(a, b) and c in arithmetic:
-                # Although we can detect division by zero at compile time, we
-                # don't report it here, because the surrounding system doesn't
-                # handle that very well. So just leave it for now.  (NOTE: If
-                # we had an "error" instruction, we could actually transform
-                # the expression to an error, or exit instruction perhaps)
-                if b==0 and c in divzero:
-                    if ignore_errors:
-                        continue
-                    else:
-                        raise errors.CompileError(ZeroDivisionError(
-                            "Division by zero"))
-
-                # Calculate result by running on a machine (lambda vm: ... is
-                # embedded pushes, see compiler)
-                result = interpreter.Machine([lambda vm: vm.push(a), lambda vm:
-                    vm.push(b), instructions.lookup(c)]).run().top
-                del code[i:i+3]
-                code.insert(i, result)
-
-                if not silent:
-                    print("Optimizer: Constant-folded %s %s %s to %s" % (a,b,c,result))
-
-                keep_running = True
-                break
+    def log(message, *args):
+        if not silent:
+            print("Optimizer: " + message % args)
 
-            # Translate <constant> dup to <constant> <constant>
-            if isconstant(a) and b == lookup(instructions.dup):
-                code[i+1] = a
-                if not silent:
-                    print("Optimizer: Translated %s %s to %s %s" % (a,b,a,a))
-                keep_running = True
-                break
+    def fold3(a, b, c):
+        # Constant fold arithmetic operations (TODO: Move to check-func)
+        if interpreter.isnumber(a, b) and c in arithmetic:
+            # Although we can detect division by zero at compile time, we
+            # don't report it here, because the surrounding system doesn't
+            # handle that very well. So just leave it for now.  (NOTE: If
+            # we had an "error" instruction, we could actually transform
+            # the expression to an error, or exit instruction perhaps)
+            if b==0 and c in divzero:
+                if ignore_errors:
+                    return None
+                else:
+                    raise errors.CompileError(ZeroDivisionError(
+                        "Division by zero"))
 
-            # Dead code removal: <constant> drop
-            if isconstant(a) and b == lookup(instructions.drop):
-                del code[i:i+2]
-                if not silent:
-                    print("Optimizer: Removed dead code %s %s" % (a,b))
-                keep_running = True
-                break
+            # Calculate result by running on a machine (lambda vm: ... is
+            # embedded pushes, see compiler)
+            result = interpreter.Machine([lambda vm: vm.push(a), lambda vm:
+                vm.push(b), instructions.lookup(c)]).run().top
+            log("Constant-folded %s %s %s to %s", a, b, c, result)
+            return [result]
 
-            if a == lookup(instructions.nop):
-                del code[i]
-                if not silent:
-                    print("Optimizer: Removed dead code %s" % a)
-                keep_running = True
-                break
+        # <c1> <c2> swap -> <c2> <c1>
+        if isconstant(a) and isconstant(b) and c == lookup(instructions.swap):
+            log("Translated %s %s %s to %s %s", a, b, c, b, a)
+            return [b, a]
 
-            # Dead code removal: <integer> cast_int
-            if isinstance(a, int) and b == lookup(instructions.cast_int):
-                del code[i+1]
-                if not silent:
-                    print("Optimizer: Translated %s %s to %s" % (a,b,a))
-                keep_running = True
-                break
+        # a b over -> a b a
+        if isconstant(a) and isconstant(b) and c == lookup(instructions.over):
+            log("Translated %s %s %s to %s %s %s", a, b, c, a, b, a)
+            return [a, b, a]
 
-            # Dead code removal: <float> cast_float
-            if isinstance(a, float) and b == lookup(instructions.cast_float):
-                del code[i+1]
-                if not silent:
-                    print("Optimizer: Translated %s %s to %s" % (a,b,a))
-                keep_running = True
-                break
+    def fold2(a, b):
+        # Translate <constant> dup to <constant> <constant>
+        if isconstant(a) and b == lookup(instructions.dup):
+            log("Translated %s %s to %s %s", a, b, a, a)
+            return [a, a]
 
-            # Dead code removal: <string> cast_str
-            if isinstance(a, str) and b == lookup(instructions.cast_str):
-                del code[i+1]
-                if not silent:
-                    print("Optimizer: Translated %s %s to %s" % (a,b,a))
-                keep_running = True
-                break
+        # Dead code removal: <constant> drop
+        if isconstant(a) and b == lookup(instructions.drop):
+            log("Removed dead code %s %s", a, b)
+            return []
 
-            # Dead code removal: <boolean> cast_bool
-            if isinstance(a, bool) and b == lookup(instructions.cast_bool):
-                del code[i+1]
-                if not silent:
-                    print("Optimizer: Translated %s %s to %s" % (a,b,a))
-                keep_running = True
-                break
+        # Dead code removal: <integer> cast_int, <float> cast_float,
+        # <string> cast_str and <boolean> cast_bool
+        for kind, cast in [(int, instructions.cast_int),
+                           (float, instructions.cast_float),
+                           (str, instructions.cast_str),
+                           (bool, instructions.cast_bool)]:
+            if type(a) is kind and b == lookup(cast):
+                log("Translated %s %s to %s", a, b, a)
+                return [a]
 
-            # <c1> <c2> swap -> <c2> <c1>
-            if isconstant(a) and isconstant(b) and c == lookup(instructions.swap):
-                del code[i:i+3]
-                code = code[:i] + [b, a] + code[i:]
-                if not silent:
-                    print("Optimizer: Translated %s %s %s to %s %s" %
-                            (a,b,c,b,a))
-                keep_running = True
-                break
+        # "123" cast_int -> 123
+        if interpreter.isstring(a) and b == lookup(instructions.cast_int):
+            try:
+                number = int(a)
+                log("Translated %s %s to %s", a, b, number)
+                return [number]
+            except ValueError:
+                pass
 
-            # a b over -> a b a
-            if isconstant(a) and isconstant(b) and c == lookup(instructions.over):
-                code[i+2] = a
-                if not silent:
-                    print("Optimizer: Translated %s %s %s to %s %s %s" %
-                            (a,b,c,a,b,a))
-                keep_running = True
-                break
+        if isconstant(a) and b == lookup(instructions.cast_str):
+            log("Translated %s %s to %s", a, b, str(a)) # TODO: Try-except here
+            return [str(a)]
 
-            # "123" cast_int -> 123
-            if interpreter.isstring(a) and b == lookup(instructions.cast_int):
-                try:
-                    number = int(a)
-                    del code[i:i+2]
-                    code.insert(i, number)
-                    if not silent:
-                        print("Optimizer: Translated %s %s to %s" % (a, b,
-                            number))
-                    keep_running = True
-                    break
-                except ValueError:
-                    pass
-
-            if isconstant(a) and b == lookup(instructions.cast_str):
-                del code[i:i+2]
-                code.insert(i, str(a)) # TODO: Try-except here
-                if not silent:
-                    print("Optimizer: Translated %s %s to %s" % (a, b, str(a)))
-                keep_running = True
-                break
+        if isconstant(a) and b == lookup(instructions.cast_bool):
+            log("Translated %s %s to %s", a, b, bool(a)) # TODO: Try-except here
+            return [bool(a)]
+
+        if isconstant(a) and b == lookup(instructions.cast_float):
+            try:
+                v = float(a)
+                log("Translated %s %s to %s", a, b, v)
+                return [v]
+            except ValueError:
+                pass
+
+    def fold1(a):
+        if a == lookup(instructions.nop):
+            log("Removed dead code %s", a)
+            return []
+
+    # The worklist holds the remaining input in reverse order, so that taking
+    # the next instruction and putting back a replacement are both cheap.
+    # Windows lying entirely in the output have already been tried, so only
+    # those ending at the newest instruction need to be looked at.
+    worklist = list(reversed(code))
+    worklist_positions = (list(reversed(positions)) if positions is not None
+                          else None)
+    output = []
+    output_positions = []
+
+    while worklist:
+        output.append(worklist.pop())
+        if worklist_positions is not None:
+            output_positions.append(worklist_positions.pop())
 
-            if isconstant(a) and b == lookup(instructions.cast_bool):
-                del code[i:i+2]
-                code.insert(i, bool(a)) # TODO: Try-except here
-                if not silent:
-                    print("Optimizer: Translated %s %s to %s" % (a, b, bool(a)))
-                keep_running = True
+        size = len(output)
+        for start, rule in [(size-3, fold3), (size-2, fold2), (size-1, fold1)]:
+            if start < 0:
+                continue
+            replacement = rule(*output[start:])
+            if replacement is not None:
                 break
+        else:
+            continue
+
+        statistics["constant_fold"] += 1
+        del output[start:]
+        worklist.extend(reversed(replacement))
+        if worklist_positions is not None:
+            old = output_positions[start:]
+            del output_positions[start:]
+            worklist_positions.extend(reversed(_positions(old,
+                len(replacement))))
+
+    code[:] = output
+    if positions is not None:
+        positions[:] = output_positions
+    return code
+
+def _shuffle_effect(ops):
+    """Returns the effect of a run of stack shuffling instruction names as a
+    tuple of the number of values it needs on the stack, and a key that is
+    the same for all runs with the same effect, given enough values."""
+    values = [] # Indices into the values below the run, 0 being the top
+    depth = 0
+    for op in ops:
+        entry = instructions.instruction(op)
+        while len(values) < entry.pops:
+            values.insert(0, depth)
+            depth += 1
+        popped = values[len(values)-entry.pops:]
+        del values[len(values)-entry.pops:]
+        values.extend(popped[i] for i in _shuffles[op])
+
+    # Values at the bottom that are left alone don't matter
+    needed = depth
+    while (len(values) > 0 and values[0] == depth-1 and
+            values.count(depth-1) == 1):
+        values.pop(0)
+        depth -= 1
+    return needed, (depth, tuple(values))
+
+_shortest = {}
+
+def _shortest_shuffles():
+    """Returns a dict mapping the effect key of each run of stack shuffles up
+    to SHUFFLE_SIZE long to the shortest run with that effect, and how many
+    values it needs on the stack."""
+    if SHUFFLE_SIZE not in _shortest:
+        names = sorted(name for name in _shuffles if name != "nop")
+        shortest = {}
+        runs = [()]
+        for length in range(SHUFFLE_SIZE + 1):
+            found = []
+            for run in runs:
+                needed, key = _shuffle_effect(run)
+                if key not in shortest:
+                    shortest[key] = (run, needed)
+                    found.append(run)
+            # Longer runs only need to build on the shortest ones
+            runs = [run + (name,) for run in found for name in names]
+        _shortest[SHUFFLE_SIZE] = shortest
+    return _shortest[SHUFFLE_SIZE]
+
+def _shorten_shuffles(run):
+    """Returns the shortest equivalent of a run of stack shuffling instruction
+    names that is found by replacing parts of it no longer than
+    SHUFFLE_SIZE."""
+    shortest = _shortest_shuffles()
+
+    def replacement(ops):
+        needed, key = _shuffle_effect(ops)
+        if key in shortest:
+            ops2, needed2 = shortest[key]
+            if len(ops2) < len(ops) and needed2 <= needed:
+                return list(ops2)
+        return list(ops)
 
-            if isconstant(a) and b == lookup(instructions.cast_float):
-                try:
-                    v = float(a)
-                    del code[i:i+2]
-                    code.insert(i, v)
-                    if not silent:
-                        print("Optimizer: Translated %s %s to %s" % (a, b, v))
-                    keep_running = True
-                    break
-                except ValueError:
-                    pass
+    # best[i] is the shortest replacement found for run[:i]
+    best = [[]]
+    for end in range(1, len(run) + 1):
+        starts = range(max(0, end - 2*SHUFFLE_SIZE), end)
+        best.append(min((best[start] + replacement(run[start:end])
+                         for start in starts), key=len))
+    return best[-1]
+
+def _shuffle_runs(names, targets=()):
+    """Yields (start, end, replacement) for each maximal run of stack
+    shuffling instruction names that can be made shorter. None marks other
+    instructions, and runs are split at the given indices."""
+    start = 0
+    for index in range(len(names) + 1):
+        if (index == len(names) or names[index] is None or
+                index in targets):
+            if index - start > 0:
+                run = names[start:index]
+                replacement = _shorten_shuffles(run)
+                if len(replacement) < len(run):
+                    yield start, index, replacement
+            start = index
+            if index < len(names) and names[index] is None:
+                start += 1
+
+def shuffle(code, silent=True, positions=None):
+    """Replaces runs of the stack shuffling instructions dup, drop, nop, over,
+    rot and swap with the shortest equivalent run. E.g., "swap swap",
+    "over drop" and "dup drop" are removed, and "rot rot rot swap" becomes
+    "swap".
+
+    The values the instructions work on need not be known. The rewrite assumes
+    that the stack holds enough values for the original run, so a run that
+    would underflow the stack, like "over drop" on a single value, may no
+    longer raise an error.
+
+    Args:
+        code: Code in non-native types. It is rewritten in place.
+        silent: Flag that controls whether to print optimizations made.
+        positions: An optional list of source positions for each instruction,
+            which is kept in step with the code.
+    """
+    names = [op if isinstance(op, str) and op in _shuffles else None
+             for op in code]
+    for start, end, replacement in reversed(list(_shuffle_runs(names))):
+        statistics["shuffle"] += 1
+        if not silent:
+            print("Optimizer: Shuffled %s to %s" % (" ".join(code[start:end]),
+                " ".join(replacement) or "nothing"))
+        if positions is not None:
+            positions[start:end] = _positions(positions[start:end],
+                    len(replacement))
+        code[start:end] = replacement
     return code
+
+def _value_type(value):
+    """Returns the type name of a constant, or None."""
+    if isinstance(value, bool):
+        return "bool"
+    elif isinstance(value, six.integer_types):
+        return "int"
+    elif isinstance(value, float):
+        return "float"
+    elif isinstance(value, six.string_types):
+        return "str"
+    return None
+
+def _result_type(name, operands):
+    """Returns the type name of the value an instruction pushes, given the
+    type names of the values it pops, or None if it is not known."""
+    if name in _result_types:
+        return _result_types[name]
+    elif name == "float":
+        return operands[0] # It only checks the value
+    elif name in ("&", "|", "^") and all(t == "bool" for t in operands):
+        return "bool"
+    elif name in _integral and all(t in ("int", "bool") for t in operands):
+        return "int"
+    elif name in _floating and all(t in ("int", "bool", "float")
+                                   for t in operands):
+        return "float"
+    return None
+
+def _type(items, origins, targets, end, slot=0, budget=16):
+    """Returns the type name of a value on the stack after running
+    items[:end], slot values below the top, or None if it cannot be known.
+
+    Items are (instruction name, None) or (None, constant). Nothing is known
+    about values that flow into jump targets, or that come from unknown
+    instructions. Only budget instructions are looked at.
+    """
+    while end > 0 and budget > 0:
+        if end < len(origins) and origins[end] in targets:
+            return None
+        end -= 1
+        budget -= 1
+        name, value = items[end]
+        if name is None:
+            if slot == 0:
+                return _value_type(value)
+            slot -= 1
+            continue
+
+        try:
+            entry = instructions.instruction(name)
+        except KeyError:
+            return None
+        if entry.control:
+            return None
+        if slot >= entry.pushes:
+            slot += entry.pops - entry.pushes
+        elif name in _shuffles:
+            pattern = _shuffles[name]
+            slot = entry.pops - 1 - pattern[len(pattern) - 1 - slot]
+        else:
+            operands = [_type(items, origins, targets, end, n, budget)
+                        for n in range(entry.pops)]
+            return _result_type(name, operands)
+    return None
+
+def _key(element):
+    """Returns a dictionary key for an instruction name or constant."""
+    if isinstance(element, str):
+        return element
+    return (type(element), element)
+
+_identities_by_last = {}
+for _rule in _identities:
+    _identities_by_last.setdefault(_key(_rule[0][-1]), []).append(_rule)
+
+def _matches(element, item):
+    """Returns whether an item matches a window element of a rule."""
+    name, value = item
+    if isinstance(element, str):
+        return name == element
+    return (name is None and type(value) is type(element) and
+            value == element)
+
+def _simplify(code, items, targets, make, silent):
+    """Applies the algebraic identities to code, described by items (see
+    _type). Rules never span jump targets, given as addresses in code.
+
+    Returns:
+        A tuple of the new code and, for each new instruction, the address of
+        the old instruction it came from.
+    """
+    worklist = list(reversed(list(zip(code, items, range(len(code))))))
+    output = []
+    output_items = []
+    origins = []
+
+    while worklist:
+        op, item, origin = worklist.pop()
+        output.append(op)
+        output_items.append(item)
+        origins.append(origin)
+
+        name, value = item
+        key = name if name is not None else _key(value)
+        try:
+            rules = _identities_by_last.get(key, ())
+        except TypeError:
+            continue # Unhashable constant
+
+        for window, replacement, types in rules:
+            start = len(output) - len(window)
+            if start < 0 or not all(_matches(element, item) for element, item
+                                    in zip(window, output_items[start:])):
+                continue
+            if targets.intersection(origins[start+1:]):
+                continue
+            if not replacement and origins[start] in targets:
+                continue # Keep an instruction at the jump target
+            if types is not None and _type(output_items, origins, targets,
+                    start) not in types:
+                continue
+
+            statistics["simplify"] += 1
+            if not silent:
+                print("Optimizer: Simplified %s to %s" % (
+                    " ".join(str(n if n is not None else v)
+                             for n, v in output_items[start:]),
+                    " ".join(replacement) or "nothing"))
+            old = origins[start:]
+            del output[start:]
+            del output_items[start:]
+            del origins[start:]
+            worklist.extend(reversed(list(zip(
+                [make(name) for name in replacement],
+                [(name, None) for name in replacement],
+                _positions(old, len(replacement))))))
+            break
+
+    return output, origins
+
+def simplify(code, silent=True, positions=None):
+    """Removes algebraic identities like "0 +", "1 *", "true and",
+    "negate negate" and "swap +", and simplifies e.g. "abs abs" to "abs" and
+    "swap <" to ">".
+
+    Most rules only apply if the type of the value they work on is known at
+    compile time, because they would change the type of other values, or
+    errors. E.g., "0 +" is only removed after something that pushes an int,
+    like "read int", "int" or "dup *" on an int.
+
+    Args:
+        code: Code in non-native types. It is rewritten in place.
+        silent: Flag that controls whether to print optimizations made.
+        positions: An optional list of source positions for each instruction,
+            which is kept in step with the code.
+    """
+    items = []
+    for op in code:
+        if interpreter.isstring(op, quoted=True):
+            items.append((None, op[1:-1]))
+        elif isinstance(op, str):
+            items.append((op, None))
+        else:
+            items.append((None, op))
+
+    output, origins = _simplify(code, items, set(), lambda name: name,
+            silent)
+    code[:] = output
+    if positions is not None:
+        positions[:] = [positions[origin] for origin in origins]
+    return code
+
+def _jump_targets(code):
+    """Returns the set of addresses that the code jumps or calls to, or None
+    if any jmp or call may take an address that is not pushed right before
+    it."""
+    from crianza import compiler
+
+    targets = set()
+    for address, op in enumerate(code):
+        if op in _jumps:
+            push = code[address-1] if address > 0 else None
+            if not compiler.is_embedded_push(push):
+                return None
+            target = compiler.get_embedded_push_value(push)
+            if type(target) is not int:
+                return None
+            targets.add(target)
+
+    # Returning or jumping straight to a jmp or call skips its push
+    returns = set(address + 1 for address, op in enumerate(code)
+                  if op is instructions.call)
+    if any(0 <= t < len(code) and code[t] in _jumps
+           for t in targets.union(returns)):
+        return None
+    return targets
+
+def _fold_native(code, targets, silent, ignore_errors):
+    """Folds unfused native code, given its jump targets.
+
+    Returns:
+        A tuple of the new code and, for each new instruction, the address of
+        the old instruction it came from.
+    """
+    from crianza import compiler
+
+    machine = interpreter.Machine([], output=None)
+    output = []
+    origins = []
+    pushes = 0 # Number of embedded pushes at the end of the output
+
+    for address, op in enumerate(code):
+        entry = _pure.get(op)
+        if entry is None or entry.pops > pushes:
+            output.append(op)
+            origins.append(address)
+            pushes = pushes + 1 if compiler.is_embedded_push(op) else 0
+            continue
+
+        # Don't fold across an address that is jumped to
+        start = len(output) - entry.pops
+        inside = origins[start+1:] + ([address] if entry.pops > 0 else [])
+        if targets.intersection(inside):
+            output.append(op)
+            origins.append(address)
+            pushes = 0
+            continue
+
+        values = [compiler.get_embedded_push_value(push)
+                  for push in output[start:]]
+        machine.data_stack = stack.Stack(list(values))
+        try:
+            op(machine)
+            results = machine.stack
+        except Exception as error:
+            if not ignore_errors:
+                raise errors.CompileError(error)
+            results = None
+
+        # Keep at least one instruction at each jump target
+        first = origins[start] if entry.pops > 0 else address
+        if results is None or (not results and first in targets):
+            output.append(op)
+            origins.append(address)
+            pushes = 0
+            continue
+
+        replacement = [compiler.make_embedded_push(v) for v in results]
+        statistics["constant_fold"] += 1
+        if not silent:
+            window = interpreter.code_to_string(output[start:] + [op])
+            if replacement:
+                print("Optimizer: Folded %s to %s" % (window,
+                    interpreter.code_to_string(replacement)))
+            else:
+                print("Optimizer: Removed dead code %s" % window)
+
+        old = origins[start:] + [address]
+        del output[start:]
+        del origins[start:]
+        output.extend(replacement)
+        origins.extend(_positions(old, len(replacement)))
+        pushes += len(results) - entry.pops
+
+    return output, origins
+
+def _simplify_native(code, origins, targets, silent):
+    """Like simplify(), but for native code with the given origins (see
+    _fold_native). Returns the new code and origins."""
+    from crianza import compiler
+
+    items = []
+    for op in code:
+        if compiler.is_embedded_push(op):
+            items.append((None, compiler.get_embedded_push_value(op)))
+        else:
+            try:
+                items.append((instructions.instruction(op).name, None))
+            except KeyError:
+                items.append(("?", None)) # Unknown instruction
+
+    splits = set(bisect.bisect_left(origins, t) for t in targets)
+    output, new_origins = _simplify(code, items, splits, instructions.lookup,
+            silent)
+    return output, [origins[origin] for origin in new_origins]
+
+def _shuffle_native(code, origins, targets, silent):
+    """Like shuffle(), but for native code with the given origins (see
+    _fold_native), which are kept in step with it. Runs are not shuffled
+    across jump targets."""
+    functions = dict((instructions.lookup(name), name) for name in _shuffles)
+    names = [functions.get(op) for op in code]
+    splits = set(bisect.bisect_left(origins, t) for t in targets)
+
+    for start, end, replacement in reversed(list(_shuffle_runs(names,
+            splits))):
+        # Keep at least one instruction at each jump target
+        if not replacement and start in splits:
+            continue
+        statistics["shuffle"] += 1
+        if not silent:
+            print("Optimizer: Shuffled %s to %s" % (
+                " ".join(names[start:end]), " ".join(replacement) or "nothing"))
+        code[start:end] = [instructions.lookup(name) for name in replacement]
+        origins[start:end] = _positions(origins[start:end], len(replacement))
+    return code, origins
+
+def _relocate(address, origins, length):
+    """Returns the new address of an old one, given the origins of the new
+    code and the length of the old code."""
+    if 0 <= address < length:
+        return bisect.bisect_left(origins, address)
+    elif address >= length:
+        return address - length + len(origins)
+    return address
+
+def native_fold(code, silent=True, ignore_errors=True, positions=None,
+        passes=None):
+    """Constant-folds native code, as returned by crianza.compile() or
+    genetic.randomize().
+
+    Each pure instruction (see instructions.registry) whose operands are all
+    pushed right before it is run at compile time and replaced with pushes of
+    its results. E.g., "2 3 + dup" becomes "5 5", and "nop" is removed. Then
+    algebraic identities and runs of stack shuffles are simplified, like
+    simplify() and shuffle() do.
+
+    Jump and call addresses are relocated, and folding never crosses an
+    address that is jumped to. This requires each jmp and call to be preceded
+    by a push of its address, as the compiler emits them. Other code is
+    returned unchanged. Superinstructions are always unfused.
+
+    Args:
+        code: Native code. It is not changed.
+        silent: Flag that controls whether to print optimizations made.
+        ignore_errors: Whether to raise exceptions on instructions that fail
+            at compile time, or leave them to fail at run time.
+        positions: An optional list of source positions for each instruction,
+            which is kept in step with the code.
+        passes: A passes.PassManager that chooses the constant_fold, simplify
+            and shuffle passes to run and records their statistics. Defaults
+            to all of them.
+
+    Returns:
+        A new list of native code.
+    """
+    from crianza import compiler
+
+    if passes is None:
+        passes = PassManager()
+
+    code = superinstructions.unfused(code)
+    targets = _jump_targets(code)
+    if targets is None:
+        return code
+
+    output, origins = list(code), list(range(len(code)))
+    if passes.enabled("constant_fold"):
+        output, origins = passes.run("constant_fold", _fold_native, output,
+                targets, silent, ignore_errors)
+    if passes.enabled("simplify"):
+        output, origins = passes.run("simplify", _simplify_native, output,
+                origins, targets, silent)
+    if passes.enabled("shuffle"):
+        output, origins = passes.run("shuffle", _shuffle_native, output,
+                origins, targets, silent)
+    for index, op in enumerate(output[1:]):
+        if op in _jumps:
+            address = compiler.get_embedded_push_value(output[index])
+            output[index] = compiler.make_embedded_push(_relocate(address,
+                origins, len(code)))
+
+    if positions is not None:
+        positions[:] = [positions[origin] for origin in origins]
+    return output
+
+def optimize_program(prog, silent=True, ignore_errors=True, passes=None):
+    """Returns an optimized copy of a Program, with its symbols and debug
+    information relocated. See native_fold()."""
+    from crianza import debug
+
+    code = prog.to_code()
+    positions = list(range(len(code)))
+    code = native_fold(code, silent=silent, ignore_errors=ignore_errors,
+            positions=positions, passes=passes)
+
+    symbols = dict((name, _relocate(address, positions, len(prog)))
+                   for name, address in prog.symbols.items())
+
+    info = None
+    if prog.debug is not None:
+        info = debug.DebugInfo([prog.debug.position(address)
+                                for address in positions], symbols)
+
+    return program.assemble(code, symbols=symbols, debug=info)
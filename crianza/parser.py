@@ -7,25 +7,31 @@ except ImportError:
     from io import StringIO
 
 
-def parse(source):
+def parse(source, positions=False):
     """Parses source code returns an array of instructions suitable for
     optimization and execution by a Machine.
 
     Args:
         source: A string or stream containing source code.
+        positions: If True, return a tuple of the code and a list with the
+            (line, column) of each instruction.
     """
     if isinstance(source, str):
-        return parse_stream(six.StringIO(source))
+        return parse_stream(six.StringIO(source), positions=positions)
     else:
-        return parse_stream(source)
+        return parse_stream(source, positions=positions)
 
-def parse_stream(stream):
+def parse_stream(stream, positions=False):
     """Parse a Forth-like language and return code."""
     code = []
+    locations = []
 
     for (line, col, (token, value)) in Tokenizer(stream).tokenize():
         if token == Tokenizer.STRING:
             value = '"' + value + '"'
         code.append(value)
+        locations.append((line, col))
 
+    if positions:
+        return code, locations
     return code
@@ -0,0 +1,138 @@
+"""
+Contains the pass manager, which decides which optimization passes the compiler
+runs and records statistics for each of them.
+
+The passes, in the order the compiler runs them, are:
+
+    inline             Inlines small words (see optimizer.inline)
+    constant_fold      Folds constant expressions (optimizer.constant_fold)
+    simplify           Removes algebraic identities (optimizer.simplify)
+    shuffle            Shortens runs of stack shuffles (optimizer.shuffle)
+    tail_calls         Turns tail calls and @ loops into jumps
+                       (optimizer.eliminate_tail_calls)
+    superinstructions  Fuses common sequences (superinstructions.fuse)
+    branches           Makes direct branches (branches.direct)
+
+An optimization level turns on the passes up to that level, as listed in
+PASSES. Passes can also be chosen by name:
+
+    passes = crianza.passes.PassManager(level=3, disable=["inline"])
+    code = crianza.compile(crianza.parse(source), passes=passes)
+    passes.report()
+"""
+
+from crianza import errors
+import collections
+import sys
+import timeit
+
+# The passes in the order they are run, and the lowest optimization level
+# that turns each one on
+PASSES = collections.OrderedDict([
+    ("inline",            2),
+    ("constant_fold",     1),
+    ("simplify",          1),
+    ("shuffle",           1),
+    ("tail_calls",        2),
+    ("superinstructions", 3),
+    ("branches",          3),
+])
+
+
+def rewrites(name):
+    """Returns the number of rewrites a pass has made so far in this
+    process."""
+    from crianza import branches
+    from crianza import optimizer
+    from crianza import superinstructions
+
+    if name == "superinstructions":
+        return sum(superinstructions.statistics.values())
+    elif name == "branches":
+        return sum(branches.statistics.values())
+    return optimizer.statistics[name]
+
+
+class PassStatistics(object):
+    """Statistics for one optimization pass."""
+
+    def __init__(self, name):
+        self.name = name
+        self.runs = 0
+        self.seconds = 0.0
+        self.before = 0 # Instructions going into the pass
+        self.after = 0 # Instructions coming out of it
+        self.rewrites = 0
+
+    def __repr__(self):
+        return ("<PassStatistics %s: runs=%d seconds=%f before=%d after=%d "
+                "rewrites=%d>" % (self.name, self.runs, self.seconds,
+                    self.before, self.after, self.rewrites))
+
+
+class PassManager(object):
+    """Chooses optimization passes and runs them, keeping statistics for each
+    pass."""
+
+    def __init__(self, level=1, passes=None, disable=()):
+        """
+        Args:
+            level: An optimization level, used if passes is None.
+            passes: Names of the passes to run, instead of those for level.
+            disable: Names of passes not to run.
+
+        Raises:
+            CompileError: For unknown pass names.
+        """
+        if passes is None:
+            passes = [name for name, minimum in PASSES.items()
+                      if int(level) >= minimum]
+        passes = list(passes)
+        disable = list(disable)
+
+        for name in passes + disable:
+            if name not in PASSES:
+                raise errors.CompileError("Unknown optimization pass '%s'" %
+                        name)
+
+        self.passes = [name for name in PASSES
+                       if name in passes and name not in disable]
+        self.statistics = collections.OrderedDict()
+
+    def enabled(self, name):
+        """Returns whether the named pass should be run."""
+        return name in self.passes
+
+    def run(self, name, function, code, *args, **kwargs):
+        """Runs function(code, *args, **kwargs) as the named pass and returns
+        its result. Instructions are counted as the length of code before,
+        and the length of the result, or its first item if it is a tuple,
+        after."""
+        stats = self.statistics.get(name)
+        if stats is None:
+            stats = self.statistics[name] = PassStatistics(name)
+
+        before = len(code)
+        count = rewrites(name)
+        start = timeit.default_timer()
+        result = function(code, *args, **kwargs)
+        stats.seconds += timeit.default_timer() - start
+        stats.rewrites += rewrites(name) - count
+        stats.runs += 1
+        stats.before += before
+        stats.after += len(result[0] if isinstance(result, tuple) else result)
+        return result
+
+    def report(self, out=sys.stdout):
+        """Writes a table of the statistics of each pass that has run."""
+        out.write("%-18s %6s %12s %8s %8s %9s\n" % ("Pass", "Runs",
+            "Seconds", "Before", "After", "Rewrites"))
+        for name in PASSES:
+            if name in self.statistics:
+                stats = self.statistics[name]
+                out.write("%-18s %6d %12.6f %8d %8d %9d\n" % (name,
+                    stats.runs, stats.seconds, stats.before, stats.after,
+                    stats.rewrites))
+
+    def __repr__(self):
+        return "PassManager(passes=%r)" % self.passes
@@ -0,0 +1,202 @@
+"""
+Contains an execution profiler for the virtual machine.
+
+The profiler counts how many times each instruction is executed and how much
+wall time it takes, per code address. Results can be summed up per opcode,
+attributed to subroutines, or written as collapsed stacks for flame graph
+tools.
+
+Profiling uses its own run loop, so that Machine.run is not slowed down when
+it is not used:
+
+    program = crianza.compile(crianza.parse(source), assemble=True)
+    profiler = crianza.profiler.Profiler()
+    crianza.Machine(program).run(profiler=profiler)
+    profiler.report()
+"""
+
+from crianza import instructions
+from crianza import interpreter
+from crianza import program
+from crianza import superinstructions
+import bisect
+import collections
+import sys
+import timeit
+
+MAIN = "main"
+
+
+class Profiler(object):
+    """Collects instruction counts and times from runs of a Machine."""
+
+    def __init__(self, symbols=None, timer=timeit.default_timer):
+        """
+        Args:
+            symbols: A dict mapping subroutine names to addresses, used to
+                attribute addresses to subroutines. Defaults to the symbols of
+                the Program being run, or of the machine's debug information.
+            timer: A function returning the current time in seconds.
+        """
+        self.symbols = symbols
+        self.timer = timer
+        self.reset()
+
+    def reset(self):
+        """Clears collected data."""
+        self.code = None
+        self.counts = collections.defaultdict(int)
+        self.times = collections.defaultdict(float)
+        self.stacks = collections.defaultdict(float)
+
+    def run(self, machine, steps=None):
+        """Runs code on the machine, like Machine.run, while collecting data.
+
+        Args:
+            steps: If specified, run that many number of instructions before
+            stopping.
+        """
+        code = machine._threaded_code()
+        self.code = code
+        if self.symbols is None and isinstance(machine.code, program.Program):
+            self.symbols = machine.code.symbols
+        if self.symbols is None and machine.debug is not None:
+            self.symbols = machine.debug.symbols
+
+        counts = self.counts
+        times = self.times
+        stacks = self.stacks
+        timer = self.timer
+        return_stack = machine.return_stack._values
+        length = len(code)
+        remaining = steps if steps is not None and steps > 0 else -1
+
+        # Stacks are keyed by the return addresses only, not by the limits
+        # and indices that do puts on the return stack for counted loops
+        do = instructions.do
+        loops = [False]*len(return_stack)
+        frames = tuple(return_stack)
+
+        try:
+            ip = machine.instruction_pointer
+            while ip < length and remaining != 0:
+                op = code[ip]
+                if remaining > 0:
+                    # Superinstructions count like in Machine.run
+                    n = superinstructions.size(op)
+                    if n > remaining:
+                        op = superinstructions.get_original(op)
+                        n = 1
+                    remaining -= n
+                machine.instruction_pointer = ip + 1
+                start = timer()
+                try:
+                    op(machine)
+                finally:
+                    elapsed = timer() - start
+                    counts[ip] += 1
+                    times[ip] += elapsed
+                    stacks[(frames, ip)] += elapsed
+                if len(return_stack) != len(loops):
+                    del loops[len(return_stack):]
+                    loops.extend([op is do]*(len(return_stack) - len(loops)))
+                    frames = tuple(a for a, loop in zip(return_stack, loops)
+                                   if not loop)
+                ip = machine.instruction_pointer
+        except StopIteration:
+            pass
+        except EOFError:
+            pass
+        return machine
+
+    def subroutine(self, address):
+        """Returns the name of the subroutine containing the address."""
+        symbols = sorted((a, n) for n, a in (self.symbols or {}).items())
+        index = bisect.bisect_right([a for a, _ in symbols], address) - 1
+        return symbols[index][1] if index >= 0 else MAIN
+
+    def caller(self, address):
+        """Returns the name of the subroutine that pushed an address on the
+        return stack. This is the address after a call, or the address of an
+        @."""
+        if self.code[address] is instructions.at:
+            return self.subroutine(address)
+        return self.subroutine(address - 1)
+
+    def name(self, address):
+        """Returns the instruction at an address as a string."""
+        op = self.code[address]
+        if superinstructions.is_superinstruction(op):
+            op = superinstructions.get_original(op)
+        return interpreter.code_to_string([op])
+
+    def opcode(self, address):
+        """Returns the opcode name for the instruction at an address, where
+        constants are all called "push" and superinstructions by what they
+        fused, like "dup *"."""
+        op = self.code[address]
+        if superinstructions.is_superinstruction(op):
+            return op.name
+        try:
+            return instructions.instruction(op).name
+        except KeyError:
+            return "push"
+
+    def addresses(self):
+        """Returns (address, instruction, subroutine, count, seconds) for each
+        executed address, most time consuming first."""
+        rows = [(a, self.name(a), self.subroutine(a), self.counts[a],
+                 self.times[a]) for a in self.counts]
+        return sorted(rows, key=lambda r: (-r[4], r[0]))
+
+    def opcodes(self):
+        """Returns (opcode, count, seconds) for each executed opcode, most time
+        consuming first."""
+        counts = collections.defaultdict(int)
+        times = collections.defaultdict(float)
+        for address in self.counts:
+            name = self.opcode(address)
+            counts[name] += self.counts[address]
+            times[name] += self.times[address]
+        return sorted(((n, counts[n], times[n]) for n in counts),
+                      key=lambda r: (-r[2], r[0]))
+
+    def report(self, out=sys.stdout, limit=None):
+        """Writes tables of time spent per opcode and per address."""
+        total = sum(self.times.values()) or 1.0
+
+        out.write("%-12s %10s %12s %7s\n" % ("Opcode", "Count", "Seconds",
+            "Time%"))
+        for name, count, seconds in self.opcodes()[:limit]:
+            out.write("%-12s %10d %12.6f %6.2f%%\n" % (name, count, seconds,
+                100.0*seconds/total))
+
+        out.write("\n%-8s %-12s %-16s %10s %12s %7s\n" % ("Address",
+            "Instruction", "Subroutine", "Count", "Seconds", "Time%"))
+        for address, name, sub, count, seconds in self.addresses()[:limit]:
+            out.write("%-8d %-12s %-16s %10d %12.6f %6.2f%%\n" % (address,
+                name[:12], sub[:16], count, seconds, 100.0*seconds/total))
+
+    def collapsed(self, out=sys.stdout, scale=1e6):
+        """Writes collapsed stacks, one "main;sub1;sub2 <value>" line per
+        stack, as read by flamegraph.pl and similar tools.
+
+        Frames come from the return addresses on the return stack. Since @
+        loops also push addresses there, consecutive frames of the same
+        subroutine are merged into one.
+        Values are seconds multiplied by scale, rounded to integers
+        (microseconds by default).
+        """
+        totals = collections.defaultdict(float)
+        for (stack, address), seconds in self.stacks.items():
+            frames = [MAIN] + [self.caller(a) for a in stack
+                               if isinstance(a, int) and 0 <= a < len(self.code)]
+            frames.append(self.subroutine(address))
+            collapsed = [frames[0]]
+            for frame in frames[1:]:
+                if frame != collapsed[-1]:
+                    collapsed.append(frame)
+            totals[";".join(collapsed)] += seconds
+
+        for stack in sorted(totals):
+            out.write("%s %d\n" % (stack, int(round(totals[stack]*scale))))
@@ -0,0 +1,155 @@
+"""
+Contains a compact representation of compiled code.
+
+A Program stores each instruction as a number in an array. Numbers below
+len(OPCODES) are instructions, and the rest push a value from a deduplicated
+constant pool, so that every instruction still takes up exactly one slot and
+jump addresses stay the same as for the corresponding native code.
+
+Programs can be compared, hashed and pickled, and a Machine can run them
+directly:
+
+    program = crianza.compile(crianza.parse("2 3 + ."), assemble=True)
+    crianza.Machine(program).run()
+"""
+
+from crianza import errors
+from crianza import instructions
+from crianza import superinstructions
+import array
+
+# Instruction names, in opcode order
+OPCODES = tuple(entry.name for entry in instructions.registry)
+
+_opcode = dict((entry.function, entry.opcode)
+               for entry in instructions.registry)
+
+
+def _key(value):
+    """Returns a key that tells apart constants that compare equal, but have
+    different types or representations (e.g., 1, 1.0, True and 0.0, -0.0)."""
+    return (type(value), repr(value))
+
+def typecode(count):
+    """Returns the smallest array typecode that can hold the given number of
+    distinct words."""
+    for code in ["B", "H", "L"]:
+        if count <= 2**(8*array.array(code).itemsize):
+            return code
+    raise errors.CompileError("Program too large: %d distinct words" % count)
+
+
+class Program(object):
+    """Compiled code stored as an opcode array, a constant pool and a symbol
+    table."""
+
+    def __init__(self, words, constants=(), symbols=None, debug=None):
+        """
+        Args:
+            words: An array of opcodes and constant references.
+            constants: The constant pool.
+            symbols: A dict mapping subroutine names to addresses.
+            debug: An optional debug.DebugInfo for the program.
+        """
+        self.words = words
+        self.constants = tuple(constants)
+        self.symbols = dict(symbols) if symbols is not None else {}
+        self.debug = debug
+        self._threaded = None
+
+    @property
+    def table(self):
+        """Returns a list mapping each word to its instruction function."""
+        from crianza import compiler
+        return [entry.function for entry in instructions.registry] + \
+               [compiler.make_embedded_push(c) for c in self.constants]
+
+    @property
+    def threaded(self):
+        """Returns the program as a list of instruction functions that a
+        Machine can run. The list is built once and cached."""
+        if self._threaded is None:
+            table = self.table
+            self._threaded = [table[w] for w in self.words]
+        return self._threaded
+
+    def to_code(self):
+        """Returns the program as a new list of native code."""
+        return list(self.threaded)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, index):
+        return self.threaded[index]
+
+    def __iter__(self):
+        return iter(self.threaded)
+
+    def __eq__(self, other):
+        if not isinstance(other, Program):
+            return NotImplemented
+        return (list(self.words) == list(other.words) and
+                list(map(_key, self.constants)) ==
+                list(map(_key, other.constants)))
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash((tuple(self.words), tuple(map(_key, self.constants))))
+
+    def __getstate__(self):
+        return {"words": self.words,
+                "constants": self.constants,
+                "symbols": self.symbols,
+                "debug": self.debug}
+
+    def __setstate__(self, state):
+        self.__init__(state["words"], state["constants"], state["symbols"],
+                state.get("debug"))
+
+    def __repr__(self):
+        return "<Program: %d words (%s) %d constants %d symbols>" % (
+                len(self.words), self.words.typecode, len(self.constants),
+                len(self.symbols))
+
+
+def assemble(code, symbols=None, debug=None):
+    """Converts native code to a Program.
+
+    Superinstructions are stored as the instructions they replaced.
+
+    Args:
+        code: Native code, as returned by crianza.compile().
+        symbols: An optional dict mapping subroutine names to addresses.
+        debug: An optional debug.DebugInfo for the code.
+
+    Raises:
+        CompileError: If the code contains unknown instructions.
+    """
+    from crianza import compiler
+
+    constants = []
+    index = {}
+    values = []
+
+    for address, op in enumerate(superinstructions.unfused(code)):
+        if compiler.is_embedded_push(op):
+            value = compiler.get_embedded_push_value(op)
+            key = _key(value)
+            if key not in index:
+                index[key] = len(constants)
+                constants.append(value)
+            values.append(-1 - index[key])
+        elif op in _opcode:
+            values.append(_opcode[op])
+        else:
+            raise errors.CompileError("Cannot assemble instruction at index "
+                    "%d: %s" % (address, op))
+
+    base = len(OPCODES)
+    words = array.array(typecode(base + len(constants)),
+            [v if v >= 0 else base - 1 - v for v in values])
+    return Program(words, constants, symbols, debug)
@@ -3,6 +3,7 @@ import sys
 from crianza.compiler import compile, is_embedded_push, get_embedded_push_value
 from crianza.errors import ParseError, MachineError, CompileError
 from crianza.parser import parse
+from crianza.superinstructions import is_superinstruction, get_original
 from crianza.interpreter import isstring, Machine
 
 
@@ -14,6 +15,9 @@ def print_code(vm, out=sys.stdout, ops_per_line=8, registers=True):
         out.write("RS: %s\n" % str(vm.return_stack))
 
     def to_str(op):
+        if is_superinstruction(op):
+            op = get_original(op)
+
         if is_embedded_push(op):
             op = get_embedded_push_value(op)
 
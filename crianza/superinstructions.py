@@ -0,0 +1,210 @@
+"""
+Contains superinstructions, fused implementations of common instruction
+sequences.
+
+A superinstruction replaces the first instruction of a sequence such as
+"dup *" and executes the whole sequence in one dispatch. The remaining
+instructions are left in place, so that the code keeps its length and any jump
+into the middle of the sequence still works. A superinstruction then skips past
+them by advancing the instruction pointer.
+
+Each superinstruction has a fast path for the common case (e.g., numbers on
+the stack) and falls back to running the original instructions one by one
+otherwise, so that errors and stack state are the same as without fusion.
+A fused sequence counts as one step for each instruction in it when Machine.run
+is given a number of steps, so that code runs as far fused as unfused.
+"""
+
+from crianza import instructions
+import collections
+import sys
+
+SUPERINSTRUCTION_TAG = "superinstruction"
+
+# How many times each fusion has been applied by fuse()
+statistics = collections.Counter()
+
+# Marks a pattern position that matches an embedded push of a number
+CONSTANT = object()
+
+_number = (int, float)
+
+
+def _make(name, original, ops, fast):
+    """Wraps a fast-path function into a tagged superinstruction."""
+    length = len(ops)
+
+    def fallback(vm):
+        ops[0](vm)
+        for op in ops[1:]:
+            vm.instruction_pointer += 1
+            op(vm)
+
+    def superinstruction(vm):
+        if fast(vm.data_stack._values):
+            vm.instruction_pointer += length - 1
+        else:
+            fallback(vm)
+
+    superinstruction.tag = SUPERINSTRUCTION_TAG
+    superinstruction.name = name
+    superinstruction.original = original
+    superinstruction.ops = tuple(ops)
+    return superinstruction
+
+def dup_mul(constants):
+    """( a -- a*a )"""
+    def fast(values):
+        if values and isinstance(values[-1], _number):
+            values[-1] = values[-1] * values[-1]
+            return True
+        return False
+    return fast
+
+def dup_add(constants):
+    """( a -- a+a )"""
+    def fast(values):
+        if values and isinstance(values[-1], _number):
+            values[-1] = values[-1] + values[-1]
+            return True
+        return False
+    return fast
+
+def swap_over_add(constants):
+    """( a b -- b b+a )"""
+    def fast(values):
+        if (len(values) > 1 and isinstance(values[-1], _number) and
+                isinstance(values[-2], _number)):
+            a = values[-2]
+            b = values[-1]
+            values[-2] = b
+            values[-1] = b + a
+            return True
+        return False
+    return fast
+
+def over_over(constants):
+    """( a b -- a b a b )"""
+    def fast(values):
+        if len(values) > 1:
+            values.extend(values[-2:])
+            return True
+        return False
+    return fast
+
+def const_add(constants):
+    """( a -- c+a )"""
+    c = constants[0]
+    def fast(values):
+        if values and isinstance(values[-1], _number):
+            values[-1] = c + values[-1]
+            return True
+        return False
+    return fast
+
+def const_sub(constants):
+    """( a -- a-c )"""
+    c = constants[0]
+    def fast(values):
+        if values and isinstance(values[-1], _number):
+            values[-1] = values[-1] - c
+            return True
+        return False
+    return fast
+
+def const_mul(constants):
+    """( a -- c*a )"""
+    c = constants[0]
+    def fast(values):
+        if values and isinstance(values[-1], _number):
+            values[-1] = c * values[-1]
+            return True
+        return False
+    return fast
+
+# Patterns are matched in order, so longer ones should come first
+patterns = [
+    ("swap over +", (instructions.swap, instructions.over, instructions.add),
+        swap_over_add),
+    ("over over",   (instructions.over, instructions.over), over_over),
+    ("dup *",       (instructions.dup, instructions.mul), dup_mul),
+    ("dup +",       (instructions.dup, instructions.add), dup_add),
+    ("<const> +",   (CONSTANT, instructions.add), const_add),
+    ("<const> -",   (CONSTANT, instructions.sub), const_sub),
+    ("<const> *",   (CONSTANT, instructions.mul), const_mul),
+]
+
+def is_superinstruction(obj):
+    """Checks if an instruction object is a superinstruction."""
+    return (callable(obj) and hasattr(obj, "tag") and
+            obj.tag == SUPERINSTRUCTION_TAG)
+
+def get_original(obj):
+    """Returns the instruction that a superinstruction replaced."""
+    assert(is_superinstruction(obj))
+    return obj.original
+
+def size(op):
+    """Returns the number of steps an instruction counts as: the length of the
+    sequence a superinstruction replaced, or 1."""
+    return len(op.ops) if is_superinstruction(op) else 1
+
+def unfused(code):
+    """Returns a copy of the code with superinstructions replaced by the
+    instructions they replaced."""
+    return [get_original(op) if is_superinstruction(op) else op for op in code]
+
+def match(code, index, pattern):
+    """Returns the embedded constants if the pattern matches at the given
+    index, otherwise None."""
+    from crianza import compiler
+
+    if index + len(pattern) > len(code):
+        return None
+
+    constants = []
+    for op, want in zip(code[index:], pattern):
+        if want is CONSTANT:
+            if not compiler.is_embedded_push(op):
+                return None
+            value = compiler.get_embedded_push_value(op)
+            if isinstance(value, bool) or not isinstance(value, _number):
+                return None
+            constants.append(value)
+        elif op is not want:
+            return None
+    return constants
+
+def fuse(code, silent=True):
+    """Replaces common instruction sequences in native code with
+    superinstructions.
+
+    Args:
+        code: Native code, as returned by compiler.native_types().
+        silent: If False, print each fusion made.
+
+    Returns:
+        A new list of the same length as the input.
+    """
+    out = list(code)
+    i = 0
+    while i < len(out):
+        for name, pattern, factory in patterns:
+            constants = match(out, i, pattern)
+            if constants is not None:
+                ops = out[i:i+len(pattern)]
+                out[i] = _make(name, out[i], ops, factory(constants))
+                statistics[name] += 1
+                if not silent:
+                    print("Superinstruction: Fused %s at index %d" % (name, i))
+                i += len(pattern)
+                break
+        else:
+            i += 1
+    return out
+
+def print_statistics(out=sys.stdout):
+    """Prints a table of how many times each fusion has been applied."""
+    width = max(len(name) for name, _, _ in patterns)
+    for name, _, _ in patterns:
+        out.write("%-*s  %d\n" % (width, name, statistics[name]))
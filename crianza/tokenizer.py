@@ -44,6 +44,9 @@ class Tokenizer:
             else:
                 if len(v) == 0:
                     v.append((col, char))
+                elif v[-1][1] == "":
+                    # First character after whitespace starts a new part
+                    v[-1] = (col, char)
                 else:
                     col, part = v[-1]
                     v[-1] = (col, part + char)
@@ -20,10 +20,10 @@ class DoubleInput(gp.GeneticMachine):
         return DoubleInput(*args, **kw)
 
     def randomize(self, **kw):
-        ops = map(crianza.instructions.lookup, ["%", "&", "*", "+", "-", "/",
+        ops = list(map(crianza.instructions.lookup, ["%", "&", "*", "+", "-", "/",
             "<", "<>", "=", ">", "^", "abs", "and", "bool", "drop", "dup",
             "false", "if", "int", "negate", "not", "or", "over", "rot", "swap",
-            "true", "|", "~"])
+            "true", "|", "~"]))
 
         return super(DoubleInput, self).randomize(number_string_ratio=1.0,
                 instruction_ratio=0.75, restrict_to=ops)
@@ -56,8 +56,9 @@ class DoubleInput(gp.GeneticMachine):
 
     @staticmethod
     def stop(iterations, generation):
-        best = sorted(generation, key=lambda m: m.score())
-        return gp.average(best, lambda s: s.score()) == 0.0
+        if any(m.fitness is None for m in generation):
+            return False
+        return gp.average(generation, lambda m: m.fitness) == 0.0
 
 
 if __name__ == "__main__":
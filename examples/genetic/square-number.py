@@ -22,10 +22,10 @@ class DoubleInput(gp.GeneticMachine):
         return DoubleInput(*args, **kw)
 
     def randomize(self, **kw):
-        ops = map(crianza.instructions.lookup, ["%", "&", "*", "+", "-", "/",
+        ops = list(map(crianza.instructions.lookup, ["%", "&", "*", "+", "-", "/",
             "<", "<>", "=", ">", "^", "abs", "and", "bool", "drop", "dup",
             "false", "if", "int", "negate", "not", "or", "over", "rot", "swap",
-            "true", "|", "~"])
+            "true", "|", "~"]))
         return super(DoubleInput, self).randomize(number_string_ratio=1.0,
                 instruction_ratio=0.75, restrict_to=ops)
 
@@ -63,8 +63,9 @@ class DoubleInput(gp.GeneticMachine):
 
     @staticmethod
     def stop(iterations, generation):
-        best = sorted(generation, key=lambda m: m.score())
-        return gp.average(best, lambda s: s.score()) <= 0.00000012
+        if any(m.fitness is None for m in generation):
+            return False
+        return gp.average(generation, lambda m: m.fitness) <= 0.00000012
 
 
 def splitlines(code, width):
@@ -105,7 +106,7 @@ if __name__ == "__main__":
     print("Example output:\n")
     correct = 0
     tries = 5
-    for n in xrange(tries):
+    for n in range(tries):
         n = random.randint(0, 1000)
         try:
             r = crianza.execute("%d %s" % (n, best.code_string)).top
@@ -15,6 +15,7 @@ setup(
     zip_safe=True,
     test_suite="tests",
     install_requires=["six"],
+    extras_require={"batch": ["numpy"]},
 
     keywords=["vm", "virtual machine", "genetic programming", "interpreter",
         "forth", "programming", "code", "bytecode", "assembler", "native",
@@ -4,9 +4,16 @@ except ImportError:
     from io import StringIO
 
 import crianza
+import crianza.cache
+import crianza.genetic
+import crianza.jit
+import crianza.profiler
 import operator
+import pickle
 import random
+import shutil
 import sys
+import tempfile
 import unittest
 import six
 
@@ -16,6 +23,12 @@ try:
 except ImportError:
     CRIANZA_NATIVE = False
 
+try:
+    from crianza import batch
+    CRIANZA_BATCH = True
+except ImportError:
+    CRIANZA_BATCH = False
+
 fibonacci_source = \
 """
 # The Fibonacci Sequence
@@ -95,6 +108,303 @@ class TestCrianza(unittest.TestCase):
         self.assertEqual(crianza.constant_fold([1, 123, "str"]), [1, "123"])
         self.assertEqual(crianza.constant_fold([1, "112", "int"]), [1, 112])
         self.assertEqual(crianza.constant_fold([1, 123, "str", "int"]), [1, 123])
+        self.assertEqual(crianza.constant_fold([1, 0, "/", 2, 0, "%", 3]),
+                         [1, 0, "/", 2, 0, "%", 3])
+        self.assertEqual(crianza.constant_fold([1] + [1, "+"]*5000), [5001])
+
+        positions = [(1, n) for n in range(6)]
+        code = crianza.constant_fold(["nop", 2, 3, "+", "dup", "."],
+                positions=positions)
+        self.assertEqual(code, [5, 5, "."])
+        self.assertEqual(positions, [(1, 1), (1, 4), (1, 5)])
+
+    def test_native_optimizer(self):
+        source = crianza.parse(": square dup * ; 2 3 + square nop 4 swap . .")
+        code = crianza.compile(source, optimize=False)
+        folded = crianza.optimized(code)
+        self.assertEqual(crianza.code_to_string(folded),
+                         "5 8 call 4 swap . . exit dup * return")
+
+        fout = six.StringIO()
+        crianza.Machine(folded, output=fout).run()
+        self.assertEqual(fout.getvalue(), "25\n4\n")
+
+        # Programs are returned as Programs, with relocated symbols
+        program = crianza.optimized(crianza.compile(source, optimize=False,
+            assemble=True))
+        self.assertIsInstance(program, crianza.Program)
+        self.assertEqual(program.symbols, {"square": 8})
+        self.assertEqual(crianza.code_to_string(program),
+                         crianza.code_to_string(folded))
+
+        # Folding stops at jump targets, and addresses are relocated
+        code = crianza.compile(crianza.parse("1 2 + 6 jmp nop 4 + 5 +"),
+                optimize=False)
+        folded = crianza.native_fold(code)
+        self.assertEqual(crianza.code_to_string(folded), "3 3 jmp 4 + 5 +")
+        self.assertEqual(crianza.Machine(folded).run().stack, [12])
+
+        # Code with computed addresses is left alone
+        code = crianza.compile(crianza.parse("2 3 + jmp nop"), optimize=False)
+        self.assertEqual(crianza.native_fold(code), code)
+
+        # Errors are left for run time, unless asked for
+        code = crianza.compile(crianza.parse('"a" 1 +'), optimize=False)
+        self.assertEqual(crianza.native_fold(code), code)
+        self.assertRaises(crianza.CompileError,
+                lambda: crianza.native_fold(code, ignore_errors=False))
+
+    def test_shuffle(self):
+        shuffle = crianza.optimizer.shuffle
+        runs = {
+            "swap swap": "",
+            "rot rot rot": "",
+            "over drop": "",
+            "dup drop": "",
+            "nop": "",
+            "swap drop": "swap drop",
+            "rot rot": "rot rot",
+            "rot rot rot swap": "swap",
+            "swap over swap": "dup rot",
+            "dup swap swap dup drop": "dup",
+            "read swap swap . over drop": "read .",
+        }
+        for run, expected in runs.items():
+            self.assertEqual(" ".join(shuffle(run.split())), expected)
+
+        positions = [(1, n) for n in range(6)]
+        self.assertEqual(shuffle(crianza.parse("1 2 over drop swap ."),
+            positions=positions), [1, 2, "swap", "."])
+        self.assertEqual(positions, [(1, 0), (1, 1), (1, 2), (1, 5)])
+
+        # Shuffles are shortened for the same results
+        for source in ["1 2 3 rot rot rot swap", "1 2 swap over swap"]:
+            self.assertEqual(crianza.eval(source, optimize=False),
+                             crianza.eval(" ".join(shuffle(source.split())),
+                                 optimize=False))
+
+        # Constants brought together by removing shuffles are folded
+        code = crianza.parse("read 2 over drop 3 +")
+        self.assertEqual(crianza.optimized(code), ["read", 5])
+
+        # Native code is shuffled too, but not across jump targets
+        code = crianza.compile(crianza.parse("read read swap swap 7 jmp "
+            "swap swap over drop dup drop"), optimize=False)
+        self.assertEqual(crianza.code_to_string(crianza.native_fold(code)),
+                         "read read 5 jmp swap swap")
+
+    def test_simplify(self):
+        simplify = crianza.optimizer.simplify
+        sources = {
+            "read int 0 + 1 *": "read int",
+            "read int dup * negate negate 0 |": "read int dup *",
+            "read read = true and not not": "read read =",
+            "read abs abs str str": "read abs str",
+            "read read swap + swap <": "read read + >",
+            "read int float": "read int",
+            "read str": "read",
+            # Unknown types, or types the rules would change
+            "read 0 +": "read 0 +",
+            "read float 1 /": "read float 1 /",
+            "read read = 0 +": "read read = 0 +",
+            "read int 0.0 +": "read int 0.0 +",
+        }
+        for source, expected in sources.items():
+            self.assertEqual(" ".join(map(str,
+                simplify(crianza.parse(source)))), expected)
+
+        positions = [(1, n) for n in range(6)]
+        self.assertEqual(simplify(["read", "int", 0, "+", "swap", "*"],
+            positions=positions), ["read", "int", "*"])
+        self.assertEqual(positions, [(1, 0), (1, 1), (1, 4)])
+
+        # A bool cast of True is kept (True int is 1)
+        self.assertEqual(crianza.eval("true false or int", optimize=True), 1)
+
+        # Native code is simplified too, but not across jump targets
+        code = crianza.compile(crianza.parse("read int 0 + 7 jmp 0 + 1 *"),
+                optimize=False)
+        self.assertEqual(crianza.code_to_string(crianza.native_fold(code)),
+                         "read int 5 jmp 0 + 1 *")
+
+    def test_pass_manager(self):
+        self.assertEqual(crianza.PassManager(0).passes, [])
+        self.assertEqual(crianza.PassManager(1).passes,
+                         ["constant_fold", "simplify", "shuffle"])
+        self.assertEqual(crianza.PassManager(3, disable=["inline"]).passes,
+                         ["constant_fold", "simplify", "shuffle",
+                          "tail_calls", "superinstructions", "branches"])
+        self.assertEqual(crianza.PassManager(0, passes=["shuffle",
+            "simplify"]).passes, ["simplify", "shuffle"])
+        self.assertRaises(crianza.CompileError, crianza.PassManager,
+                passes=["fold"])
+
+        source = crianza.parse(": sq dup * ; read int 0 + sq swap swap .")
+        passes = crianza.PassManager(2)
+        code = crianza.compile(list(source), passes=passes)
+        self.assertEqual(crianza.code_to_string(code), "read int dup * .")
+        self.assertEqual(list(passes.statistics),
+                         ["inline", "constant_fold", "simplify", "shuffle",
+                          "tail_calls"])
+        stats = passes.statistics["simplify"]
+        self.assertEqual((stats.runs, stats.before, stats.after,
+                          stats.rewrites), (2, 14, 12, 1))
+        self.assertEqual(passes.statistics["shuffle"].rewrites, 1)
+        self.assertEqual(passes.statistics["inline"].rewrites, 1)
+        self.assertTrue(all(stats.seconds >= 0
+                            for stats in passes.statistics.values()))
+
+        fout = six.StringIO()
+        passes.report(out=fout)
+        lines = fout.getvalue().splitlines()
+        self.assertEqual(lines[0].split(), ["Pass", "Runs", "Seconds",
+                                            "Before", "After", "Rewrites"])
+        self.assertEqual(len(lines), 6)
+
+        # Passes can be turned off one by one
+        passes = crianza.PassManager(2, disable=["simplify", "inline"])
+        code = crianza.compile(list(source), passes=passes)
+        self.assertEqual(crianza.code_to_string(code),
+                         "read int 0 + 8 call . exit dup * return")
+
+    def test_inline(self):
+        source = crianza.parse(": square dup * ; : quad square square ; "
+                               ": count dup 0 > if count ; 3 quad .")
+        code = crianza.compile(list(source), optimize=2)
+        self.assertEqual(crianza.code_to_string(code),
+                         "81 . exit dup 0 > if 3 jmp return")
+
+        fout = six.StringIO()
+        crianza.Machine(code, output=fout).run()
+        self.assertEqual(fout.getvalue(), "81\n")
+
+        # Words above the size threshold are called
+        program = crianza.compile(list(source), optimize=2, inline_size=2,
+                assemble=True)
+        self.assertEqual(sorted(program.symbols), ["count", "quad"])
+        self.assertEqual(crianza.Machine(program, output=None).run().stack, [])
+
+        # Words using control instructions are not inlined
+        code = crianza.compile(crianza.parse(": loop @ 1 + return ; loop"),
+                optimize=2)
+        self.assertEqual(crianza.code_to_string(code),
+                         "3 call exit 1 + 3 jmp return")
+
+        # Fibonacci gives the same output when inlined
+        fout = six.StringIO()
+        code = crianza.compile(crianza.parse(fibonacci_source), optimize=2)
+        crianza.Machine(code, output=fout).run(50)
+        self.assertTrue(fout.getvalue().startswith("0\n1\n1\n2\n3\n5\n8\n"))
+
+    def test_tail_calls(self):
+        # Mutual recursion in tail position does not grow the return stack
+        source = crianza.parse(": ping 1 + pong ; : pong 1 + ping ; 0 ping")
+        machine = crianza.Machine(crianza.compile(list(source), optimize=2))
+        machine.run(1000)
+        self.assertEqual(len(machine.return_stack), 1)
+        self.assertGreater(machine.stack[0], 100)
+
+        machine = crianza.Machine(crianza.compile(list(source), optimize=1))
+        machine.run(1000)
+        self.assertGreater(len(machine.return_stack), 100)
+
+        # @ loops become backward jumps
+        code = crianza.compile(crianza.parse(fibonacci_source), optimize=2,
+                inline_size=0)
+        self.assertEqual(crianza.code_to_string(code).split()[6:],
+                         "16 call 13 call 6 jmp exit dup . return swap over "
+                         "+ return".split())
+
+        fout = six.StringIO()
+        machine = crianza.Machine(code, output=fout)
+        machine.run(200)
+        self.assertEqual(len(machine.return_stack), 0)
+        self.assertTrue(fout.getvalue().startswith("0\n1\n1\n2\n3\n5\n8\n"))
+
+        # Loops without a return of their own do not reach into words
+        compile = lambda source: crianza.compile(crianza.parse(source),
+                optimize=2, inline_size=0)
+        code = compile(": foo 1 + ; 0 @ foo .")
+        self.assertEqual(crianza.code_to_string(code),
+                         "0 @ 6 call . exit 1 + return")
+        fout = six.StringIO()
+        crianza.Machine(code, output=fout).run()
+        self.assertEqual(fout.getvalue(), "1\n")
+        self.assertEqual(crianza.code_to_string(compile(": foo 1 + ; 0 @ .")),
+                         "0 @ . exit 1 + return")
+
+    def test_direct_branches(self):
+        with open("examples/fib.src", "rt") as f:
+            source = f.read()
+        plain = crianza.compile(crianza.parse(source), optimize=2)
+        direct = crianza.compile(crianza.parse(source), optimize=3)
+        self.assertEqual(len(plain), len(direct))
+        self.assertEqual(crianza.code_to_string(plain),
+                         crianza.code_to_string(direct))
+        self.assertTrue(any(getattr(op, "name", None) ==
+                            "<address> <address> if jmp" for op in direct))
+
+        def output(code):
+            fout = six.StringIO()
+            try:
+                crianza.Machine(code, output=fout).run()
+            except crianza.MachineError:
+                pass # Python 2 longs are not numbers
+            return fout.getvalue()
+
+        self.assertEqual(output(plain), output(direct))
+        self.assertTrue(output(direct).startswith("0\n1\n1\n2\n3\n5\n8\n"))
+
+        # Calls push the same return address
+        code = crianza.compile(crianza.parse(": two 2 ; two 3"), optimize=3)
+        machine = crianza.Machine(code).run()
+        self.assertEqual(machine.stack, [2, 3])
+
+        # Bad addresses are still reported when jumping
+        code = crianza.compile(crianza.parse("100 jmp"), optimize=3)
+        self.assertRaises(crianza.MachineError, crianza.Machine(code).run)
+        code = crianza.compile(crianza.parse('"a" jmp'), optimize=3)
+        self.assertRaises(crianza.MachineError, crianza.Machine(code).run)
+
+    def test_structured(self):
+        code = crianza.compile(crianza.parse("1 if 2 else 3 then"),
+                optimize=False)
+        self.assertEqual(crianza.code_to_string(code),
+                         "1 6 jz 2 7 jmp 3 nop")
+
+        sources = {
+            "1 if 10 else 20 then 0 if 30 else 40 then": [10, 40],
+            "0 if 1 then": [],
+            "true false 1 2 if": [True, 2], # if without then is the instruction
+            "3 begin dup 1 - dup 0 = until": [3, 2, 1, 0],
+            "3 begin dup 0 < while dup 1 - repeat": [3, 2, 1, 0],
+            "0 4 0 do i + loop": [6],
+            "0 3 0 do 2 0 do i + loop loop": [3],
+            "0 5 2 do i + loop 7": [9, 7],
+            ": sign 0 < if 1 else -1 then ; -2 sign 2 sign": [-1, 1],
+            ": sum 0 swap 0 do i + loop ; 5 sum 3 sum": [10, 3],
+            ": while rot ; 1 2 3 while": [2, 3, 1], # words shadow control
+            ": loop 1 + ; 2 loop": [3], # and the instructions they use
+            ": i 1 + ; 2 i": [3],
+            ": do 1 ; do": [1],
+            ": jz 2 * ; 3 jz": [6],
+            ": i 10 ; 0 3 0 do i + loop": [30],
+        }
+        for source, stack in sources.items():
+            for level in range(4):
+                machine = crianza.execute(source, optimize=level)
+                self.assertEqual(machine.stack, stack)
+
+        for source in ["1 if 2 else", "begin", "then", "1 until",
+                       "begin 1 repeat", "do", "loop", "1 if 2 else 3 else"]:
+            self.assertRaises(crianza.CompileError, crianza.compile,
+                    crianza.parse(source))
+
+        # Direct branches
+        code = crianza.compile(crianza.parse("0 4 0 do i + loop"), optimize=3)
+        self.assertTrue(any(getattr(op, "name", None) == "<address> loop"
+                            for op in code))
+        self.assertEqual(crianza.Machine(code).run().stack, [6])
 
     def test_program_fibonacci(self):
         code = crianza.compile(crianza.parse(fibonacci_source))
@@ -118,6 +428,255 @@ class TestCrianza(unittest.TestCase):
         self.assertEqual(sequence, [1, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144,
             233, 377, 610])
 
+    def test_run_steps(self):
+        code = crianza.compile(crianza.parse(fibonacci_source))
+
+        # Running n steps should be the same as calling step() n times
+        for n in [1, 2, 11, 13, 50]:
+            a = crianza.Machine(code, output=None).run(n)
+            b = crianza.Machine(code, output=None)
+            for _ in range(n):
+                b.step()
+            self.assertEqual(a.instruction_pointer, b.instruction_pointer)
+            self.assertEqual(a.stack, b.stack)
+            self.assertEqual(a.return_stack, b.return_stack)
+
+        # Zero or negative step counts means no limit
+        for n in [0, -1]:
+            m = crianza.Machine(crianza.compile(crianza.parse("1 2 3 + +")))
+            self.assertEqual(m.run(n).stack, [6])
+
+    def test_superinstructions(self):
+        source = "2 3 dup * 4 + swap over + over over 10 - 3 *"
+        plain = crianza.compile(crianza.parse(source), optimize=False)
+        fused = crianza.compile(crianza.parse(source), optimize=False,
+                fuse=True)
+
+        self.assertEqual(len(plain), len(fused))
+        self.assertEqual(crianza.code_to_string(plain),
+                crianza.code_to_string(fused))
+        self.assertEqual(crianza.Machine(plain).run().stack,
+                         crianza.Machine(fused).run().stack)
+        self.assertGreater(crianza.superinstructions.statistics["dup *"], 0)
+
+        # Jumping into the middle of a fused sequence still works
+        code = crianza.compile(crianza.parse("3 3 5 jmp dup * 5 +"),
+                optimize=False, fuse=True)
+        self.assertEqual(crianza.Machine(code).run().stack, [14])
+
+        # Fallbacks should give the same errors as unfused code
+        code = crianza.compile(crianza.parse('"a" dup *'), optimize=False,
+                fuse=True)
+        self.assertRaises(crianza.MachineError, crianza.Machine(code).run)
+
+    def test_program(self):
+        source = crianza.parse(fibonacci_source)
+        code = crianza.compile(source)
+        program = crianza.compile(source, assemble=True)
+
+        self.assertIsInstance(program, crianza.Program)
+        self.assertEqual(len(program), len(code))
+        self.assertEqual(program.words.typecode, "B")
+        self.assertEqual(crianza.code_to_string(program),
+                         crianza.code_to_string(code))
+        self.assertEqual(sorted(program.symbols), ["next", "println"])
+
+        fout = six.StringIO()
+        crianza.Machine(program, output=fout).run(100)
+        self.assertTrue(fout.getvalue().startswith("0\n1\n1\n2\n3\n5\n8\n"))
+
+        # Constants that compare equal are kept apart in the pool
+        program = crianza.assemble(crianza.compile(
+            crianza.parse("1 1 1.0 true 2 1"), optimize=False))
+        self.assertEqual(len(program.constants), 4)
+        self.assertEqual(crianza.Machine(program).run().stack,
+                         [1, 1, 1.0, True, 2, 1])
+        self.assertEqual(list(map(type, crianza.Machine(program).run().stack)),
+                         [int, int, float, bool, int, int])
+
+        copy = pickle.loads(pickle.dumps(program))
+        self.assertEqual(copy, program)
+        self.assertEqual(hash(copy), hash(program))
+
+    def test_disk_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = crianza.cache.DiskCache(directory)
+            source = fibonacci_source + ' "hello" 2.5 true 1234567890'
+            first = cache.compile(source)
+            second = cache.compile(source)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertEqual(first, second)
+            self.assertEqual(first.symbols, second.symbols)
+            self.assertEqual(second.debug.symbols, second.symbols)
+            address = second.symbols["next"]
+            self.assertEqual(second.debug.word(address), "next")
+            self.assertEqual(first.debug.word(address), "next")
+            self.assertEqual(list(map(type, first.constants)),
+                             list(map(type, second.constants)))
+
+            # Different flags are different entries
+            cache.compile(source, optimize=False)
+            self.assertEqual(cache.misses, 2)
+
+            # Corrupt entries are misses
+            key = cache.key("1 2 +", optimize=True)
+            with open(cache.path(key), "wb") as file:
+                file.write(b"CRZP\x01")
+            self.assertEqual(cache.load(key), None)
+            self.assertEqual(crianza.eval("1 2 +", cache=cache), 3)
+            self.assertEqual(cache.load(key), crianza.assemble(
+                crianza.compile(crianza.parse("1 2 +"))))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_compile_cache(self):
+        cache = crianza.cache.CompileCache(maxsize=2)
+        self.assertEqual(crianza.eval("2 3 *", cache=cache), 6)
+        self.assertEqual(crianza.eval("2 3 *", cache=cache), 6)
+        self.assertEqual(crianza.eval("2 3 *", optimize=False, cache=cache), 6)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        # Changing returned code does not change the cache
+        code = cache.compile("1 2 +")
+        code[0] = None
+        self.assertEqual(crianza.Machine(cache.compile("1 2 +")).run().top, 3)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(crianza.eval("2 3 *", cache=cache), 6)
+        self.assertEqual((cache.misses, cache.evictions), (4, 2))
+
+        cache.maxsize = 0
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(crianza.eval("2 3 *", cache=cache), 6)
+        self.assertEqual(len(cache), 0)
+
+    def test_profiler(self):
+        program = crianza.compile(crianza.parse(fibonacci_source),
+                assemble=True)
+        profiler = crianza.profiler.Profiler()
+        machine = crianza.Machine(program, output=None).run(50,
+                profiler=profiler)
+
+        # Profiling does not change how the code runs
+        plain = crianza.Machine(program, output=None).run(50)
+        self.assertEqual(machine.stack, plain.stack)
+        self.assertEqual(machine.instruction_pointer,
+                         plain.instruction_pointer)
+
+        self.assertEqual(sum(profiler.counts.values()), 50)
+        opcodes = dict((name, count) for name, count, _ in profiler.opcodes())
+        self.assertEqual(opcodes["@"], 3)
+        subroutines = set(sub for _, _, sub, _, _ in profiler.addresses())
+        self.assertEqual(subroutines, set(["main", "next", "println"]))
+
+        out = six.StringIO()
+        profiler.collapsed(out=out)
+        stacks = [line.rsplit(" ", 1)[0] for line in
+                  out.getvalue().splitlines()]
+        self.assertEqual(stacks, ["main", "main;next", "main;println"])
+
+        # Counted loops keep their index on the return stack, but not in the
+        # profiled stacks
+        program = crianza.compile(crianza.parse(
+            ": body 1 + ; 0 3000 0 do body loop"), assemble=True)
+        profiler = crianza.profiler.Profiler()
+        machine = crianza.Machine(program).run(profiler=profiler)
+        self.assertEqual(machine.stack, [3000])
+        self.assertTrue(len(profiler.stacks) <= len(program))
+        out = six.StringIO()
+        profiler.collapsed(out=out)
+        stacks = [line.rsplit(" ", 1)[0] for line in
+                  out.getvalue().splitlines()]
+        self.assertEqual(stacks, ["main", "main;body"])
+
+        # Fused code is profiled as it is, with superinstructions by name
+        code = crianza.compile(crianza.parse(
+            ": body 1 + ; 0 30 0 do body loop"), optimize=3)
+        profiler = crianza.profiler.Profiler()
+        crianza.Machine(code).run(profiler=profiler)
+        opcodes = dict((name, count) for name, count, _ in profiler.opcodes())
+        self.assertEqual(opcodes["<address> call"], 30)
+        self.assertEqual(opcodes["<const> +"], 30)
+
+    def test_debug_info(self):
+        source = ": square\n  dup * ;\n2 3 + square\n  1 2 swap"
+        code, positions = crianza.parse(source, positions=True)
+        self.assertEqual(positions[:3], [(1, 1), (1, 3), (2, 3)])
+
+        # Positions survive constant folding and other rewrites
+        debug = crianza.DebugInfo()
+        code = crianza.compile(code, positions=positions, debug=debug)
+        self.assertEqual(crianza.code_to_string(code),
+                "5 6 call 2 1 exit dup * return")
+        self.assertEqual(len(debug), len(code))
+        self.assertEqual(debug[0], (None, 3, 1))
+        self.assertEqual(debug[2], (None, 3, 7))
+        self.assertEqual(debug[3], (None, 4, 3))
+        self.assertEqual(debug[4], (None, 4, 5))
+        self.assertEqual(debug[5], (None, None, None))
+        self.assertEqual(debug[7], ("square", 2, 7))
+        self.assertEqual(debug.symbols, {"square": 6})
+        debug.add_symbols({"cube": 9})
+        self.assertEqual((debug.word(5), debug.word(8), debug.word(9)),
+                         (None, "square", "cube"))
+
+        # Runtime errors point at the source
+        code, positions = crianza.parse(": f drop ;\nf", positions=True)
+        program = crianza.compile(code, positions=positions,
+                debug=crianza.DebugInfo(), assemble=True)
+        try:
+            crianza.Machine(program).run()
+            self.fail("Expected MachineError")
+        except crianza.MachineError as e:
+            self.assertIn("(line 1, column 5 in f)", str(e))
+
+    def test_instruction_registry(self):
+        registry = crianza.instructions.registry
+        self.assertEqual(len(registry),
+                         len(crianza.instructions.default_instructions))
+
+        for opcode, entry in enumerate(registry):
+            self.assertIsInstance(entry, crianza.Instruction)
+            self.assertEqual(entry.opcode, opcode)
+            self.assertEqual(crianza.lookup(entry.name), entry.function)
+            self.assertEqual(crianza.lookup(entry.function), entry.name)
+            for key in [entry.name, entry.function, entry.opcode]:
+                self.assertIs(crianza.instructions.instruction(key), entry)
+
+            # Pure instructions have the stack effect they claim to have
+            if entry.pure:
+                machine = crianza.Machine([entry.function])
+                machine.data_stack = crianza.Stack([True]*(entry.pops + 1))
+                machine.run()
+                self.assertEqual(len(machine.stack), entry.pops + 1 + entry.effect,
+                        entry.name)
+
+        dup = crianza.instructions.instruction("dup")
+        self.assertEqual((dup.arity, dup.pops, dup.pushes), (1, 1, 2))
+        self.assertTrue(crianza.instructions.instruction("jmp").branches)
+        self.assertTrue(crianza.instructions.instruction(".").io)
+        self.assertFalse(crianza.instructions.instruction("+").io)
+        self.assertRaises(KeyError, crianza.instructions.instruction, "foo")
+
+        # Misses raise at once, and custom sets are still searched
+        push = crianza.compiler.make_embedded_push(1)
+        self.assertRaises(KeyError, crianza.lookup, push)
+        self.assertEqual(crianza.lookup(push, {"one": push}), "one")
+
+        # Instructions added after import are still found
+        def triple(vm):
+            vm.push(3*vm.pop())
+        crianza.instructions.default_instructions["triple"] = triple
+        try:
+            self.assertEqual(crianza.lookup(triple), "triple")
+            code = crianza.compile(crianza.parse("2 triple"), optimize=False)
+            self.assertEqual(crianza.code_to_string(code), "2 triple")
+            self.assertEqual(crianza.Machine(code).run().stack, [6])
+        finally:
+            del crianza.instructions.default_instructions["triple"]
+
     def test_io(self):
         fin = six.StringIO("Input line 1.\nInput line 2.")
         fout = six.StringIO()
@@ -193,6 +752,57 @@ class TestCrianza(unittest.TestCase):
         self.assertEqual(m.return_stack, crianza.Stack([6]))
 
 
+class TestCrianzaJit(unittest.TestCase):
+    def _compare(self, source, steps=None, optimize=False):
+        code = crianza.compile(crianza.parse(source), optimize=optimize)
+
+        def run(machine):
+            try:
+                machine.run(steps)
+                return (None, machine.instruction_pointer, machine.stack,
+                        machine.return_stack)
+            except crianza.MachineError as e:
+                return (str(e), machine.instruction_pointer, machine.stack,
+                        machine.return_stack)
+
+        expected = run(crianza.Machine(code, output=None))
+        self.assertEqual(run(crianza.jit.JitMachine(code, output=None)),
+                expected)
+        return expected
+
+    def test_arithmetic(self):
+        self._compare("2 3 + 4 * 7 - 3 / 2 %")
+        self._compare("1 2 3 rot swap over dup drop - + 5 <")
+        self._compare(": sq dup * ; 2 sq sq 1.5 sq 3 sq +")
+
+    def test_steps(self):
+        for steps in [1, 2, 5, 11, 13, 50, 100]:
+            self._compare(fibonacci_source, steps=steps, optimize=True)
+        self._compare("0 @ 1 + 3 * 7 % return", steps=1000)
+
+    def test_fused_steps(self):
+        # Superinstructions and direct branches count as the instructions they
+        # replaced, so fused code stops where unfused code does
+        source = ": sq dup * ; 0 5 0 do i sq + 3 + loop 2 *"
+        code = crianza.compile(crianza.parse(source), optimize=3)
+        self.assertTrue(any(crianza.superinstructions.is_superinstruction(op)
+                            for op in code))
+        plain = crianza.superinstructions.unfused(code)
+        for steps in range(1, 80):
+            machine = crianza.Machine(plain, output=None).run(steps)
+            self.assertEqual(self._compare(source, steps=steps, optimize=3),
+                    (None, machine.instruction_pointer, machine.stack,
+                     machine.return_stack))
+
+    def test_fallback(self):
+        # Guards fail and the interpreter takes over with the same state
+        self.assertEqual(self._compare('"b" "a" < 1 2 +')[2], [True, 3])
+        self.assertIsNotNone(self._compare('1 2 "x" * 3 +')[0])
+        self.assertIsNotNone(self._compare('1 2 0 / 3 +')[0])
+        self.assertIsNotNone(self._compare('1 + 2 +')[0])
+        self.assertEqual(self._compare('dup drop 1')[2], [1])
+
+
 class TestCrianzaNative(unittest.TestCase):
     @unittest.skipUnless(CRIANZA_NATIVE, "crianza.native unsupported")
     def test_mul2(self):
@@ -204,13 +814,307 @@ class TestCrianzaNative(unittest.TestCase):
         self.assertEqual(mul2.__doc__, "Multiplies number with two.")
         self.assertEqual(mul2.__name__, "mul2")
 
-        for n in xrange(100):
+        for n in range(100):
             self.assertEqual(n*2, mul2(n))
 
         for __ in range(10):
             n = random.randint(-1000000, 1000000)
             self.assertEqual(n*2, mul2(n))
 
+    @unittest.skipUnless(CRIANZA_NATIVE, "crianza.native unsupported")
+    def test_subroutines_and_loops(self):
+        source = """
+        : step swap 1 - swap over 0 = ;
+        100 0 3 + 7 * 1000 % step 14 2 if jmp
+        """
+        code = crianza.compile(crianza.parse(source), optimize=False)
+        func = crianza.native.compile(code)
+        self.assertFalse(func.interpreted)
+        self.assertEqual(func(), crianza.Machine(code).run().top)
+
+        fout = six.StringIO()
+        with open("tests/subroutine-1.source", "rt") as f:
+            code = crianza.compile(crianza.parse(f))
+        self.assertEqual(crianza.native.compile(code, output=fout)(), 0)
+        self.assertEqual(fout.getvalue(), "one\ntwo\nthree\n144\nfinished\n")
+
+    @unittest.skipUnless(CRIANZA_NATIVE, "crianza.native unsupported")
+    def test_structured(self):
+        source = ": sum 0 swap 0 do i + loop ; 0 10 begin dup while 1 - " \
+                 "swap over sum + swap repeat drop"
+        for level in range(4):
+            code = crianza.compile(crianza.parse(source), optimize=level)
+            func = crianza.native.compile(code)
+            self.assertFalse(func.interpreted)
+            self.assertEqual(func(), 120)
+
+    @unittest.skipUnless(CRIANZA_NATIVE, "crianza.native unsupported")
+    def test_dynamic_jumps(self):
+        code = crianza.compile(crianza.parse("5 + jmp 1 2 3 4 5 6 7"))
+        func = crianza.native.compile(code, args=1)
+        self.assertTrue(func.interpreted)
+        self.assertEqual(func(2), 7)
+        self.assertEqual(func(-1), crianza.eval("4 jmp 1 2 3 4 5 6 7")[-1])
+
+
+@unittest.skipUnless(CRIANZA_BATCH, "crianza.batch requires numpy")
+class TestCrianzaBatch(unittest.TestCase):
+    def compare(self, source, inputs, steps=None, optimize=False):
+        code = crianza.compile(crianza.parse(source), optimize=optimize)
+        result = batch.run(code, [inputs], steps=steps)
+        for lane, value in enumerate(inputs):
+            m = crianza.Machine(code, output=None)
+            m.data_stack = crianza.Stack([value])
+            error = False
+            try:
+                m.run(steps)
+            except crianza.MachineError:
+                error = True
+            self.assertEqual(result.stack(lane), m.stack)
+            self.assertEqual(result.errors[lane], error)
+            self.assertEqual(result.return_depth[lane], len(m.return_stack))
+        return result
+
+    def test_arithmetic(self):
+        result = self.compare("dup * 1 +", [0, 1, 2, 3])
+        self.assertEqual(list(result.top), [1.0, 2.0, 5.0, 10.0])
+        self.assertEqual(list(result.depth), [1, 1, 1, 1])
+        self.compare("2 * 3 - 7 %", [-5, 0, 5, 10])
+        self.compare("dup 0.5 * swap 3 > not", [1, 4])
+        self.compare("10 swap /", [0, 1, 4])
+        self.compare("dup 1 swap 2.5 if", [0, 1, 2])
+
+    def test_errors(self):
+        result = self.compare("+", [1, 2])
+        self.assertEqual(list(result.errors), [True, True])
+        self.assertEqual(list(result.depth), [0, 0])
+        self.compare("1 swap / 2", [0, 1])
+        self.compare("not", [1])
+
+    def test_branches(self):
+        self.compare("3 < if 10 else 20 then", [1, 3, 5])
+        self.compare("0 swap 0 do i + loop", [0, 1, 5, 10])
+        self.compare("begin 1 - dup 0 = until 7", [1, 3, 20], steps=30)
+
+        # Fused code stops after as many steps as the batch
+        for steps in range(1, 40):
+            self.compare("0 swap 0 do i dup * + 3 + loop", [1, 4], steps=steps,
+                    optimize=3)
+
+    def test_fallback(self):
+        # Integers that do not fit in 64 bits, strings and None
+        self.compare("dup * dup *", [3, 2**20])
+        self.compare('"two" swap', [1, 2])
+        self.compare("drop dup", [1])
+
+
+class DoubleInput(crianza.genetic.GeneticMachine):
+    """Evolves programs that double their input."""
+
+    def __init__(self, code=[]):
+        super(DoubleInput, self).__init__(code)
+        self._input = 0
+
+    def new(self, *args, **kw):
+        return DoubleInput(*args, **kw)
+
+    def randomize(self, **kw):
+        ops = list(map(crianza.instructions.lookup,
+            ["*", "+", "-", "drop", "dup", "over", "swap"]))
+        return super(DoubleInput, self).randomize(ints=(0, 9),
+                number_string_ratio=1.0, instruction_ratio=0.75,
+                restrict_to=ops)
+
+    def setUp(self):
+        self._orig = self.code
+        self._input = random.randint(0, 100)
+        self.code = [crianza.compiler.make_embedded_push(self._input)] + self.code
+
+    def tearDown(self):
+        self.code = self._orig
+
+    def score(self):
+        top = self.top if crianza.isnumber(self.top) else 9999
+        return abs(top - 2*self._input) + 1000*self._error + len(self.stack)
+
+
+class DoubleSeven(DoubleInput):
+    """Evolves programs that double the number seven."""
+
+    def new(self, *args, **kw):
+        return DoubleSeven(*args, **kw)
+
+    def setUp(self):
+        self._orig = self.code
+        self._input = 7
+        self.code = [crianza.compiler.make_embedded_push(7)] + self.code
+
+
+class TestCrianzaGenetic(unittest.TestCase):
+    def evolve(self, MachineClass=DoubleInput, generations=3,
+            survival_rate=0.25, **kw):
+        random.seed(1)
+        stop = lambda iterations, generation: iterations >= generations
+        survivors = crianza.genetic.iterate(MachineClass, stop, machines=40,
+                survival_rate=survival_rate, silent=True, **kw)
+        return [(m.code_string, m.fitness) for m in survivors]
+
+    def test_genome(self):
+        code = crianza.compile(crianza.parse('1 "two" 3.5 dup +'),
+                optimize=False)
+        genome = crianza.genetic.encode(code)
+        self.assertEqual(genome, [(1,), ("two",), (3.5,), "dup", "+"])
+        self.assertEqual(pickle.loads(pickle.dumps(genome)), genome)
+        self.assertEqual(crianza.code_to_string(crianza.genetic.decode(genome)),
+                         crianza.code_to_string(code))
+
+    def test_compact_genome(self):
+        pool = crianza.genetic.ConstantPool()
+        code = crianza.compile(crianza.parse('1 1.0 true 1 dup + "s"'),
+                optimize=False)
+        genome = crianza.genetic.Genome.from_code(code, pool)
+        self.assertEqual(pool.constants, [1, 1.0, True, "s"])
+        self.assertEqual(genome.words.typecode, "B")
+        self.assertEqual(crianza.code_to_string(genome.to_code()),
+                         crianza.code_to_string(code))
+        self.assertEqual(genome.to_code()[0], genome.to_code()[3])
+
+        self.assertEqual(genome[:2] + genome[2:], genome)
+        self.assertEqual((genome[:2] + genome[2:]).key(), genome.key())
+        self.assertNotEqual(genome[1:].key(), genome.key())
+
+        # The arrays widen as the pool grows, and keys do not depend on the
+        # typecode or the pool
+        for n in six.moves.range(300):
+            pool.add(n + 1000)
+        wide = crianza.genetic.Genome.from_code(code, pool)
+        self.assertEqual((genome.words.typecode, wide.words.typecode),
+                         ("B", "H"))
+        self.assertEqual(wide.key(), genome.key())
+        self.assertEqual(wide, genome)
+        self.assertEqual(len(set([genome, wide])), 1)
+        other = crianza.genetic.Genome.from_code(code,
+                crianza.genetic.ConstantPool([2, "s", True]))
+        self.assertEqual(other.key(), genome.key())
+        genome.insert(0, pool.add(-1))
+        self.assertEqual(genome.words.typecode, "H")
+        self.assertEqual(crianza.code_to_string((genome[:1] +
+            crianza.genetic.Genome.from_code(code, pool)).to_code()),
+            "-1 " + crianza.code_to_string(code))
+
+        random.seed(2)
+        m = DoubleInput().randomize()
+        self.assertTrue(isinstance(m.genome, crianza.genetic.Genome))
+        self.assertEqual(m.code_string,
+                         crianza.code_to_string(m.genome.to_code()))
+        for _ in six.moves.range(20):
+            m.mutate()
+            self.assertEqual(m.code_string,
+                             crianza.code_to_string(m.genome.to_code()))
+        child = m.crossover(DoubleInput().randomize())
+        self.assertTrue(child.pool is m.pool)
+        genome = child.genome
+        child.setUp()
+        self.assertEqual(len(child.code), len(genome) + 1)
+        child.run()
+        child.tearDown()
+        self.assertTrue(child.genome is genome)
+
+    def test_selection(self):
+        machines = [DoubleInput() for _ in six.moves.range(4)]
+        for m, fitness in zip(machines, [0.0, 0.5, 1.0, 2.0]):
+            m.fitness = fitness
+
+        def counts(selection):
+            random.seed(1)
+            choose = selection(machines)
+            picks = [choose() for _ in six.moves.range(4000)]
+            return [picks.count(m) for m in machines]
+
+        rank = counts(crianza.genetic.rank_selection)
+        self.assertTrue(rank[0] > rank[1] > rank[2] > rank[3] > 0)
+        self.assertAlmostEqual(rank[0] / float(rank[3]), 4, delta=1)
+
+        proportional = counts(crianza.genetic.proportional_selection)
+        self.assertEqual(proportional[2:], [0, 0])
+        self.assertAlmostEqual(proportional[0] / float(proportional[1]), 2,
+                delta=0.3)
+
+        tournament = counts(crianza.genetic.tournament_selection)
+        self.assertTrue(tournament[0] > tournament[1] > tournament[2] >
+                        tournament[3] > 0)
+        self.assertTrue(all(counts(lambda ms:
+            crianza.genetic.tournament_selection(ms, size=1))))
+
+        stochastic = counts(crianza.genetic.stochastic_selection)
+        self.assertEqual(sum(stochastic), 4000)
+
+        for m in machines:
+            m.fitness = 1.0
+        self.assertTrue(all(counts(crianza.genetic.proportional_selection)))
+
+        # Picks stay in range when the random product rounds up to the total
+        uniform = random.random
+        random.random = lambda: 1.0 - 2**-53
+        try:
+            choose = crianza.genetic._cumulative_choice(machines[:3],
+                    [0.0, 5e-324, 0.0])
+            self.assertTrue(choose() is machines[1])
+        finally:
+            random.random = uniform
+
+        survivors = self.evolve(selection=crianza.genetic.rank_selection)
+        self.assertEqual(self.evolve(selection=crianza.genetic.rank_selection),
+                         survivors)
+
+    def test_restart(self):
+        # No survivors restarts with new machines in the same constant pool
+        stop = lambda iterations, generation: iterations >= 2
+        for workers in [None, 2]:
+            random.seed(1)
+            survivors = crianza.genetic.iterate(DoubleInput, stop,
+                    machines=10, survival_rate=0, silent=True,
+                    workers=workers)
+            self.assertEqual(len(survivors), 10)
+            pools = set(id(m.pool) for m in survivors)
+            self.assertEqual(len(pools), 1)
+            self.assertTrue(isinstance(survivors[0].pool,
+                crianza.genetic.ConstantPool))
+
+    def test_workers(self):
+        serial = self.evolve()
+        self.assertTrue(all(fitness is not None for _, fitness in serial))
+        self.assertEqual(self.evolve(), serial)
+        self.assertEqual(self.evolve(workers=2), serial)
+
+    def test_fitness_cache(self):
+        key = lambda source: DoubleInput(crianza.compile(crianza.parse(source),
+            optimize=False)).key()
+        self.assertEqual(key("1 dup +"), key("1 dup +"))
+        self.assertNotEqual(key("1 dup +"), key("1.0 dup +"))
+        self.assertNotEqual(key("1 dup +"), key("true dup +"))
+
+        cache = crianza.genetic.FitnessCache(size=2)
+        self.assertEqual(cache.get("a"), None)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertEqual((cache.get("b"), cache.get("a"), cache.get("c")),
+                         (None, 1, 3))
+        self.assertEqual((len(cache), cache.hits, cache.misses), (2, 3, 2))
+        self.assertEqual(cache.hit_rate, 0.6)
+
+        evolve = lambda **kw: self.evolve(DoubleSeven, generations=5,
+                survival_rate=0.05, **kw)
+        serial = evolve()
+        cache = crianza.genetic.FitnessCache()
+        self.assertEqual(evolve(cache=cache), serial)
+        self.assertTrue(cache.hits > 0)
+        self.assertEqual(cache.hits + cache.misses, 5*40)
+        self.assertEqual(evolve(workers=2,
+            cache=crianza.genetic.FitnessCache()), serial)
+
 
 if __name__ == "__main__":
     unittest.main()